@@ -1,4 +1,4 @@
-from typing import Dict, List, TypeVar, Generic, Optional
+from typing import Dict, List, Literal, TypeVar, Generic, Optional
 
 from pydantic import BaseModel, Field
 
@@ -65,6 +65,15 @@ class ReqPrdcerLyrMapData(ReqUserId):
     prdcer_lyr_id: Optional[str] = ""
 
 
+class ReqLyrMapData(ReqPrdcerLyrMapData):
+    # Return the layer clustered for this map zoom instead of every point
+    cluster_zoom: Optional[int] = None
+
+
+class ReqStreamLyrMapData(ReqPrdcerLyrMapData):
+    stream_format: Literal["ndjson", "geojson"] = "ndjson"
+
+
 class ReqSavePrdcerLyer(ReqPrdcerLyrMapData):
     prdcer_layer_name: str
     bknd_dataset_id: str
@@ -113,6 +122,11 @@ class ReqFetchCtlgLyrs(BaseModel):
     prdcer_ctlg_id: str
     as_layers: bool
     user_id: str
+    cluster_zoom: Optional[int] = None
+
+
+class ReqStreamCtlgLyrs(ReqFetchCtlgLyrs):
+    stream_format: Literal["layers", "features"] = "layers"
 
 
 class ReqCostEstimate(ReqCityCountry):
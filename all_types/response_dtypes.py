@@ -58,15 +58,23 @@ class CityData(BaseModel):
     type: str = None
 
 
-class ResFetchDataset(BaseModel):
+class ResFetchDatasetHead(BaseModel):
+    """
+    ResFetchDataset without its features, for datasets whose features are
+    assembled by Postgres.
+    """
+
     type: Literal["FeatureCollection"]
-    features: List[Feature]
     bknd_dataset_id: str
     prdcer_lyr_id: str
     records_count: int
     next_page_token: Optional[str] = ""
 
 
+class ResFetchDataset(ResFetchDatasetHead):
+    features: List[Feature]
+
+
 class UserCatalogInfo(BaseModel):
     prdcer_ctlg_id: str
     prdcer_ctlg_name: str
@@ -94,6 +102,16 @@ class ResLyrMapData(MapData, LayerInfo):
     pass
 
 
+class ResLyrMapDataHead(LayerInfo):
+    """
+    ResLyrMapData without its features, for responses that pass the stored
+    features through unvalidated.
+    """
+
+    type: Literal["FeatureCollection"]
+    properties: list[str]
+
+
 class TrafficCondition(BaseModel):
     start_index: int
     end_index: int
@@ -29,14 +29,18 @@ class ApiConfig(CommonApiConfig):
     delete_layer: str = backend_base_uri + "delete_layer"
     user_layers: str = backend_base_uri + "user_layers"
     prdcer_lyr_map_data: str = backend_base_uri + "prdcer_lyr_map_data"
+    prdcer_lyr_map_data_stream: str = backend_base_uri + "prdcer_lyr_map_data/stream"
+    lyr_tile: str = backend_base_uri + "tiles/{prdcer_lyr_id}/{z}/{x}/{y}.mvt"
     nearest_lyr_map_data: str = backend_base_uri + "nearest_lyr_map_data"
     save_producer_catalog: str = backend_base_uri + "save_producer_catalog"
     delete_producer_catalog: str = backend_base_uri + "delete_producer_catalog"
     user_catalogs: str = backend_base_uri + "user_catalogs"
     fetch_ctlg_lyrs: str = backend_base_uri + "fetch_ctlg_lyrs"
+    fetch_ctlg_lyrs_stream: str = backend_base_uri + "fetch_ctlg_lyrs/stream"
     apply_zone_layers: str = backend_base_uri + "apply_zone_layers"
     cost_calculator: str = backend_base_uri + "cost_calculator"
     check_street_view: str = backend_base_uri + "check_street_view"
+    service_metrics: str = backend_base_uri + "service_metrics"
     google_fields: str = (
         "places.id,places.types,places.location,places.rating,places.priceLevel,places.userRatingCount,places.displayName,places.primaryType,places.formattedAddress,places.takeout,places.delivery,places.paymentOptions"
     )
@@ -48,6 +52,90 @@ class ApiConfig(CommonApiConfig):
     gcloud_images_bucket_path:str = "postgreSQL/dbo_operational/raw_schema_marketplace/catalog_thumbnails"
     gcloud_bucket_credentials_json_path:str = "secrets/weighty-gasket-437422-h6-a9caa84da98d.json"
 
+    http_connection_limit: int = 100
+    http_connection_limit_per_host: int = 32
+    http_dns_cache_ttl_seconds: int = 300
+    http_keepalive_timeout_seconds: float = 30.0
+    http_timeout_seconds: float = 60.0
+
+    # Fetch the next text search page in the background while returning the current one
+    text_search_prefetch: bool = False
+    text_search_prefetch_ttl_seconds: int = 120
+
+    # Outbound Google API rate limits (calls per second); bursts allow
+    # quota_burst_seconds worth of calls at once
+    quota_places_nearby_per_second: float = 10.0
+    quota_text_search_per_second: float = 10.0
+    quota_routes_per_second: float = 50.0
+    quota_street_view_per_second: float = 50.0
+    quota_burst_seconds: float = 1.0
+    # Share the buckets between worker processes through Postgres
+    quota_shared_across_workers: bool = False
+
+    # Let only one worker process fetch a given dataset from Google at a time
+    dataset_fetch_lock_enabled: bool = False
+    dataset_fetch_lock_lease_seconds: float = 60.0
+    dataset_fetch_lock_poll_seconds: float = 0.5
+
+    # In-process cache of stored datasets in front of load_dataset
+    dataset_cache_max_bytes: int = 256 * 1024 * 1024
+    dataset_cache_ttl_seconds: float = 300.0
+
+    # Layers of one catalog loaded at the same time
+    ctlg_lyrs_load_concurrency: int = 8
+
+    # Features read from the database per query when streaming a layer
+    stream_features_chunk_size: int = 1000
+
+    # Serve stored map data without validating every feature, see
+    # fetch_lyr_map_data_trusted. Stored features are sent as stored: extra
+    # top-level keys are not dropped and coordinates not coerced to float
+    trusted_map_data_responses: bool = True
+
+    # Build census and Saudi real estate datasets in Postgres, see
+    # fetch_dataset_db_assembled
+    db_geojson_assembly: bool = True
+
+    # Apply pending database_files/migrations when the app starts. Off by
+    # default: migrations adding generated columns rewrite their table under an
+    # ACCESS EXCLUSIVE lock, so run them out of band before deploying, with
+    # python -m database_files.migrate. Startup then fails if any is missing
+    apply_db_migrations_on_startup: bool = False
+
+    # Deferred work, see job_queue.JobQueue. job_workers is per process, 0
+    # leaves the jobs to other processes.
+    job_workers: int = 2
+    job_poll_interval_seconds: float = 1.0
+    job_lease_seconds: float = 300.0
+    job_max_attempts: int = 5
+    job_retry_base_seconds: float = 5.0
+    job_retention_seconds: float = 7 * 24 * 3600.0
+    job_purge_interval_seconds: float = 3600.0
+
+    # Read-through cache of search plans, see plan_store.PlanStore
+    plan_cache_max_plans: int = 256
+    plan_cache_ttl_seconds: float = 30.0
+
+    # Per-layer cache of Mapbox Vector Tiles
+    tile_cache_max_layers: int = 64
+    tile_cache_max_tiles_per_layer: int = 4096
+    tile_cache_ttl_seconds: float = 300.0
+
+    # Zoom-aware point clustering of map layers, see point_clustering.ClusterIndex
+    cluster_max_zoom: int = 16
+    cluster_radius_px: float = 40.0
+    cluster_cache_max_datasets: int = 32
+    cluster_cache_ttl_seconds: float = 300.0
+
+    routes_api_concurrency: int = 16
+    routes_api_max_retries: int = 3
+    routes_api_timeout_seconds: float = 30.0
+    route_cache_ttl_hours: int = 24
+    route_cache_precision: int = 4  # decimal places of lat/lng in the cache key, ~11 m
+    route_matrix_api_url: str = "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix"
+    route_matrix_max_elements: int = 625  # origins x destinations per request
+    route_matrix_max_waypoints: int = 50  # origins + destinations per request
+
     @classmethod
     def get_conf(cls):
         common_conf = CommonApiConfig.get_common_conf()
@@ -1,12 +1,14 @@
+import asyncio
 import logging
 import math
 import geopy.distance
 from urllib.parse import unquote, urlparse
 import uuid
-from typing import List, Dict, Any, Tuple, Optional
+from typing import List, Dict, Any, Tuple, Optional, AsyncIterator
 from geopy.distance import geodesic
 from geopy.geocoders import Nominatim
 import numpy as np
+import orjson
 from fastapi import HTTPException
 from fastapi import status
 from backend_common.auth import (
@@ -24,13 +26,16 @@ from all_types.myapi_dtypes import *
 from all_types.response_dtypes import (
     ResGradientColorBasedOnZone,
     ResLyrMapData,
+    ResLyrMapDataHead,
+    ResFetchDatasetHead,
     LayerInfo,
     UserCatalogInfo,
-    NearestPointRouteResponse,
 )
 from google_api_connector import (
-    calculate_distance_traffic_route,
     fetch_from_google_maps_api,
+    fetch_route_matrix_coalesced,
+    load_cached_drive_times,
+    single_flight_metrics,
     text_fetch_from_google_maps_api,
 )
 from backend_common.logging_wrapper import (
@@ -39,6 +44,7 @@ from backend_common.logging_wrapper import (
 )
 from backend_common.logging_wrapper import log_and_validate
 from mapbox_connector import MapBoxConnector
+from quota_manager import quota_metrics
 from storage import (
     GOOGLE_CATEGORIES,
     REAL_ESTATE_CATEGORIES,
@@ -48,9 +54,14 @@ from storage import (
     # load_area_intelligence_categories,
     get_real_estate_dataset_from_storage,
     get_census_dataset_from_storage,
+    get_census_features_json_from_storage,
+    get_real_estate_features_json_from_storage,
     get_commercial_properties_dataset_from_storage,
     fetch_dataset_id,
+    fetch_dataset_ids,
     load_dataset,
+    open_dataset_feature_stream,
+    dataset_cache_metrics,
     update_dataset_layer_matching,
     update_user_layer_matching,
     delete_dataset_layer_matching,
@@ -67,7 +78,16 @@ from storage import (
     make_ggl_layer_filename,
 )
 from boolean_query_processor import reduce_to_single_query
-from popularity_algo import create_plan, get_plan, process_plan_popularity, save_plan
+from spatial_index import SpatialGridIndex
+from nearest_points import k_nearest_points
+from route_matrix import pack_route_matrix_batches
+from popularity_algo import create_plan, get_plan, save_plan
+from job_queue import JobQueue
+from plan_store import PlanStore
+from search_plan import SearchPlan
+from single_flight import SingleFlight
+from vector_tiles import MAX_TILE_ZOOM, TileCache
+from point_clustering import ClusterCache, ClusterIndex
 
 
 logging.basicConfig(
@@ -77,6 +97,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+TILE_CACHE = TileCache(
+    CONF.tile_cache_max_layers,
+    CONF.tile_cache_max_tiles_per_layer,
+    CONF.tile_cache_ttl_seconds,
+)
+# Tile requests for a layer that is not cached yet share one dataset load
+TILE_LAYER_FLIGHTS = SingleFlight(copy_results=False)
+
+CLUSTER_CACHE = ClusterCache(
+    CONF.cluster_cache_max_datasets, CONF.cluster_cache_ttl_seconds
+)
+CLUSTER_FLIGHTS = SingleFlight(copy_results=False)
+
 EXPANSION_DISTANCE_KM = 60.0  # for each side from the center of the bounding box
 # Global cache dictionary to store previously fetched locations
 _LOCATION_CACHE = {}
@@ -283,11 +316,22 @@ async def fetch_ggl_nearby(req: ReqFetchDataset):
 
     if "default" in search_type or "category_search" in search_type:
         dataset = await fetch_from_google_maps_api(req)
+        if action == "full data":
+            # Score the page just stored together with the plan's earlier pages
+            await JobQueue.enqueue(
+                "plan_popularity", {"plan_name": plan_name}, dedupe_key=plan_name
+            )
     elif "keyword_search" in search_type:
-        ggl_api_resp, _ = await text_fetch_from_google_maps_api(req)
+        # A full data request pages through its search plan, not Google's tokens
+        paged_by_google = action != "full data"
+        ggl_api_resp, ggl_next_page_token = await text_fetch_from_google_maps_api(
+            req, prefetch_next_page=paged_by_google and CONF.text_search_prefetch
+        )
         dataset = await MapBoxConnector.new_ggl_to_boxmap(ggl_api_resp, req.radius)
         if ggl_api_resp:
             dataset = convert_strings_to_ints(dataset)
+        if paged_by_google:
+            next_page_token = ggl_next_page_token or ""
     # Store the fetched data in storage
     # dataset = await MapBoxConnector.new_ggl_to_boxmap(ggl_api_resp,req.radius)
     # if ggl_api_resp:
@@ -312,58 +356,23 @@ async def fetch_ggl_nearby(req: ReqFetchDataset):
 
 async def rectify_plan(plan_name, current_plan_index):
     plan = await get_plan(plan_name)
-    rectified_plan = add_skip_to_subcircles(plan, current_plan_index)
-    await save_plan(plan_name, rectified_plan)
-    next_plan_index = get_next_non_skip_index(rectified_plan, current_plan_index)
-
-    return next_plan_index
-
-
-def get_next_non_skip_index(rectified_plan, current_plan_index):
-    for i in range(current_plan_index + 1, len(rectified_plan)):
-        if (
-            not rectified_plan[i].endswith("_skip")
-            and rectified_plan[i] != "end of search plan"
-        ):
-            # Return the new token with the found index
-            return i
-
-    # If no non-skipped item is found, return None or a special token
-    return ""
-
-
-def add_skip_to_subcircles(plan: list, token_plan_index: str):
-    circle_string = plan[token_plan_index]
-    # Extract the circle number from the input string
-
-    circle_number = circle_string.split("_circle=")[1].split("_")[0].replace("*", "")
-
-    def is_subcircle(circle):
-        circle = "_circle=" + circle.split("_circle=")[1]
-        return circle.startswith(f"_circle={circle_number}.")
+    plan.skip_subcircles(current_plan_index)
+    await PlanStore.skip_subcircles(plan_name, current_plan_index)
+    next_plan_index = plan.next_unskipped(current_plan_index)
 
-    # Add "_skip" to subcircles
-    modified_plan = []
-    for circle in plan[:-1]:
-        if is_subcircle(circle):
-            if not circle.endswith("_skip"):
-                circle += "_skip"
-        modified_plan.append(circle)
-    # Add the last item separately
-    modified_plan.append(plan[-1])
-
-    return modified_plan
+    # If no non-skipped circle is left, return the end of plan token
+    return "" if next_plan_index is None else next_plan_index
 
 
 async def process_req_plan(req: ReqFetchDataset):
     action = req.action
-    plan: List[str] = []
+    plan: Optional[SearchPlan] = None
     current_plan_index = 0
     bknd_dataset_id = ""
 
     if req.page_token == "" and action == "full data":
         if req.radius > 750:
-            string_list_plan = await create_plan(
+            plan = await create_plan(
                 req.lng, req.lat, req.radius, req.boolean_query, req.text_search
             )
 
@@ -372,18 +381,16 @@ async def process_req_plan(req: ReqFetchDataset):
         plan_name = f"plan_{tcc_string}"
         if req.text_search != "" and req.text_search is not None:
             plan_name = plan_name + "_text_search="
-        await save_plan(plan_name, string_list_plan)
-        plan = string_list_plan
+        await save_plan(plan_name, plan)
 
-        next_search = string_list_plan[0]
-        first_search = next_search.split("_")
+        first_search = plan.circles[0]
         req.lng, req.lat, req.radius = (
-            float(first_search[0]),
-            float(first_search[1]),
-            float(first_search[2]),
+            first_search.lng,
+            first_search.lat,
+            first_search.radius,
         )
 
-        bknd_dataset_id = plan[current_plan_index]
+        bknd_dataset_id = plan.entry(current_plan_index)
         next_page_token = f"page_token={plan_name}@#${1}"  # Start with the first search
 
     elif req.page_token != "":
@@ -407,23 +414,18 @@ async def process_req_plan(req: ReqFetchDataset):
         ):
             return req, plan_name, "", current_plan_index, bknd_dataset_id
 
-        search_info = plan[current_plan_index].split("_")
+        search_info = plan.circles[current_plan_index]
         req.lng, req.lat, req.radius = (
-            float(search_info[0]),
-            float(search_info[1]),
-            float(search_info[2]),
+            search_info.lng,
+            search_info.lat,
+            search_info.radius,
         )
         next_plan_index = current_plan_index + 1
-        if plan[next_plan_index] == "end of search plan":
+        if next_plan_index >= len(plan):
             next_page_token = ""  # End of search plan
-            await process_plan_popularity(plan_name)
         else:
             next_page_token = f"page_token={plan_name}@#${next_plan_index}"
 
-        # TODO: Remove this after testing Process plan at index 5
-        if current_plan_index == 5:
-            await process_plan_popularity(plan_name)
-
     return req, plan_name, next_page_token, current_plan_index, bknd_dataset_id
 
 
@@ -602,19 +604,14 @@ def determine_data_type(boolean_query: str, categories: Dict) -> Optional[str]:
     return "google_categories"
 
 
-async def fetch_dataset(req: ReqFetchDataset):
-    """
-    This function attempts to fetch an existing layer based on the provided
-    request parameters. If the layer exists, it loads the data, transforms it,
-    and returns it. If the layer doesn't exist, it creates a new layer
-    """
-    next_page_token = None
+def make_dataset_layer_id(req: ReqFetchDataset) -> str:
     new_layer_id = req.prdcer_lyr_id
     if req.page_token != "" or req.page_token != "0":
         new_layer_id = generate_layer_id()
+    return new_layer_id
 
-    geojson_dataset = []
 
+async def fetch_dataset_data_type(req: ReqFetchDataset) -> str:
     # Load all categories
 
     categories = await poi_categories(
@@ -622,7 +619,21 @@ async def fetch_dataset(req: ReqFetchDataset):
     )
 
     # Now using boolean_query instead of included_types
-    data_type = determine_data_type(req.boolean_query, categories)
+    return determine_data_type(req.boolean_query, categories)
+
+
+async def fetch_dataset(req: ReqFetchDataset):
+    """
+    This function attempts to fetch an existing layer based on the provided
+    request parameters. If the layer exists, it loads the data, transforms it,
+    and returns it. If the layer doesn't exist, it creates a new layer
+    """
+    next_page_token = None
+    new_layer_id = make_dataset_layer_id(req)
+
+    geojson_dataset = []
+
+    data_type = await fetch_dataset_data_type(req)
 
     if (
         data_type == "real_estate"
@@ -665,6 +676,51 @@ async def fetch_dataset(req: ReqFetchDataset):
     return geojson_dataset
 
 
+async def fetch_dataset_db_assembled(
+    req: ReqFetchDataset,
+) -> Optional[Tuple[ResFetchDatasetHead, str]]:
+    """
+    fetch_dataset for census and Saudi real estate datasets with the features
+    assembled by Postgres. Returns the response without its features and the
+    features array as JSON text, which is never decoded here. Returns None
+    for requests that fetch_dataset has to handle, e.g. "full data" ones.
+    """
+    if req.action == "full data":
+        return None
+
+    data_type = await fetch_dataset_data_type(req)
+    if data_type == "real_estate" or (
+        data_type == "commercial" and req.country_name == "Saudi Arabia"
+    ):
+        get_features_func = get_real_estate_features_json_from_storage
+    elif data_type in ["Population Area Intelligence"]:
+        get_features_func = get_census_features_json_from_storage
+    else:
+        return None
+
+    new_layer_id = make_dataset_layer_id(req)
+    req._included_types, req._excluded_types = reduce_to_single_query(req.boolean_query)
+    req = fetch_lat_lng_bounding_box(req)
+
+    features_json, records_count, bknd_dataset_id, next_page_token = (
+        await get_features_func(
+            "",
+            req.action,
+            request_location=req,
+            next_page_token=req.page_token,
+            data_type=data_type,
+        )
+    )
+    head = ResFetchDatasetHead(
+        type="FeatureCollection",
+        bknd_dataset_id=bknd_dataset_id,
+        prdcer_lyr_id=new_layer_id,
+        records_count=records_count,
+        next_page_token=next_page_token,
+    )
+    return head, features_json
+
+
 async def save_lyr(req: ReqSavePrdcerLyer) -> str:
     user_data = await load_user_profile(req.user_id)
 
@@ -787,37 +843,41 @@ async def aquire_user_lyrs(req: ReqUserId) -> List[LayerInfo]:
     return user_layers_metadata
 
 
-async def fetch_lyr_map_data(req: ReqPrdcerLyrMapData) -> ResLyrMapData:
+async def load_lyr_metadata(prdcer_lyr_id: str) -> Tuple[Dict, str, Dict]:
     """
-    Fetches detailed map data for a specific producer layer.
+    Looks up a producer layer's metadata in its owner's profile and the
+    dataset behind it.
+
+    Returns:
+        The layer metadata, the dataset id and the dataset info.
     """
-    dataset = {}
     user_layer_matching = await load_user_layer_matching()
-    layer_owner_id = user_layer_matching.get(req.prdcer_lyr_id)
+    layer_owner_id = user_layer_matching.get(prdcer_lyr_id)
     layer_owner_data = await load_user_profile(layer_owner_id)
 
     try:
-        layer_metadata = layer_owner_data["prdcer"]["prdcer_lyrs"][req.prdcer_lyr_id]
+        layer_metadata = layer_owner_data["prdcer"]["prdcer_lyrs"][prdcer_lyr_id]
     except KeyError as ke:
         raise HTTPException(
             status_code=404, detail="Producer layer not found for this user"
         ) from ke
 
-    dataset_id, dataset_info = await fetch_dataset_id(req.prdcer_lyr_id)
-    dataset = await load_dataset(dataset_id, fetch_full_plan_datasets=True)
+    dataset_id, dataset_info = await fetch_dataset_id(prdcer_lyr_id)
+    return layer_metadata, dataset_id, dataset_info
 
-    # Extract properties from first feature if available
-    properties = []
-    if dataset.get("features") and len(dataset.get("features", [])) > 0:
-        first_feature = dataset.get("features", [])[0]
-        properties = list(first_feature.get("properties", {}).keys())
 
-    return ResLyrMapData(
+def make_lyr_map_data_head(
+    prdcer_lyr_id: str,
+    layer_metadata: Dict,
+    dataset_id: str,
+    dataset_info: Dict,
+    properties: List[str],
+) -> ResLyrMapDataHead:
+    return ResLyrMapDataHead(
         type="FeatureCollection",
-        features=dataset.get("features", []),
-        properties=properties,  # Add the properties list here
+        properties=properties,
         prdcer_layer_name=layer_metadata.get("prdcer_layer_name"),
-        prdcer_lyr_id=req.prdcer_lyr_id,
+        prdcer_lyr_id=prdcer_lyr_id,
         bknd_dataset_id=dataset_id,
         points_color=layer_metadata.get("points_color"),
         layer_legend=layer_metadata.get("layer_legend"),
@@ -828,6 +888,187 @@ async def fetch_lyr_map_data(req: ReqPrdcerLyrMapData) -> ResLyrMapData:
     )
 
 
+async def load_cluster_index(dataset_id: str) -> ClusterIndex:
+    """
+    The cluster hierarchy of a dataset, from which its features clustered for
+    any zoom are a lookup. It is built once, off the event loop, and kept in
+    CLUSTER_CACHE; the dataset is only loaded to build it.
+    """
+    index = CLUSTER_CACHE.get(dataset_id)
+    if index is None:
+
+        async def build_index() -> ClusterIndex:
+            dataset = await load_dataset(dataset_id, fetch_full_plan_datasets=True)
+            features = dataset.get("features", [])
+            index = await asyncio.to_thread(
+                ClusterIndex,
+                features,
+                max_zoom=CONF.cluster_max_zoom,
+                radius=CONF.cluster_radius_px,
+            )
+            CLUSTER_CACHE.put(dataset_id, index)
+            return index
+
+        index = await CLUSTER_FLIGHTS.do(dataset_id, build_index)
+    return index
+
+
+async def fetch_lyr_map_data_trusted(
+    req: ReqLyrMapData,
+) -> Tuple[ResLyrMapDataHead, List[Dict]]:
+    """
+    Fetches a producer layer as its validated head and its stored features.
+    The features come from our own datasets table and are returned as is,
+    without building a Feature model per feature. Unlike Feature validation,
+    this keeps any extra top-level keys of a stored feature and does not
+    coerce its coordinates to float, so the response matches the untrusted
+    path only for features stored in that shape. With req.cluster_zoom the
+    features are the layer's clusters at that zoom.
+    """
+    layer_metadata, dataset_id, dataset_info = await load_lyr_metadata(
+        req.prdcer_lyr_id
+    )
+    if req.cluster_zoom is not None:
+        # A zoom change is a lookup in the cached index, not a dataset load
+        index = await load_cluster_index(dataset_id)
+        head = make_lyr_map_data_head(
+            req.prdcer_lyr_id,
+            layer_metadata,
+            dataset_id,
+            dataset_info,
+            index.feature_properties,
+        )
+        return head, index.clusters(req.cluster_zoom)
+
+    dataset = await load_dataset(dataset_id, fetch_full_plan_datasets=True)
+    features = dataset.get("features", [])
+
+    # Extract properties from first feature if available
+    properties = []
+    if features:
+        properties = list(features[0].get("properties", {}).keys())
+
+    head = make_lyr_map_data_head(
+        req.prdcer_lyr_id, layer_metadata, dataset_id, dataset_info, properties
+    )
+    return head, features
+
+
+async def fetch_lyr_map_data(req: ReqLyrMapData) -> ResLyrMapData:
+    """
+    Fetches detailed map data for a specific producer layer.
+    """
+    head, features = await fetch_lyr_map_data_trusted(req)
+    return ResLyrMapData(features=features, **head.model_dump())
+
+
+def feature_property_names(features: List[str]) -> List[str]:
+    """
+    Property names of the first feature, given features as JSON text.
+    """
+    if not features:
+        return []
+    return list(orjson.loads(features[0]).get("properties", {}).keys())
+
+
+async def chain_feature_chunks(
+    first_chunk: List[str], chunks: AsyncIterator[List[str]]
+) -> AsyncIterator[List[str]]:
+    """
+    The non-empty chunks of a feature stream whose first chunk was already read.
+    """
+    if first_chunk:
+        yield first_chunk
+    async for chunk in chunks:
+        if chunk:
+            yield chunk
+
+
+def encode_feature_stream(
+    head: Dict,
+    first_chunk: List[str],
+    chunks: AsyncIterator[List[str]],
+    stream_format: str,
+) -> AsyncIterator[bytes]:
+    """
+    Encodes a layer streamed as chunks of features in JSON text. "ndjson" sends
+    `head` on the first line and then one feature per line; "geojson" sends a
+    single FeatureCollection made of `head` and the features. Features are
+    passed through as stored, never decoded.
+    """
+
+    async def ndjson() -> AsyncIterator[bytes]:
+        yield orjson.dumps(head) + b"\n"
+        async for chunk in chain_feature_chunks(first_chunk, chunks):
+            yield "\n".join(chunk).encode() + b"\n"
+
+    async def geojson() -> AsyncIterator[bytes]:
+        # Open the head object and append the features array to it
+        yield orjson.dumps(head)[:-1] + b',"features":['
+        separator = b""
+        async for chunk in chain_feature_chunks(first_chunk, chunks):
+            yield separator + ",".join(chunk).encode()
+            separator = b","
+        yield b"]}"
+
+    if stream_format == "geojson":
+        return geojson()
+    return ndjson()
+
+
+async def stream_lyr_map_data(req: ReqStreamLyrMapData) -> AsyncIterator[bytes]:
+    """
+    Streaming variant of fetch_lyr_map_data. Features are read from the
+    database as JSON text one stored dataset at a time and sent
+    CONF.stream_features_chunk_size at a time, so memory use is bounded by the
+    largest stored dataset (a page, for plan layers) rather than by the decoded
+    layer. A missing layer raises before the stream starts.
+    """
+    layer_metadata, dataset_id, dataset_info = await load_lyr_metadata(
+        req.prdcer_lyr_id
+    )
+    _, chunks = await open_dataset_feature_stream(
+        dataset_id,
+        fetch_full_plan_datasets=True,
+        chunk_size=CONF.stream_features_chunk_size,
+    )
+    first_chunk = await anext(chunks, [])
+
+    head = make_lyr_map_data_head(
+        req.prdcer_lyr_id,
+        layer_metadata,
+        dataset_id,
+        dataset_info,
+        feature_property_names(first_chunk),
+    )
+    return encode_feature_stream(
+        head.model_dump(), first_chunk, chunks, req.stream_format
+    )
+
+
+async def fetch_lyr_tile(prdcer_lyr_id: str, z: int, x: int, y: int) -> bytes:
+    """
+    Fetches tile z/x/y of a producer layer as a Mapbox Vector Tile holding only
+    the layer's features in that tile. The layer's dataset is loaded once and
+    kept in TILE_CACHE with the tiles encoded from it.
+    """
+    if not 0 <= z <= MAX_TILE_ZOOM or not (0 <= x < 2**z and 0 <= y < 2**z):
+        raise HTTPException(status_code=400, detail="Invalid tile coordinates")
+
+    layer_tiles = TILE_CACHE.get(prdcer_lyr_id)
+    if layer_tiles is None:
+
+        async def build_layer_tiles():
+            _, dataset_id, _ = await load_lyr_metadata(prdcer_lyr_id)
+            dataset = await load_dataset(dataset_id, fetch_full_plan_datasets=True)
+            return TILE_CACHE.build(
+                prdcer_lyr_id, dataset_id, dataset.get("features", [])
+            )
+
+        layer_tiles = await TILE_LAYER_FLIGHTS.do(prdcer_lyr_id, build_layer_tiles)
+    return layer_tiles.tile(z, x, y)
+
+
 async def save_prdcer_ctlg(req: ReqSavePrdcerCtlg) -> str:
     """
     Creates and saves a new producer catalog.
@@ -942,72 +1183,232 @@ async def fetch_prdcer_ctlgs(req: ReqUserId) -> List[UserCatalogInfo]:
         ) from e
 
 
-async def fetch_ctlg_lyrs(req: ReqFetchCtlgLyrs) -> List[ResLyrMapData]:
+async def load_ctlg(req: ReqFetchCtlgLyrs) -> Tuple[Dict, Dict]:
     """
-    Fetches all layers associated with a specific catalog.
+    Finds the requested catalog among the user's catalogs or the store catalogs
+    and loads its owner's profile.
     """
-    try:
-        user_data = await load_user_profile(req.user_id)
-        ctlg = (
-            user_data.get("prdcer", {})
-            .get("prdcer_ctlgs", {})
-            .get(req.prdcer_ctlg_id, {})
+    user_data = await load_user_profile(req.user_id)
+    ctlg = (
+        user_data.get("prdcer", {})
+        .get("prdcer_ctlgs", {})
+        .get(req.prdcer_ctlg_id, {})
+    )
+    if not ctlg:
+        store_ctlgs = load_store_catalogs()
+        ctlg = next(
+            (
+                ctlg_info
+                for ctlg_key, ctlg_info in store_ctlgs.items()
+                if ctlg_key == req.prdcer_ctlg_id
+            ),
+            {},
         )
-        if not ctlg:
-            store_ctlgs = load_store_catalogs()
-            ctlg = next(
-                (
-                    ctlg_info
-                    for ctlg_key, ctlg_info in store_ctlgs.items()
-                    if ctlg_key == req.prdcer_ctlg_id
-                ),
-                {},
+    if not ctlg:
+        raise HTTPException(status_code=404, detail="Catalog not found")
+
+    ctlg_owner_data = await load_user_profile(ctlg["ctlg_owner_user_id"])
+    return ctlg, ctlg_owner_data
+
+
+def make_ctlg_lyr_info(
+    lyr_id: str, dataset_id: str, records_count: int, ctlg_owner_data: Dict
+) -> LayerInfo:
+    lyr_metadata = (
+        ctlg_owner_data.get("prdcer", {}).get("prdcer_lyrs", {}).get(lyr_id, {})
+    )
+
+    return LayerInfo(
+        prdcer_layer_name=lyr_metadata.get(
+            "prdcer_layer_name", f"Layer {lyr_id}"
+        ),
+        prdcer_lyr_id=lyr_id,
+        bknd_dataset_id=dataset_id,
+        points_color=lyr_metadata.get("points_color", "red"),
+        layer_legend=lyr_metadata.get("layer_legend", ""),
+        layer_description=lyr_metadata.get("layer_description", ""),
+        records_count=records_count,
+        city_name=lyr_metadata["city_name"],
+        is_zone_lyr="false",
+    )
+
+
+def make_ctlg_lyr_head(
+    lyr_id: str,
+    dataset_id: str,
+    properties: List[str],
+    records_count: int,
+    ctlg_owner_data: Dict,
+) -> ResLyrMapDataHead:
+    lyr_info = make_ctlg_lyr_info(lyr_id, dataset_id, records_count, ctlg_owner_data)
+
+    return ResLyrMapDataHead(
+        type="FeatureCollection",
+        properties=properties,
+        **lyr_info.model_dump(),
+    )
+
+
+async def resolve_ctlg_lyrs(
+    req: ReqFetchCtlgLyrs,
+) -> Tuple[List[str], Dict[str, Tuple[str, Dict]], Dict]:
+    """
+    Resolves the catalog and the datasets of all its layers in one pass.
+
+    Returns:
+        The layer ids in catalog order, their (dataset id, dataset info) and
+        the catalog owner's profile.
+    """
+    ctlg, ctlg_owner_data = await load_ctlg(req)
+    lyr_ids = [lyr_info["layer_id"] for lyr_info in ctlg["lyrs"]]
+    dataset_ids = await fetch_dataset_ids(lyr_ids)
+    for lyr_id in lyr_ids:
+        if lyr_id not in dataset_ids:
+            raise HTTPException(
+                status_code=404, detail=f"Dataset not found for layer {lyr_id}"
             )
-        if not ctlg:
-            raise HTTPException(status_code=404, detail="Catalog not found")
+    return lyr_ids, dataset_ids, ctlg_owner_data
 
-        ctlg_owner_data = await load_user_profile(ctlg["ctlg_owner_user_id"])
-        ctlg_lyrs_map_data = []
 
-        for lyr_info in ctlg["lyrs"]:
-            lyr_id = lyr_info["layer_id"]
-            dataset_id, dataset_info = await fetch_dataset_id(lyr_id)
-            trans_dataset = await load_dataset(
-                dataset_id, fetch_full_plan_datasets=True
+async def start_ctlg_lyr_loads(req: ReqFetchCtlgLyrs) -> List[asyncio.Task]:
+    """
+    Resolves the catalog's layers, then starts loading them concurrently, at
+    most CONF.ctlg_lyrs_load_concurrency at a time.
+
+    Returns:
+        One task per layer in catalog order, each resolving to
+        (position in the catalog, layer head, stored layer features).
+    """
+    lyr_ids, dataset_ids, ctlg_owner_data = await resolve_ctlg_lyrs(req)
+
+    semaphore = asyncio.Semaphore(CONF.ctlg_lyrs_load_concurrency)
+
+    async def load_lyr(
+        position: int, lyr_id: str
+    ) -> Tuple[int, ResLyrMapDataHead, List[Dict]]:
+        dataset_id, _ = dataset_ids[lyr_id]
+        if req.cluster_zoom is not None:
+            # Layers with a cached cluster index are not loaded again
+            index = CLUSTER_CACHE.get(dataset_id)
+            if index is None:
+                async with semaphore:
+                    index = await load_cluster_index(dataset_id)
+            head = make_ctlg_lyr_head(
+                lyr_id,
+                dataset_id,
+                index.feature_properties,
+                index.feature_count,
+                ctlg_owner_data,
             )
-            # trans_dataset = await MapBoxConnector.new_ggl_to_boxmap(trans_dataset)
+            return position, head, index.clusters(req.cluster_zoom)
+
+        async with semaphore:
+            trans_dataset = await load_dataset(dataset_id, fetch_full_plan_datasets=True)
+        features = trans_dataset.get("features", [])
+        # Extract properties from first feature if available
+        properties = []
+        if features:
+            properties = list(features[0].get("properties", {}).keys())
+        head = make_ctlg_lyr_head(
+            lyr_id, dataset_id, properties, len(features), ctlg_owner_data
+        )
+        return position, head, features
+
+    return [
+        asyncio.create_task(load_lyr(position, lyr_id))
+        for position, lyr_id in enumerate(lyr_ids)
+    ]
+
+
+async def fetch_ctlg_lyrs_trusted(
+    req: ReqFetchCtlgLyrs,
+) -> List[Tuple[ResLyrMapDataHead, List[Dict]]]:
+    """
+    Fetches all layers of a catalog in catalog order, as validated heads and
+    stored features, like fetch_lyr_map_data_trusted.
+    """
+    tasks = await start_ctlg_lyr_loads(req)
+    try:
+        return [(head, features) for _, head, features in await asyncio.gather(*tasks)]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def fetch_ctlg_lyrs(req: ReqFetchCtlgLyrs) -> List[ResLyrMapData]:
+    """
+    Fetches all layers associated with a specific catalog, in catalog order.
+    """
+    return [
+        ResLyrMapData(features=features, **head.model_dump())
+        for head, features in await fetch_ctlg_lyrs_trusted(req)
+    ]
 
-            # Extract properties from first feature if available
-            properties = []
-            if trans_dataset.get("features") and len(trans_dataset["features"]) > 0:
-                first_feature = trans_dataset["features"][0]
-                properties = list(first_feature.get("properties", {}).keys())
 
-            lyr_metadata = (
-                ctlg_owner_data.get("prdcer", {}).get("prdcer_lyrs", {}).get(lyr_id, {})
+async def stream_ctlg_lyr_features(req: ReqFetchCtlgLyrs) -> AsyncIterator[bytes]:
+    """
+    Streams a catalog one feature at a time, layer after layer in catalog
+    order: a {"catalog_index": ..., "layer": ...} line with the layer info,
+    then a {"catalog_index": ..., "feature": ...} line per feature.
+    """
+    if req.cluster_zoom is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="cluster_zoom is not supported when streaming features",
+        )
+    lyr_ids, dataset_ids, ctlg_owner_data = await resolve_ctlg_lyrs(req)
+
+    async def lines() -> AsyncIterator[bytes]:
+        for position, lyr_id in enumerate(lyr_ids):
+            dataset_id, _ = dataset_ids[lyr_id]
+            records_count, chunks = await open_dataset_feature_stream(
+                dataset_id,
+                fetch_full_plan_datasets=True,
+                chunk_size=CONF.stream_features_chunk_size,
             )
+            first_chunk = await anext(chunks, [])
+            head = {
+                "type": "FeatureCollection",
+                "properties": feature_property_names(first_chunk),
+                **make_ctlg_lyr_info(
+                    lyr_id, dataset_id, records_count, ctlg_owner_data
+                ).model_dump(),
+            }
+            yield orjson.dumps({"catalog_index": position, "layer": head}) + b"\n"
 
-            ctlg_lyrs_map_data.append(
-                ResLyrMapData(
-                    type="FeatureCollection",
-                    features=trans_dataset["features"],
-                    properties=properties,  # Add the properties list here
-                    prdcer_layer_name=lyr_metadata.get(
-                        "prdcer_layer_name", f"Layer {lyr_id}"
-                    ),
-                    prdcer_lyr_id=lyr_id,
-                    bknd_dataset_id=dataset_id,
-                    points_color=lyr_metadata.get("points_color", "red"),
-                    layer_legend=lyr_metadata.get("layer_legend", ""),
-                    layer_description=lyr_metadata.get("layer_description", ""),
-                    records_count=len(trans_dataset["features"]),
-                    city_name=lyr_metadata["city_name"],
-                    is_zone_lyr="false",
+            prefix = b'{"catalog_index":%d,"feature":' % position
+            async for chunk in chain_feature_chunks(first_chunk, chunks):
+                yield b"".join(
+                    prefix + feature.encode() + b"}\n" for feature in chunk
                 )
-            )
-        return ctlg_lyrs_map_data
-    except HTTPException:
-        raise
+
+    return lines()
+
+
+async def stream_ctlg_lyrs(req: ReqStreamCtlgLyrs) -> AsyncIterator[bytes]:
+    """
+    Streaming variant of fetch_ctlg_lyrs. Returns NDJSON lines of
+    {"catalog_index": ..., "layer": ...}, each sent as soon as that layer is
+    loaded. With stream_format "features" layers are streamed feature by
+    feature instead, see stream_ctlg_lyr_features. A missing catalog or
+    dataset raises before the stream starts.
+    """
+    if req.stream_format == "features":
+        return await stream_ctlg_lyr_features(req)
+
+    tasks = await start_ctlg_lyr_loads(req)
+
+    async def lines() -> AsyncIterator[bytes]:
+        try:
+            for finished in asyncio.as_completed(tasks):
+                position, head, features = await finished
+                layer = {**head.model_dump(), "features": features}
+                yield orjson.dumps({"catalog_index": position, "layer": layer}) + b"\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return lines()
 
 
 def calculate_thresholds(values: List[float]) -> List[float]:
@@ -1111,6 +1512,21 @@ async def fetch_gradient_colors() -> List[List]:
     return GRADIENT_COLORS
 
 
+async def fetch_service_metrics() -> Dict[str, Any]:
+    """
+    Runtime metrics of the backend, e.g. outbound API queue depth and waits.
+    """
+    return {
+        "api_quotas": quota_metrics(),
+        "single_flight": single_flight_metrics(),
+        "dataset_cache": dataset_cache_metrics(),
+        "tile_cache": TILE_CACHE.metrics(),
+        "cluster_cache": CLUSTER_CACHE.metrics(),
+        "job_queue": await JobQueue.metrics(),
+        "plan_cache": PlanStore.metrics(),
+    }
+
+
 async def given_layer_fetch_dataset(layer_id: str):
     # given layer id get dataset
     user_layer_matching = await load_user_layer_matching()
@@ -1159,7 +1575,7 @@ def assign_point_properties(point):
 #             for point in req.points
 #         ]
 
-#         nearest_points = await calculate_nearest_points(
+#         nearest_points = await filter_for_nearest_points(
 #             coordinates_list, business_target_coordinates
 #         )
 
@@ -1178,29 +1594,33 @@ async def filter_for_nearest_points(
     bussiness_target_coordinates: List[Dict[str, float]],
     num_points_per_target=3,
 ) -> List[Dict[str, Any]]:
-    nearest_locations = []
-    for target in bussiness_target_coordinates:
-        distances = []
-        for loc in category_coordinates:
-            dist = calculate_distance_km(
-                (target["longitude"], target["latitude"]),
-                (loc["longitude"], loc["latitude"]),
-            )
-            distances.append(
-                {
-                    "latitude": loc["latitude"],
-                    "longitude": loc["longitude"],
-                    "distance": dist,
-                }
-            )
+    """
+    Finds the `num_points_per_target` category coordinates closest to each
+    business target, ordered nearest first. Each result carries the position of
+    its target in `bussiness_target_coordinates` as "target_index".
+    """
+    nearest_indices, _ = k_nearest_points(
+        [loc["latitude"] for loc in category_coordinates],
+        [loc["longitude"] for loc in category_coordinates],
+        [target["latitude"] for target in bussiness_target_coordinates],
+        [target["longitude"] for target in bussiness_target_coordinates],
+        k=num_points_per_target,
+    )
 
-        # Sort distances and get the nearest 3
-        nearest = sorted(distances, key=lambda x: x["distance"])[:num_points_per_target]
+    nearest_locations = []
+    for target_index, (target, indices) in enumerate(
+        zip(bussiness_target_coordinates, nearest_indices)
+    ):
         nearest_locations.append(
             {
                 "target": target,
+                "target_index": target_index,
                 "nearest_coordinates": [
-                    (loc["latitude"], loc["longitude"]) for loc in nearest
+                    (
+                        category_coordinates[i]["latitude"],
+                        category_coordinates[i]["longitude"],
+                    )
+                    for i in indices
                 ],
             }
         )
@@ -1208,32 +1628,73 @@ async def filter_for_nearest_points(
     return nearest_locations
 
 
-async def calculate_nearest_points_drive_time(
+async def stream_drive_times(
     nearest_locations: List[Dict[str, Any]]
-) -> List[NearestPointRouteResponse]:
-    results = []
-    for item in nearest_locations:
-        target = item["target"]
-        target_routes = NearestPointRouteResponse(target=target, routes=[])
-
-        for nearest in item["nearest_coordinates"]:
-            origin = f"{target['latitude']},{target['longitude']}"
-            destination = f"{nearest[0]},{nearest[1]}"
-
-            try:
-                # Fetch route information between target and nearest location
-                route_info = await calculate_distance_traffic_route(origin, destination)
-                target_routes.routes.append(route_info)
-            except HTTPException as e:
-                # Handle HTTP exceptions during the route fetching
-                target_routes.routes.append({"error": str(e.detail)})
-            except Exception as e:
-                # Handle any other exceptions
-                target_routes.routes.append({"error": f"An error occurred: {str(e)}"})
-
-        results.append(target_routes)
+) -> AsyncIterator[Tuple[Dict[str, Any], Optional[float]]]:
+    """
+    Resolves the shortest static drive time, in seconds, from every target to
+    one of its nearest coordinates. Durations in the route cache are used as
+    is, the other pairs are packed into batched Route Matrix requests. Results
+    are yielded as `(item, seconds)` as soon as all routes of a target are in;
+    seconds is None when no route is available.
+    """
+    targets = [
+        (item["target"]["latitude"], item["target"]["longitude"])
+        for item in nearest_locations
+    ]
 
-    return results
+    async def run_batch(
+        positions: List[int],
+        destinations: List[Tuple[float, float]],
+        pairs: List[Tuple[int, int]],
+    ):
+        origins = [targets[i] for i in positions]
+        try:
+            durations = await fetch_route_matrix_coalesced(origins, destinations)
+        except Exception as e:
+            logger.warning(f"Route matrix request for {len(origins)} targets failed: {str(e)}")
+            durations = {}
+        return positions, pairs, durations
+
+    cached = await load_cached_drive_times(
+        [
+            (targets[i], coord)
+            for i, item in enumerate(nearest_locations)
+            for coord in dict.fromkeys(item["nearest_coordinates"])
+        ]
+    )
+    pending = [0] * len(nearest_locations)
+    shortest: List[Optional[float]] = [None] * len(nearest_locations)
+    uncached_locations = []
+    for i, item in enumerate(nearest_locations):
+        uncached = []
+        for coord in dict.fromkeys(item["nearest_coordinates"]):
+            seconds = cached.get((targets[i], coord))
+            if seconds is None:
+                uncached.append(coord)
+            elif shortest[i] is None or seconds < shortest[i]:
+                shortest[i] = seconds
+        pending[i] = len(uncached)
+        uncached_locations.append({**item, "nearest_coordinates": uncached})
+        if pending[i] == 0:
+            yield item, shortest[i]
+
+    batches = pack_route_matrix_batches(
+        uncached_locations,
+        CONF.route_matrix_max_elements,
+        CONF.route_matrix_max_waypoints,
+    )
+    for finished in asyncio.as_completed([run_batch(*batch) for batch in batches]):
+        positions, pairs, durations = await finished
+        # Only the pairs the batch was packed for count, each pair is in one batch
+        for origin_index, destination_index in pairs:
+            i = positions[origin_index]
+            seconds = durations.get((origin_index, destination_index))
+            if seconds is not None and (shortest[i] is None or seconds < shortest[i]):
+                shortest[i] = seconds
+            pending[i] -= 1
+            if pending[i] == 0:
+                yield nearest_locations[i], shortest[i]
 
 
 def filter_locations_by_drive_time(
@@ -1266,7 +1727,7 @@ def filter_locations_by_drive_time(
 
         filtered_nearest_locations.append(
             {
-                "target": target,
+                **location,
                 "nearest_coordinates": filtered_coords,  # This might be empty
             }
         )
@@ -1274,38 +1735,46 @@ def filter_locations_by_drive_time(
     return filtered_nearest_locations
 
 
+def extract_metric_values(
+    features: List[Dict[str, Any]], color_based_on: str
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the `color_based_on` value of every feature as floats, together with
+    a mask of the values that take part in averages (missing values, blank
+    strings, booleans and values that are not numbers are ignored).
+    """
+    values = np.zeros(len(features), dtype=np.float64)
+    usable = np.zeros(len(features), dtype=bool)
+    for i, feature in enumerate(features):
+        value = feature.get("properties", {}).get(color_based_on)
+        if value is None or isinstance(value, bool) or not str(value).strip():
+            continue
+        try:
+            values[i] = float(value)
+        except (TypeError, ValueError):
+            continue
+        usable[i] = True
+    return values, usable
+
+
 def average_metric_of_surrounding_points(
-    color_based_on, point, based_on_dataset, radius
+    point, based_on_index: SpatialGridIndex, metric_values, metric_usable, radius
 ):
+    """
+    Averages the metric of the based-on points within `radius` meters of `point`.
+    Returns None when no based-on point is in range.
+    """
     lat, lon = (
         point["geometry"]["coordinates"][1],
         point["geometry"]["coordinates"][0],
     )
 
-    nearby_metric_value = []
-
-    for point_2 in based_on_dataset["features"]:
-        if color_based_on not in point_2["properties"]:
-            continue
-
-        distance = geodesic(
-            (lat, lon),
-            (
-                point_2["geometry"]["coordinates"][1],
-                point_2["geometry"]["coordinates"][0],
-            ),
-        ).meters
-
-        if distance <= radius:
-            nearby_metric_value.append(point_2["properties"][color_based_on])
-
-    if nearby_metric_value:
-        cleaned_list = [float(x) for x in nearby_metric_value 
-                        if str(x).strip() and not isinstance(x, bool)]
-        return np.mean(cleaned_list)
-    else:
+    nearby = based_on_index.query_radius(lat, lon, radius)
+    if nearby.size == 0:
         return None
 
+    return np.mean(metric_values[nearby][metric_usable[nearby]])
+
 
 def calculate_distance(coord1, coord2):
     """
@@ -1355,45 +1824,34 @@ async def process_color_based_on(
             nearest_locations, req.coverage_value
         )
 
-        # Calculate routes with Google Maps
-        route_results = await calculate_nearest_points_drive_time(
-            filtered_nearest_locations
-        )
-
         # Main function
         within_time_features = []
         outside_time_features = []
         unallocated_features = []
 
-        for target_routes in route_results:
-            min_static_time = float("inf")
-
-            # Get minimum static drive time from routes
-            for route in target_routes.routes:
-                if route.route and route.route[0].static_duration:
-                    static_time = int(route.route[0].static_duration.replace("s", ""))
-                    min_static_time = min(min_static_time, static_time)
-
-            # Find the point with matching coordinates
-            for change_point in change_layer_dataset["features"]:
-                if (
-                    change_point["geometry"]["coordinates"][1]
-                    == target_routes.target["latitude"]
-                    and change_point["geometry"]["coordinates"][0]
-                    == target_routes.target["longitude"]
-                ):
-
-                    feature = assign_point_properties(change_point)
+        # Classify targets as their Route Matrix batches come back. target_index
+        # is the position of the target in the change layer features.
+        feature_categories = ["unallocated"] * len(change_layer_dataset["features"])
+        async for target_item, min_static_time in stream_drive_times(
+            filtered_nearest_locations
+        ):
+            if min_static_time is not None:
+                drive_time_minutes = min_static_time / 60
+                feature_categories[target_item["target_index"]] = (
+                    "within" if drive_time_minutes <= req.coverage_value else "outside"
+                )
 
-                    if min_static_time != float("inf"):
-                        drive_time_minutes = min_static_time / 60
-                        if drive_time_minutes <= req.coverage_value:
-                            within_time_features.append(feature)
-                        else:
-                            outside_time_features.append(feature)
-                    else:
-                        unallocated_features.append(feature)
-                    break
+        # Emit in change layer order so the layers do not depend on API timing
+        for change_point, category in zip(
+            change_layer_dataset["features"], feature_categories
+        ):
+            feature = assign_point_properties(change_point)
+            if category == "within":
+                within_time_features.append(feature)
+            elif category == "outside":
+                outside_time_features.append(feature)
+            else:
+                unallocated_features.append(feature)
 
         # Create the three layers
         new_layers = []
@@ -1525,15 +1983,29 @@ async def process_color_based_on(
         return new_layers
     else:
 
+        # Index the based-on points once instead of scanning them for every change point
+        metric_features = [
+            point
+            for point in based_on_layer_dataset["features"]
+            if req.color_based_on in point["properties"]
+        ]
+        based_on_index = SpatialGridIndex.from_features(
+            metric_features, cell_size_m=max(req.coverage_value, 1.0)
+        )
+        metric_values, metric_usable = extract_metric_values(
+            metric_features, req.color_based_on
+        )
+
         # Calculate influence scores for change_layer_dataset and store them
         influence_scores = []
         point_influence_map = {}
         for change_point in change_layer_dataset["features"]:
             change_point["id"] = str(uuid.uuid4())
             surrounding_metric_avg = average_metric_of_surrounding_points(
-                req.color_based_on,
                 change_point,
-                based_on_layer_dataset,
+                based_on_index,
+                metric_values,
+                metric_usable,
                 req.coverage_value,
             )
             if surrounding_metric_avg is not None:
@@ -0,0 +1,120 @@
+# migrate.py
+# Versioned schema migrations for the schema_marketplace tables.
+#
+# Migrations are the files database_files/migrations/NNNN_<name>.sql, applied
+# once each in version order and recorded in schema_marketplace.schema_migrations.
+# Every migration runs in its own transaction. Workers starting at the same
+# time may both see a migration as pending, so migrations must be idempotent
+# (IF NOT EXISTS). A migration on a table that does not exist yet fails rather
+# than being skipped, so it is not recorded and the next run retries it.
+#
+# Some migrations rewrite whole tables under an ACCESS EXCLUSIVE lock (STORED
+# generated columns), so they are run out of band before a deploy rather than
+# at app startup (see CONF.apply_db_migrations_on_startup); the app then only
+# checks that they were all applied. Run from the repository root:
+#     python -m database_files.migrate
+import asyncio
+import logging
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Set
+
+from sql_object import SqlObject
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+MIGRATION_FILE_PATTERN = re.compile(r"^(\d{4})_(\w+)\.sql$")
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    sql: str
+
+
+def load_migrations(directory: Path = MIGRATIONS_DIR) -> List[Migration]:
+    """
+    Reads the migrations of `directory`, sorted by version.
+    """
+    migrations = {}
+    for path in directory.glob("*.sql"):
+        match = MIGRATION_FILE_PATTERN.match(path.name)
+        if match is None:
+            raise ValueError(f"Migration file name not NNNN_<name>.sql: {path.name}")
+        version = int(match.group(1))
+        if version in migrations:
+            raise ValueError(f"Duplicate migration version {version}: {path.name}")
+        migrations[version] = Migration(version, match.group(2), path.read_text())
+    return [migrations[version] for version in sorted(migrations)]
+
+
+async def load_applied_versions() -> Set[int]:
+    from backend_common.database import Database
+
+    await Database.execute(SqlObject.create_schema_migrations_table)
+    rows = await Database.fetch(SqlObject.load_schema_migration_versions)
+    return {row["version"] for row in rows}
+
+
+async def check_migrations(directory: Path = MIGRATIONS_DIR):
+    """
+    Raises if any migration of `directory` is not recorded in the database,
+    e.g. because migrate was not run before the deploy or one of them failed.
+    """
+    applied_versions = await load_applied_versions()
+    pending = [
+        f"{migration.version:04d}_{migration.name}"
+        for migration in load_migrations(directory)
+        if migration.version not in applied_versions
+    ]
+    if pending:
+        raise RuntimeError(
+            f"Database migrations not applied: {', '.join(pending)}. "
+            "Run python -m database_files.migrate"
+        )
+
+
+async def apply_migrations(directory: Path = MIGRATIONS_DIR) -> List[int]:
+    """
+    Applies the migrations of `directory` not yet recorded in the database.
+    Returns the versions applied.
+    """
+    # Imported here so that reading the migrations needs no database setup
+    from backend_common.database import Database
+
+    applied_versions = await load_applied_versions()
+    applied = []
+    for migration in load_migrations(directory):
+        if migration.version in applied_versions:
+            continue
+        logger.info(f"Applying migration {migration.version:04d}_{migration.name}")
+        await Database.execute(
+            SqlObject.apply_schema_migration.format(
+                migration_sql=migration.sql,
+                version=migration.version,
+                name=migration.name,
+            )
+        )
+        applied.append(migration.version)
+    return applied
+
+
+async def main():
+    from backend_common.database import Database
+
+    await Database.create_pool()
+    try:
+        applied = await apply_migrations()
+        print(f"Applied migrations: {applied or 'none pending'}")
+    finally:
+        await Database.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
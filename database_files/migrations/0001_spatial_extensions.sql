@@ -0,0 +1,5 @@
+-- PostGIS for the point geometry columns and their indexes, pg_trgm for
+-- substring matching on text columns
+CREATE SCHEMA IF NOT EXISTS "schema_marketplace";
+CREATE EXTENSION IF NOT EXISTS postgis;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
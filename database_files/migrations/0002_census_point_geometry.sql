@@ -0,0 +1,13 @@
+-- Census rows are loaded city by city and never updated, so rows close on
+-- the map are close on disk and a BRIN index over the point is a fraction of
+-- the size of a GiST index for the same bounding box scans.
+-- The table must exist: a missing table fails the migration, which is then
+-- not recorded and is retried by the next run.
+ALTER TABLE "schema_marketplace".census
+    ADD COLUMN IF NOT EXISTS geom geometry(Point, 4326)
+    GENERATED ALWAYS AS (
+        ST_SetSRID(ST_MakePoint(longitude::float8, latitude::float8), 4326)
+    ) STORED;
+CREATE INDEX IF NOT EXISTS census_geom_brin
+    ON "schema_marketplace".census USING brin (geom)
+    WITH (pages_per_range = 32);
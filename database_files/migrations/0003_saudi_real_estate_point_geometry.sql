@@ -0,0 +1,9 @@
+-- The table must exist: a missing table fails the migration, which is then
+-- not recorded and is retried by the next run.
+ALTER TABLE "schema_marketplace".saudi_real_estate
+    ADD COLUMN IF NOT EXISTS geom geometry(Point, 4326)
+    GENERATED ALWAYS AS (
+        ST_SetSRID(ST_MakePoint(longitude::float8, latitude::float8), 4326)
+    ) STORED;
+CREATE INDEX IF NOT EXISTS saudi_real_estate_geom_gist
+    ON "schema_marketplace".saudi_real_estate USING gist (geom);
@@ -0,0 +1,14 @@
+-- The trigram index serves the lower(property_type) LIKE '%...%' filter of
+-- canada_commercial_w_bounding_box_and_property_type, which a B-tree cannot.
+-- The table must exist: a missing table fails the migration, which is then
+-- not recorded and is retried by the next run.
+ALTER TABLE "schema_marketplace".canada_commercial_properties
+    ADD COLUMN IF NOT EXISTS geom geometry(Point, 4326)
+    GENERATED ALWAYS AS (
+        ST_SetSRID(ST_MakePoint(longitude::float8, latitude::float8), 4326)
+    ) STORED;
+CREATE INDEX IF NOT EXISTS canada_commercial_properties_geom_gist
+    ON "schema_marketplace".canada_commercial_properties USING gist (geom);
+CREATE INDEX IF NOT EXISTS canada_commercial_properties_property_type_trgm
+    ON "schema_marketplace".canada_commercial_properties
+    USING gin (lower(property_type) gin_trgm_ops);
@@ -0,0 +1,24 @@
+-- Deferred work run by job_queue.JobQueue workers. At most one pending job
+-- per (kind, dedupe_key); workers claim jobs with FOR UPDATE SKIP LOCKED.
+CREATE TABLE IF NOT EXISTS "schema_marketplace".jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    dedupe_key TEXT,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+    enqueued_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    last_error TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_pending_dedupe
+    ON "schema_marketplace".jobs (kind, dedupe_key) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS jobs_pending_run_after
+    ON "schema_marketplace".jobs (run_after, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS jobs_running_started_at
+    ON "schema_marketplace".jobs (started_at) WHERE status = 'running';
+CREATE INDEX IF NOT EXISTS jobs_finished_at
+    ON "schema_marketplace".jobs (finished_at);
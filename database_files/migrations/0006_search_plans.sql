@@ -0,0 +1,20 @@
+-- Search plans of "full data" requests, see plan_store.PlanStore. Each circle
+-- of a plan is a row; circle_index is its 1 based position in the plan.
+CREATE TABLE IF NOT EXISTS "schema_marketplace".search_plans (
+    plan_name TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS "schema_marketplace".search_plan_circles (
+    plan_name TEXT NOT NULL
+        REFERENCES "schema_marketplace".search_plans (plan_name) ON DELETE CASCADE,
+    circle_index INTEGER NOT NULL,
+    circle_number TEXT NOT NULL,
+    parent_number TEXT,
+    is_center BOOLEAN NOT NULL,
+    center_lng DOUBLE PRECISION NOT NULL,
+    center_lat DOUBLE PRECISION NOT NULL,
+    radius DOUBLE PRECISION NOT NULL,
+    skip BOOLEAN NOT NULL DEFAULT false,
+    PRIMARY KEY (plan_name, circle_index)
+);
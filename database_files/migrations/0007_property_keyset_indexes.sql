@@ -0,0 +1,11 @@
+-- B-tree indexes in the keyset order of the property queries
+-- (saudi_real_estate_w_bounding_box_and_category and friends), which page
+-- with ORDER BY latitude, longitude, ctid after the last row's key. The
+-- planner can walk these from the key instead of sorting every bounding box
+-- match per page; ctid only breaks ties between rows at the same coordinates.
+-- The tables must exist: a missing table fails the migration, which is then
+-- not recorded and is retried by the next run.
+CREATE INDEX IF NOT EXISTS saudi_real_estate_latitude_longitude
+    ON "schema_marketplace".saudi_real_estate (latitude, longitude);
+CREATE INDEX IF NOT EXISTS canada_commercial_properties_latitude_longitude
+    ON "schema_marketplace".canada_commercial_properties (latitude, longitude);
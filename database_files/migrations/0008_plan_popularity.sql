@@ -0,0 +1,7 @@
+-- Incremental popularity scoring state of each search plan, see
+-- popularity_algo.process_plan_popularity.
+CREATE TABLE IF NOT EXISTS "schema_marketplace".plan_popularity (
+    plan_name TEXT PRIMARY KEY,
+    state JSONB NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,91 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from config_factory import CONF
+
+# Stored datasets older than this are deleted on read
+DATASET_EXPIRY = timedelta(days=90)
+
+
+class DatasetCache:
+    """
+    LRU cache of serialized datasets rows, keyed by filename and bounded by the
+    total size of the cached JSON.
+
+    Entries hold the response_data JSON as returned by Postgres together with
+    its created_at. Every hit is decoded again by the caller: callers mutate the
+    datasets they load, and orjson.loads of the text is cheaper than deep
+    copying a decoded dataset. Entries live at most `ttl_seconds` so that writes
+    made by other worker processes become visible, and never past the dataset
+    expiry.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[str, datetime, float]]" = OrderedDict()
+        self.total_bytes = 0
+        # Bumped on every invalidation; fills that started earlier are dropped
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, filename: str) -> Optional[Tuple[str, datetime]]:
+        entry = self._entries.get(filename)
+        if entry is not None:
+            response_data, created_at, cached_at = entry
+            if (
+                time.monotonic() - cached_at <= self.ttl_seconds
+                and created_at >= datetime.now(timezone.utc) - DATASET_EXPIRY
+            ):
+                self._entries.move_to_end(filename)
+                self.hits += 1
+                return response_data, created_at
+            self._remove(filename)
+        self.misses += 1
+        return None
+
+    def put(self, filename: str, response_data: str, created_at: datetime, generation: int):
+        """
+        Caches a row read from the database. `generation` is the cache
+        generation from before the read, so a row read before a concurrent
+        invalidation is not cached.
+        """
+        size = len(response_data)
+        if generation != self.generation or size > self.max_bytes:
+            return
+        self._remove(filename)
+        self._entries[filename] = (response_data, created_at, time.monotonic())
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            evicted, _ = next(iter(self._entries.items()))
+            self._remove(evicted)
+            self.evictions += 1
+
+    def invalidate(self, filename: str):
+        self.generation += 1
+        self.invalidations += 1
+        self._remove(filename)
+
+    def _remove(self, filename: str):
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[0])
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+DATASET_CACHE = DatasetCache(CONF.dataset_cache_max_bytes, CONF.dataset_cache_ttl_seconds)
@@ -19,7 +19,8 @@ import json
 from backend_common.background import set_background_tasks
 from fastapi.middleware.cors import CORSMiddleware
 from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
+import orjson
 from pydantic import BaseModel
 from pydantic import ValidationError
 import asyncio
@@ -40,7 +41,7 @@ from backend_common.dtypes.auth_dtypes import (
 from all_types.myapi_dtypes import (
     ReqModel,
     ReqFetchDataset,
-    ReqPrdcerLyrMapData,
+    ReqLyrMapData,
     # ReqNearestRoute,
     ReqCostEstimate,
     ReqSavePrdcerCtlg,
@@ -49,6 +50,8 @@ from all_types.myapi_dtypes import (
     ReqStreeViewCheck,
     ReqSavePrdcerLyer,
     ReqFetchCtlgLyrs,
+    ReqStreamCtlgLyrs,
+    ReqStreamLyrMapData,
     ReqCityCountry,
     ReqDeletePrdcerLayer
 )
@@ -75,6 +78,7 @@ from all_types.response_dtypes import (
     ResGradientColorBasedOnZone,
     ResGetPaymentMethods,
     ResLyrMapData,
+    ResLyrMapDataHead,
     card_metadata,
     CityData,
     NearestPointRouteResponse,
@@ -93,10 +97,15 @@ from data_fetcher import (
     delete_layer,
     aquire_user_lyrs,
     fetch_lyr_map_data,
+    fetch_lyr_map_data_trusted,
+    stream_lyr_map_data,
+    fetch_lyr_tile,
     save_prdcer_ctlg,
     delete_prdcer_ctlg,
     fetch_prdcer_ctlgs,
     fetch_ctlg_lyrs,
+    fetch_ctlg_lyrs_trusted,
+    stream_ctlg_lyrs,
     poi_categories,
     save_draft_catalog,
     fetch_gradient_colors,
@@ -104,8 +113,10 @@ from data_fetcher import (
     get_user_profile,
     # fetch_nearest_points_Gmap,
     fetch_dataset,
+    fetch_dataset_db_assembled,
     load_area_intelligence_categories,
-    update_profile
+    update_profile,
+    fetch_service_metrics,
     
 )
 from backend_common.dtypes.stripe_dtypes import (
@@ -124,6 +135,10 @@ from backend_common.dtypes.stripe_dtypes import (
     DeductWalletReq
 )
 from backend_common.database import Database
+from database_files.migrate import apply_migrations, check_migrations
+from job_queue import JobQueue
+from http_client import HttpClient
+from geojson_builder import features_envelope_json
 from backend_common.logging_wrapper import log_and_validate
 from backend_common.stripe_backend import (
     create_stripe_product,
@@ -233,12 +248,21 @@ async def background_tasks_middleware(request, call_next):
 @app.on_event("startup")
 async def startup_event():
     await Database.create_pool()
+    if CONF.apply_db_migrations_on_startup:
+        await apply_migrations()
+    else:
+        # Queries rely on the migrated schema, refuse to start without it
+        await check_migrations()
+    await HttpClient.create_session()
+    await JobQueue.start_workers()
     await db.initialize_all()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await JobQueue.stop_workers()
     await Database.close_pool()
+    await HttpClient.close_session()
     # Run cleanup in a thread to not block
     await asyncio.get_event_loop().run_in_executor(None, db.cleanup)
     # Wait a moment to ensure threads are cleaned up
@@ -325,6 +349,12 @@ async def ep_load_area_intelligence_categories(
     dependencies=[Depends(JWTBearer())],
 )
 async def fetch_dataset_ep(req: ReqModel[ReqFetchDataset], request: Request):
+    if CONF.db_geojson_assembly:
+        assembled = await fetch_dataset_db_assembled(
+            ReqFetchDataset.model_validate(req.request_body)
+        )
+        if assembled is not None:
+            return raw_features_response(*assembled)
     response = await request_handling(
         req.request_body,
         ReqFetchDataset,
@@ -370,11 +400,52 @@ async def user_layers(req: ReqModel[ReqUserId]):
     return response
 
 
+def trusted_map_data_response(
+    heads: Union[ResLyrMapDataHead, list[ResLyrMapDataHead]], features: list
+) -> Response:
+    """
+    ResModel response for map data read from our own datasets table. The
+    envelope and the layer heads are validated, the features are written
+    with orjson as stored instead of going through the Feature model: extra
+    top-level feature keys are kept and coordinates are not coerced to float.
+    `heads` is one layer with its features, or a list of layers with one
+    features list each.
+    """
+    if isinstance(heads, list):
+        envelope = ResModel[list[ResLyrMapDataHead]](
+            message="Request received", request_id=str(uuid.uuid4()), data=heads
+        ).model_dump()
+        for layer, layer_features in zip(envelope["data"], features):
+            layer["features"] = layer_features
+    else:
+        envelope = ResModel[ResLyrMapDataHead](
+            message="Request received", request_id=str(uuid.uuid4()), data=heads
+        ).model_dump()
+        envelope["data"]["features"] = features
+    return Response(orjson.dumps(envelope), media_type="application/json")
+
+
+def raw_features_response(head: BaseModel, features_json: str) -> Response:
+    """
+    ResModel response whose data is `head` plus a "features" array given as
+    JSON text, which is spliced in as is, without Feature validation.
+    """
+    body = features_envelope_json(
+        "Request received", str(uuid.uuid4()), head.model_dump(), features_json
+    )
+    return Response(body, media_type="application/json")
+
+
 @app.post(CONF.prdcer_lyr_map_data, response_model=ResModel[ResLyrMapData])
-async def prdcer_lyr_map_data(req: ReqModel[ReqPrdcerLyrMapData]):
+async def prdcer_lyr_map_data(req: ReqModel[ReqLyrMapData]):
+    if CONF.trusted_map_data_responses:
+        head, features = await fetch_lyr_map_data_trusted(
+            ReqLyrMapData.model_validate(req.request_body)
+        )
+        return trusted_map_data_response(head, features)
     response = await request_handling(
         req.request_body,
-        ReqPrdcerLyrMapData,
+        ReqLyrMapData,
         ResModel[ResLyrMapData],
         fetch_lyr_map_data,
         wrap_output=True,
@@ -382,6 +453,21 @@ async def prdcer_lyr_map_data(req: ReqModel[ReqPrdcerLyrMapData]):
     return response
 
 
+@app.get(CONF.lyr_tile)
+async def lyr_tile(prdcer_lyr_id: str, z: int, x: int, y: int):
+    tile = await fetch_lyr_tile(prdcer_lyr_id, z, x, y)
+    return Response(tile, media_type="application/vnd.mapbox-vector-tile")
+
+
+@app.post(CONF.prdcer_lyr_map_data_stream)
+async def prdcer_lyr_map_data_stream(req: ReqModel[ReqStreamLyrMapData]):
+    body = ReqStreamLyrMapData.model_validate(req.request_body)
+    chunks = await stream_lyr_map_data(body)
+    if body.stream_format == "geojson":
+        return StreamingResponse(chunks, media_type="application/geo+json")
+    return StreamingResponse(chunks, media_type="application/x-ndjson")
+
+
 # @app.post(
 #     CONF.nearest_lyr_map_data,
 #     description="Get Nearest Point",
@@ -457,6 +543,13 @@ async def user_catalogs(req: ReqModel[ReqUserId]):
 
 @app.post(CONF.fetch_ctlg_lyrs, response_model=ResModel[list[ResLyrMapData]])
 async def fetch_catalog_layers(req: ReqModel[ReqFetchCtlgLyrs]):
+    if CONF.trusted_map_data_responses:
+        layers = await fetch_ctlg_lyrs_trusted(
+            ReqFetchCtlgLyrs.model_validate(req.request_body)
+        )
+        return trusted_map_data_response(
+            [head for head, _ in layers], [features for _, features in layers]
+        )
     response = await request_handling(
         req.request_body,
         ReqFetchCtlgLyrs,
@@ -467,6 +560,13 @@ async def fetch_catalog_layers(req: ReqModel[ReqFetchCtlgLyrs]):
     return response
 
 
+@app.post(CONF.fetch_ctlg_lyrs_stream)
+async def fetch_catalog_layers_stream(req: ReqModel[ReqStreamCtlgLyrs]):
+    # NDJSON, one line per layer as soon as it is loaded, or per feature
+    lines = await stream_ctlg_lyrs(ReqStreamCtlgLyrs.model_validate(req.request_body))
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
 # Authentication
 @app.post(CONF.login, response_model=ResModel[dict[str, Any]], tags=["Authentication"])
 async def login(req: ReqModel[ReqUserLogin]):
@@ -649,6 +749,14 @@ async def ep_fetch_gradient_colors():
     return response
 
 
+@app.get(CONF.service_metrics, response_model=ResModel[dict[str, Any]])
+async def ep_service_metrics():
+    response = await request_handling(
+        None, None, ResModel[dict[str, Any]], fetch_service_metrics, wrap_output=True
+    )
+    return response
+
+
 @app.post(
     CONF.gradient_color_based_on_zone,
     response_model=ResModel[list[ResGradientColorBasedOnZone]],
@@ -1,5 +1,9 @@
 import math
 
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8  # mean Earth radius in meters
+
 
 def get_point_at_distance(start_point: tuple, bearing: float, distance: float):
     """
@@ -19,4 +23,62 @@ def get_point_at_distance(start_point: tuple, bearing: float, distance: float):
         math.cos(distance / R) - math.sin(lat1) * math.sin(lat2),
     )
 
-    return (math.degrees(lon2), math.degrees(lat2))
\ No newline at end of file
+    return (math.degrees(lon2), math.degrees(lat2))
+
+
+def haversine_distance_m(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """
+    Vectorized haversine distance in meters between points given in degrees.
+    Scalars and numpy arrays are broadcast against each other.
+    """
+    lat1, lng1, lat2, lng2 = (
+        np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lng1, lat2, lng2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def to_unit_sphere(lat, lng) -> np.ndarray:
+    """
+    Convert latitude/longitude in degrees to (N, 3) cartesian coordinates on the unit sphere.
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack((cos_lat * np.cos(lng), cos_lat * np.sin(lng), np.sin(lat)), axis=-1)
+
+
+def chord_length(distance_m: float) -> float:
+    """
+    Straight-line length on the unit sphere of a great-circle arc of the given length in meters.
+    """
+    return 2 * math.sin(min(distance_m / (2 * EARTH_RADIUS_M), math.pi / 2))
+
+
+# Latitude limit of the square Web Mercator world used by map tiles
+MERCATOR_MAX_LAT = 85.0511287798066
+
+
+def to_web_mercator_unit(lat, lng) -> np.ndarray:
+    """
+    Convert latitude/longitude in degrees to (N, 2) Web Mercator coordinates scaled
+    to the unit square, x growing east and y growing south as in tile coordinates.
+    """
+    lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT))
+    lng = np.asarray(lng, dtype=np.float64)
+    x = (lng + 180.0) / 360.0
+    y = 0.5 - np.log(np.tan(np.pi / 4 + lat / 2)) / (2 * np.pi)
+    return np.stack((x, y), axis=-1)
+
+
+def from_web_mercator_unit(x, y) -> np.ndarray:
+    """
+    Inverse of to_web_mercator_unit: (N, 2) latitude/longitude in degrees.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y))))
+    return np.stack((lat, x * 360.0 - 180.0), axis=-1)
@@ -0,0 +1,107 @@
+from itertools import repeat
+from typing import Any, Dict, List, Mapping, Sequence
+
+import numpy as np
+import orjson
+
+# Columns that describe the point's location rather than the place itself
+NON_PROPERTY_COLUMNS = ("latitude", "longitude", "city", "country")
+
+
+def _column_values(column: Any) -> list:
+    # Arrow arrays, NumPy arrays (to native Python scalars) and plain sequences
+    if hasattr(column, "to_pylist"):
+        return column.to_pylist()
+    if hasattr(column, "tolist"):
+        return column.tolist()
+    return list(column)
+
+
+def columns_to_features(
+    columns: Mapping[str, Any],
+    drop_nulls: bool = False,
+    excluded_columns: Sequence[str] = (),
+) -> List[Dict]:
+    """
+    Builds GeoJSON Point features from columns of equal length, e.g. NumPy or
+    Arrow arrays keyed by column name. "longitude" and "latitude" give the
+    geometry, every column but NON_PROPERTY_COLUMNS and `excluded_columns`
+    becomes a property.
+    Rows without valid coordinates are skipped; with drop_nulls, null and NaN
+    properties are left out of each feature.
+    """
+    if "longitude" not in columns or "latitude" not in columns:
+        return []
+    lngs = np.asarray(_column_values(columns["longitude"]), dtype=np.float64)
+    lats = np.asarray(_column_values(columns["latitude"]), dtype=np.float64)
+    valid = (np.isfinite(lngs) & np.isfinite(lats)).tolist()
+
+    property_names = [
+        name
+        for name in columns
+        if name not in NON_PROPERTY_COLUMNS and name not in excluded_columns
+    ]
+    if property_names:
+        property_rows = zip(*(_column_values(columns[name]) for name in property_names))
+    else:
+        property_rows = repeat(())
+
+    features = []
+    for lng, lat, is_valid, values in zip(lngs.tolist(), lats.tolist(), valid, property_rows):
+        if not is_valid:
+            continue
+        if drop_nulls:
+            # value == value is False for NaN
+            properties = {
+                name: value
+                for name, value in zip(property_names, values)
+                if value is not None and value == value
+            }
+        else:
+            properties = dict(zip(property_names, values))
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [lng, lat]},
+                "properties": properties,
+            }
+        )
+    return features
+
+
+def records_to_features(
+    records: Sequence[Mapping],
+    drop_nulls: bool = False,
+    excluded_columns: Sequence[str] = (),
+) -> List[Dict]:
+    """
+    columns_to_features for rows such as asyncpg Records: the rows are
+    transposed into columns once, without building a dict or Series per row.
+    """
+    if not records:
+        return []
+    names = list(records[0].keys())
+    columns = dict(zip(names, zip(*(record.values() for record in records))))
+    return columns_to_features(columns, drop_nulls, excluded_columns)
+
+
+def features_envelope_json(
+    message: str, request_id: str, head: Mapping, features_json: str
+) -> bytes:
+    """
+    JSON of a ResModel envelope whose data is `head` plus a "features" array
+    given as JSON text, which is spliced in as is:
+    {"message":..,"request_id":..,"data":{<head>,"features":<features_json>}}
+    """
+    head_json = orjson.dumps(dict(head))
+    return (
+        b'{"message":'
+        + orjson.dumps(message)
+        + b',"request_id":'
+        + orjson.dumps(request_id)
+        + b',"data":'
+        + head_json[:-1]
+        + (b',"features":' if head else b'"features":')
+        + features_json.encode()
+        + b"}}"
+    )
@@ -1,22 +1,34 @@
 import aiohttp
 import logging
-from typing import List, Dict, Any, Tuple, Optional
+from datetime import timedelta
+from typing import List, Dict, Any, Tuple, Optional, Callable, Awaitable
 import json
 import asyncio
+import random
+import time
+import uuid
+from functools import partial
 from fastapi import HTTPException
-import requests
 from all_types.myapi_dtypes import ReqStreeViewCheck, ReqFetchDataset
 from backend_common.utils.utils import convert_strings_to_ints
 from config_factory import CONF
 from backend_common.logging_wrapper import apply_decorator_to_module
-from all_types.response_dtypes import (
-    LegInfo,
-    TrafficCondition,
-    RouteInfo,
-)
 from boolean_query_processor import optimize_query_sequence
+from http_client import HttpClient
+from quota_manager import acquire_quota
+from single_flight import SingleFlight
 from mapbox_connector import MapBoxConnector
-from storage import load_dataset, make_dataset_filename, make_dataset_filename_part, store_data_resp
+from storage import (
+    load_dataset,
+    make_dataset_filename,
+    make_dataset_filename_part,
+    store_data_resp,
+    make_route_cache_key,
+    load_cached_routes,
+    store_cached_routes,
+    acquire_dataset_fetch_lock,
+    release_dataset_fetch_lock,
+)
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(name)s - %(levelname)s - %(funcName)s - %(message)s",
@@ -35,6 +47,64 @@ POPULARITY_DATA = {}
 for category in raw_popularity_data.values():
     POPULARITY_DATA.update(category)
 
+ROUTES_RETRY_STATUSES = {429, 500, 502, 503, 504}
+ROUTES_RETRY_BASE_DELAY = 0.5  # seconds, doubled on every retry
+
+_routes_semaphore = asyncio.Semaphore(CONF.routes_api_concurrency)
+# Concurrent identical fetches share one call: datasets by filename, route
+# matrices by their waypoints
+DATASET_FLIGHTS = SingleFlight()
+ROUTE_FLIGHTS = SingleFlight()
+# Identifies this process when holding cross-worker dataset fetch leases
+_WORKER_ID = str(uuid.uuid4())
+# Prefetched text search pages: page token -> (expiry on the monotonic clock, task)
+_text_search_prefetch: Dict[str, Tuple[float, asyncio.Task]] = {}
+
+
+async def fetch_dataset_once(dataset_id: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Runs `fetch` for a dataset filename at most once at a time. Concurrent
+    callers in this process share the in-flight call. With
+    CONF.dataset_fetch_lock_enabled, workers also take a lease on the filename;
+    a worker that finds it taken waits for the stored dataset instead of
+    fetching it again.
+    """
+
+    async def fetch_with_lease():
+        if not CONF.dataset_fetch_lock_enabled:
+            return await fetch()
+        while True:
+            if await acquire_dataset_fetch_lock(
+                dataset_id, _WORKER_ID, CONF.dataset_fetch_lock_lease_seconds
+            ):
+                try:
+                    # Another worker may have stored it just before we got the lease
+                    stored_data = await load_dataset(dataset_id)
+                    return stored_data if stored_data else await fetch()
+                finally:
+                    await release_dataset_fetch_lock(dataset_id, _WORKER_ID)
+            await asyncio.sleep(CONF.dataset_fetch_lock_poll_seconds)
+            stored_data = await load_dataset(dataset_id)
+            if stored_data:
+                return stored_data
+
+    return await DATASET_FLIGHTS.do(dataset_id, fetch_with_lease)
+
+
+async def fetch_dataset_part(
+    req: ReqFetchDataset, dataset_id: str, included_types: List[str], excluded_types: List[str]
+) -> Optional[Dict]:
+    """
+    Runs one optimized sub-query against Google and stores its dataset.
+    """
+    query_results = await execute_single_query(req, included_types, excluded_types)
+    if not query_results:
+        return None
+    dataset = await MapBoxConnector.new_ggl_to_boxmap(query_results, req.radius)
+    dataset = convert_strings_to_ints(dataset)
+    await store_data_resp(req, dataset, dataset_id)
+    return dataset
+
 
 async def fetch_from_google_maps_api(req: ReqFetchDataset) -> Tuple[List[Dict[str, Any]], str]:
     try:
@@ -45,78 +115,87 @@ async def fetch_from_google_maps_api(req: ReqFetchDataset) -> Tuple[List[Dict[st
         if existing_combined_data:
             logger.info(f"Returning existing combined dataset: {combined_dataset_id}")
             return existing_combined_data
-        optimized_queries = optimize_query_sequence(req.boolean_query, POPULARITY_DATA)
+        return await fetch_dataset_once(
+            combined_dataset_id, partial(fetch_combined_dataset, req, combined_dataset_id)
+        )
 
-        datasets = {}
-        missing_queries = []
-        
+    except Exception as e:
+        logger.error(f"Error in fetch_from_google_maps_api: {str(e)}")
+        return str(e)
 
-        for included_types, excluded_types in optimized_queries:
-            full_dataset_id = make_dataset_filename_part(req, included_types, excluded_types)
-            stored_data = await load_dataset(full_dataset_id)
 
-            if stored_data:
-                datasets[full_dataset_id] = stored_data
-            else:
-                missing_queries.append((full_dataset_id, included_types, excluded_types))
-
-        if missing_queries:
-            logger.info(f"Fetching {len(missing_queries)} queries from Google Maps API.")
-            query_tasks = [
-                execute_single_query(req, included_types, excluded_types)
-                for _, included_types, excluded_types in missing_queries
-            ]
-
-            all_query_results = await asyncio.gather(*query_tasks)
-
-            for (dataset_id, included, excluded), query_results in zip(missing_queries, all_query_results):
-                    
-                if query_results:  
-                    dataset = await MapBoxConnector.new_ggl_to_boxmap(query_results,req.radius)
-                    dataset = convert_strings_to_ints(dataset)
-                    await store_data_resp(req, dataset, dataset_id)
-                    datasets[dataset_id] = dataset
-
-        # Initialize the combined dictionary
-        combined = {
-            'type': 'FeatureCollection',
-            'features': [],
-            'properties': set()
-        }
-
-        # Initialize a set to keep track of unique IDs
-        seen_ids = set()
-
-        # Iterate through each dataset
-        for dataset in datasets.values():
-            # Add properties to the combined set
-            combined['properties'].update(dataset.get('properties', []))
-            features = dataset.get('features', [])
-            
-            # Iterate through each feature in the dataset
-            for feature in features:
-                feature_id = feature.get('properties', {}).get('id')
-                if feature_id is not None and feature_id not in seen_ids:
-                    combined['features'].append(feature)
-                    seen_ids.add(feature_id)
-
-        # Convert the properties set back to a list (if needed)
-        combined['properties'] = list(combined['properties'])
-
-        if combined:
-            await store_data_resp(req, combined, combined_dataset_id)
-            for feature in combined['features']:
-                if 'properties' in feature and 'id' in feature['properties']:
-                    del feature['properties']['id']
-            logger.info(f"Stored combined dataset: {combined_dataset_id}")
-            return combined
+async def fetch_combined_dataset(req: ReqFetchDataset, combined_dataset_id: str) -> Dict:
+    """
+    Builds the dataset of a boolean query from its optimized sub-queries,
+    reusing stored sub-query datasets, and stores the combined result.
+    """
+    optimized_queries = optimize_query_sequence(req.boolean_query, POPULARITY_DATA)
+
+    datasets = {}
+    missing_queries = []
+    
+
+    for included_types, excluded_types in optimized_queries:
+        full_dataset_id = make_dataset_filename_part(req, included_types, excluded_types)
+        stored_data = await load_dataset(full_dataset_id)
+
+        if stored_data:
+            datasets[full_dataset_id] = stored_data
         else:
-            logger.warning("No valid results returned from Google Maps API or DB.")
-            return combined
+            missing_queries.append((full_dataset_id, included_types, excluded_types))
+
+    if missing_queries:
+        logger.info(f"Fetching {len(missing_queries)} queries from Google Maps API.")
+        query_tasks = [
+            fetch_dataset_once(
+                dataset_id,
+                partial(fetch_dataset_part, req, dataset_id, included_types, excluded_types),
+            )
+            for dataset_id, included_types, excluded_types in missing_queries
+        ]
 
-    except Exception as e:
-        logger.error(f"Error in fetch_from_google_maps_api: {str(e)}")
-        return str(e)
+        all_query_results = await asyncio.gather(*query_tasks)
+
+        for (dataset_id, _, _), dataset in zip(missing_queries, all_query_results):
+            if dataset:
+                datasets[dataset_id] = dataset
+
+    # Initialize the combined dictionary
+    combined = {
+        'type': 'FeatureCollection',
+        'features': [],
+        'properties': set()
+    }
+
+    # Initialize a set to keep track of unique IDs
+    seen_ids = set()
+
+    # Iterate through each dataset
+    for dataset in datasets.values():
+        # Add properties to the combined set
+        combined['properties'].update(dataset.get('properties', []))
+        features = dataset.get('features', [])
+        
+        # Iterate through each feature in the dataset
+        for feature in features:
+            feature_id = feature.get('properties', {}).get('id')
+            if feature_id is not None and feature_id not in seen_ids:
+                combined['features'].append(feature)
+                seen_ids.add(feature_id)
+
+    # Convert the properties set back to a list (if needed)
+    combined['properties'] = list(combined['properties'])
+
+    if combined:
+        await store_data_resp(req, combined, combined_dataset_id)
+        for feature in combined['features']:
+            if 'properties' in feature and 'id' in feature['properties']:
+                del feature['properties']['id']
+        logger.info(f"Stored combined dataset: {combined_dataset_id}")
+        return combined
+    else:
+        logger.warning("No valid results returned from Google Maps API or DB.")
+        return combined
 
 
 async def execute_single_query(
@@ -143,22 +222,23 @@ async def execute_single_query(
     }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            logger.debug(
-                f"Executing query - Include: {included_types}, Exclude: {excluded_types}"
-            )
-            async with session.post(
-                CONF.nearby_search, headers=headers, json=data
-            ) as response:
-                if response.status == 200:
-                    response_data = await response.json()
-                    results = response_data.get("places", [])
-                    logger.debug(f"Query returned {len(results)} results")
-                    return results
-                else:
-                    error_msg = await response.text()
-                    logger.error(f"API request failed: {error_msg}")
-                    return []
+        await acquire_quota("places_nearby", location_data.user_id)
+        session = await HttpClient.get_session()
+        logger.debug(
+            f"Executing query - Include: {included_types}, Exclude: {excluded_types}"
+        )
+        async with session.post(
+            CONF.nearby_search, headers=headers, json=data
+        ) as response:
+            if response.status == 200:
+                response_data = await response.json()
+                results = response_data.get("places", [])
+                logger.debug(f"Query returned {len(results)} results")
+                return results
+            else:
+                error_msg = await response.text()
+                logger.error(f"API request failed: {error_msg}")
+                return []
 
     except aiohttp.ClientError as e:
         # TODO this doesn't reraise the error, not sure what to do about it
@@ -169,12 +249,57 @@ async def execute_single_query(
 
 
 
-async def text_fetch_from_google_maps_api(req: ReqFetchDataset) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+async def request_text_search(
+    data: dict, user_id: str = ""
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
     headers = {
         "Content-Type": "application/json",
         "X-Goog-Api-Key": CONF.api_key,
         "X-Goog-FieldMask": CONF.google_fields+",nextPageToken",
     }
+    await acquire_quota("text_search", user_id)
+    session = await HttpClient.get_session()
+    async with session.post(CONF.search_text, headers=headers, json=data) as response:
+        if response.status == 200:
+            response_data = await response.json()
+            results = response_data.get("places", [])
+            next_page_token = response_data.get("nextPageToken", "")
+            return results, next_page_token
+        else:
+            logger.error(f"Text search failed: {response.status} {await response.text()}")
+            return [], None
+
+
+def prefetch_text_search_page(data: dict, page_token: str, user_id: str = ""):
+    """
+    Starts fetching the page behind `page_token` in the background and parks the
+    task for CONF.text_search_prefetch_ttl_seconds.
+    """
+    now = time.monotonic()
+    for token, (expires_at, task) in list(_text_search_prefetch.items()):
+        if expires_at <= now:
+            task.cancel()
+            del _text_search_prefetch[token]
+
+    if page_token in _text_search_prefetch:
+        return
+    task = asyncio.create_task(
+        request_text_search({**data, "pageToken": page_token}, user_id)
+    )
+    # A failed prefetch is retried by the caller; don't log it as unretrieved
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    _text_search_prefetch[page_token] = (now + CONF.text_search_prefetch_ttl_seconds, task)
+
+
+async def text_fetch_from_google_maps_api(
+    req: ReqFetchDataset, prefetch_next_page: bool = False
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Runs a Places text search for one page. A page that was prefetched under
+    `req.page_token` is served from the prefetch cache. With
+    `prefetch_next_page`, the following page is requested in the background so
+    that a call with the returned token does not wait on Google.
+    """
     data = {
         "textQuery": req.text_search,
         "includePureServiceAreaBusinesses": False,
@@ -186,103 +311,180 @@ async def text_fetch_from_google_maps_api(req: ReqFetchDataset) -> Tuple[List[Di
             }
         },
     }
-    response = requests.post(CONF.search_text, headers=headers, json=data)
-    if response.status_code == 200:
-        response_data = response.json()
-        results = response_data.get("places", [])
-        next_page_token = response_data.get("nextPageToken", "")
-        return results, next_page_token
-    else:
-        print("Error:", response.status_code, response.text)
-        return [], None
+
+    results, next_page_token = None, None
+    expires_at, task = _text_search_prefetch.pop(req.page_token, (0.0, None))
+    if task is not None and expires_at > time.monotonic():
+        try:
+            results, next_page_token = await task
+        except Exception as e:
+            logger.warning(f"Prefetched text search page failed: {str(e)}")
+    elif task is not None:
+        task.cancel()
+
+    if results is None:
+        results, next_page_token = await request_text_search(data, req.user_id)
+
+    if prefetch_next_page and next_page_token:
+        prefetch_text_search_page(data, next_page_token, req.user_id)
+    return results, next_page_token
 
 
 async def check_street_view_availability(req: ReqStreeViewCheck) -> Dict[str, bool]:
     url = f"https://maps.googleapis.com/maps/api/streetview?return_error_code=true&size=600x300&location={req.lat},{req.lng}&heading=151.78&pitch=-0.76&key={CONF.api_key}"
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                return {"has_street_view": True}
-            else:
-                raise HTTPException(
-                    status_code=499,
-                    detail=f"Error checking Street View availability, error = {response.status}",
-                )
+    await acquire_quota("street_view")
+    session = await HttpClient.get_session()
+    async with session.get(url) as response:
+        if response.status == 200:
+            return {"has_street_view": True}
+        else:
+            raise HTTPException(
+                status_code=499,
+                detail=f"Error checking Street View availability, error = {response.status}",
+            )
 
 
-async def calculate_distance_traffic_route(
-    origin: str, destination: str
-) -> RouteInfo:  # GoogleApi connector
-    url = "https://routes.googleapis.com/directions/v2:computeRoutes"
+async def post_routes_api(url: str, payload: dict, field_mask: str) -> Any:
+    """
+    Posts a Routes API request and returns the decoded response. At most
+    CONF.routes_api_concurrency requests run at once, and throttled or failed
+    requests are retried with exponential backoff.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "X-Goog-Api-Key": CONF.api_key,
+        "X-Goog-fieldmask": field_mask,
+    }
 
+    session = await HttpClient.get_session()
+    timeout = aiohttp.ClientTimeout(total=CONF.routes_api_timeout_seconds)
+    async with _routes_semaphore:
+        for attempt in range(CONF.routes_api_max_retries + 1):
+            await acquire_quota("routes")
+            try:
+                async with session.post(
+                    url, json=payload, headers=headers, timeout=timeout
+                ) as response:
+                    if response.status not in ROUTES_RETRY_STATUSES:
+                        return await response.json(content_type=None)
+                    logger.warning(f"Routes API returned {response.status}, retrying")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Routes API request failed: {str(e)}")
+
+            if attempt < CONF.routes_api_max_retries:
+                delay = ROUTES_RETRY_BASE_DELAY * 2**attempt
+                await asyncio.sleep(delay + random.uniform(0, delay))
+
+    raise HTTPException(
+        status_code=400,
+        detail="Error fetching route information from Google Maps API",
+    )
+
+
+def route_matrix_waypoint(lat: float, lng: float) -> dict:
+    return {"waypoint": {"location": {"latLng": {"latitude": lat, "longitude": lng}}}}
+
+
+async def compute_route_matrix(
+    origins: List[Tuple[float, float]], destinations: List[Tuple[float, float]]
+) -> List[Dict[str, Any]]:
+    """
+    Calls computeRouteMatrix for every origin x destination combination and
+    returns only the matrix elements that have a route. Each element carries
+    originIndex, destinationIndex and staticDuration (e.g. "512s").
+
+    The caller keeps a request within CONF.route_matrix_max_elements and
+    CONF.route_matrix_max_waypoints.
+    """
     payload = {
-        "origin": {
-            "location": {
-                "latLng": {
-                    "latitude": origin.split(",")[0],
-                    "longitude": origin.split(",")[1],
-                }
-            }
-        },
-        "destination": {
-            "location": {
-                "latLng": {
-                    "latitude": destination.split(",")[0],
-                    "longitude": destination.split(",")[1],
-                }
-            }
-        },
+        "origins": [route_matrix_waypoint(lat, lng) for lat, lng in origins],
+        "destinations": [route_matrix_waypoint(lat, lng) for lat, lng in destinations],
         "travelMode": "DRIVE",
-        "routingPreference": "TRAFFIC_AWARE",
-        "computeAlternativeRoutes": True,
-        "extraComputations": ["TRAFFIC_ON_POLYLINE"],
-        "polylineQuality": "high_quality",
+        # staticDuration ignores traffic, so the cheaper traffic-unaware mode is enough
+        "routingPreference": "TRAFFIC_UNAWARE",
     }
 
-    headers = {
-        "Content-Type": "application/json",
-        "X-Goog-Api-Key": CONF.api_key,
-        "X-Goog-fieldmask": "*",
+    elements = await post_routes_api(
+        CONF.route_matrix_api_url,
+        payload,
+        "originIndex,destinationIndex,status,condition,staticDuration",
+    )
+    if not isinstance(elements, list):
+        raise HTTPException(status_code=400, detail="No route matrix found.")
+
+    return [
+        element
+        for element in elements
+        if element.get("condition") == "ROUTE_EXISTS" and "staticDuration" in element
+    ]
+
+
+def drive_time_cache_key(origin: Tuple[float, float], destination: Tuple[float, float]) -> str:
+    # Matrix durations share the route cache with routes, under a prefix of their own
+    return "static_seconds:" + make_route_cache_key(
+        f"{origin[0]},{origin[1]}",
+        f"{destination[0]},{destination[1]}",
+        CONF.route_cache_precision,
+    )
+
+
+async def load_cached_drive_times(
+    pairs: List[Tuple[Tuple[float, float], Tuple[float, float]]]
+) -> Dict[Tuple[Tuple[float, float], Tuple[float, float]], float]:
+    """
+    Static drive times in seconds of the (origin, destination) pairs found in
+    the route cache, loaded with one query.
+    """
+    cache_keys = {pair: drive_time_cache_key(*pair) for pair in pairs}
+    cached = await load_cached_routes(
+        list(set(cache_keys.values())), timedelta(hours=CONF.route_cache_ttl_hours)
+    )
+    return {
+        pair: cached[cache_key]["static_seconds"]
+        for pair, cache_key in cache_keys.items()
+        if cache_key in cached
     }
 
-    try:
-        response = requests.post(url, json=payload, headers=headers)
-        response_data = response.json()
-
-        if "routes" not in response_data:
-            raise HTTPException(status_code=400, detail="No route found.")
-
-        # Parse the first route's leg for necessary details
-        route_info = []
-        for leg in response_data["routes"][0]["legs"]:
-            leg_info = LegInfo(
-                start_location=leg["startLocation"],
-                end_location=leg["endLocation"],
-                distance=leg["distanceMeters"],
-                duration=leg["duration"],
-                static_duration=leg["staticDuration"],
-                polyline=leg["polyline"]["encodedPolyline"],
-                traffic_conditions=[
-                    TrafficCondition(
-                        start_index=interval.get("startPolylinePointIndex", 0),
-                        end_index=interval["endPolylinePointIndex"],
-                        speed=interval["speed"],
-                    )
-                    for interval in leg["travelAdvisory"].get(
-                        "speedReadingIntervals", []
-                    )
-                ],
-            )
-            route_info.append(leg_info)
-
-        return RouteInfo(origin=origin, destination=destination, route=route_info)
 
-    except requests.RequestException:
-        raise HTTPException(
-            status_code=400,
-            detail="Error fetching route information from Google Maps API",
+async def fetch_and_cache_route_matrix(
+    origins: List[Tuple[float, float]], destinations: List[Tuple[float, float]]
+) -> Dict[Tuple[int, int], float]:
+    elements = await compute_route_matrix(origins, destinations)
+    durations = {
+        (element.get("originIndex", 0), element.get("destinationIndex", 0)): float(
+            element["staticDuration"].rstrip("s")
         )
+        for element in elements
+    }
+    try:
+        await store_cached_routes(
+            {
+                drive_time_cache_key(origins[o], destinations[d]): {"static_seconds": seconds}
+                for (o, d), seconds in durations.items()
+            }
+        )
+    except Exception as e:
+        logger.warning(f"Could not cache route matrix durations: {str(e)}")
+    return durations
+
+
+async def fetch_route_matrix_coalesced(
+    origins: List[Tuple[float, float]], destinations: List[Tuple[float, float]]
+) -> Dict[Tuple[int, int], float]:
+    """
+    Static drive times in seconds by (origin index, destination index) of the
+    origin x destination combinations that have a route. Identical requests in
+    flight share one Route Matrix call, and fetched durations are cached.
+    """
+    return await ROUTE_FLIGHTS.do(
+        f"{origins}|{destinations}",
+        partial(fetch_and_cache_route_matrix, origins, destinations),
+    )
+
+
+def single_flight_metrics() -> Dict[str, Any]:
+    return {"datasets": DATASET_FLIGHTS.metrics(), "routes": ROUTE_FLIGHTS.metrics()}
 
 
 # Apply the decorator to all functions in this module
@@ -0,0 +1,53 @@
+import logging
+from typing import Optional
+
+import aiohttp
+
+from config_factory import CONF
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient:
+    """
+    Application-wide aiohttp session for outbound API calls.
+
+    The session is created on startup and closed on shutdown, like the database
+    pool, so every connector reuses keep-alive connections and cached DNS
+    lookups instead of paying a new TCP+TLS handshake per request. The
+    connector caps open connections overall and per host, which also bounds
+    the fan-out of asyncio.gather based callers.
+    """
+
+    _session: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    async def create_session(cls) -> aiohttp.ClientSession:
+        if cls._session is None or cls._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=CONF.http_connection_limit,
+                limit_per_host=CONF.http_connection_limit_per_host,
+                ttl_dns_cache=CONF.http_dns_cache_ttl_seconds,
+                keepalive_timeout=CONF.http_keepalive_timeout_seconds,
+            )
+            cls._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=CONF.http_timeout_seconds),
+            )
+            logger.info("HTTP client session created")
+        return cls._session
+
+    @classmethod
+    async def close_session(cls):
+        if cls._session is not None and not cls._session.closed:
+            await cls._session.close()
+            logger.info("HTTP client session closed")
+        cls._session = None
+
+    @classmethod
+    async def get_session(cls) -> aiohttp.ClientSession:
+        """
+        Returns the shared session, creating it when called outside the app
+        lifecycle (scripts, tests).
+        """
+        return await cls.create_session()
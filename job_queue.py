@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from backend_common.database import Database
+from config_factory import CONF
+from sql_object import SqlObject
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class JobQueue:
+    """
+    Durable queue of deferred work, e.g. plan popularity scoring, backed by
+    the schema_marketplace.jobs table.
+
+    Request handlers only enqueue. Workers started with the app claim due
+    jobs with FOR UPDATE SKIP LOCKED, so any number of worker processes share
+    the queue, and run them with the handler registered for their kind. Jobs
+    enqueued with a dedupe_key collapse into the one pending job of that key.
+    A failing job is retried with exponential backoff up to max_attempts; a
+    job whose worker died is taken over once its lease expires.
+    """
+
+    _handlers: Dict[str, JobHandler] = {}
+    _workers: List[asyncio.Task] = []
+    _wakeup: Optional[asyncio.Event] = None
+    _last_purge = 0.0
+    # Local counters, the backlog and latency across workers come from the table
+    _completed = 0
+    _retried = 0
+    _failed = 0
+    _queued_seconds: deque = deque(maxlen=1000)
+
+    @classmethod
+    def handler(cls, kind: str) -> Callable[[JobHandler], JobHandler]:
+        """
+        Registers the decorated coroutine function as the handler of `kind`
+        jobs. It receives the job payload and raises to have the job retried.
+        """
+
+        def register(func: JobHandler) -> JobHandler:
+            cls._handlers[kind] = func
+            return func
+
+        return register
+
+    @classmethod
+    async def enqueue(
+        cls,
+        kind: str,
+        payload: Dict[str, Any],
+        dedupe_key: Optional[str] = None,
+        delay_seconds: float = 0,
+    ) -> bool:
+        """
+        Enqueues a job. Returns False if a pending job of the same kind and
+        dedupe_key already existed, in which case that job stands for this one.
+        """
+        row = await Database.fetchrow(
+            SqlObject.enqueue_job,
+            kind,
+            dedupe_key,
+            json.dumps(payload),
+            CONF.job_max_attempts,
+            float(delay_seconds),
+        )
+        if cls._wakeup is not None and not delay_seconds:
+            cls._wakeup.set()
+        return row is not None
+
+    @classmethod
+    async def start_workers(cls, concurrency: int = None):
+        concurrency = CONF.job_workers if concurrency is None else concurrency
+        if cls._workers or concurrency <= 0:
+            return
+        cls._wakeup = asyncio.Event()
+        cls._workers = [
+            asyncio.create_task(cls._work(), name=f"job-worker-{i}")
+            for i in range(concurrency)
+        ]
+        logger.info(f"Started {concurrency} job workers")
+
+    @classmethod
+    async def stop_workers(cls):
+        workers, cls._workers = cls._workers, []
+        for worker in workers:
+            worker.cancel()
+        # Jobs interrupted here are taken over by a worker once their lease expires
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    @classmethod
+    async def _work(cls):
+        while True:
+            try:
+                ran = await cls.run_next()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job worker error: {e}")
+                ran = False
+            if ran:
+                continue
+
+            if time.monotonic() - cls._last_purge > CONF.job_purge_interval_seconds:
+                cls._last_purge = time.monotonic()
+                # A failed purge must not end the worker, the next one retries it
+                try:
+                    await Database.execute(
+                        SqlObject.purge_finished_jobs, float(CONF.job_retention_seconds)
+                    )
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Job purge error: {e}")
+            cls._wakeup.clear()
+            try:
+                await asyncio.wait_for(
+                    cls._wakeup.wait(), timeout=CONF.job_poll_interval_seconds
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    @classmethod
+    async def run_next(cls) -> bool:
+        """
+        Claims and runs one due job. Returns False if none was due.
+        """
+        job = await Database.fetchrow(SqlObject.claim_job, float(CONF.job_lease_seconds))
+        if job is None:
+            return False
+        cls._queued_seconds.append(job["queued_seconds"])
+
+        handler = cls._handlers.get(job["kind"])
+        try:
+            if handler is None:
+                raise LookupError(f"No handler for {job['kind']} jobs")
+            if job["attempts"] > job["max_attempts"]:
+                raise RuntimeError("Lease expired on the last attempt")
+            # A job must not outlive its lease, or another worker takes it over
+            await asyncio.wait_for(
+                handler(json.loads(job["payload"])), timeout=CONF.job_lease_seconds
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            retry_after = min(
+                CONF.job_retry_base_seconds * 2 ** (job["attempts"] - 1), 3600
+            )
+            row = await Database.fetchrow(
+                SqlObject.fail_job, job["id"], f"{type(e).__name__}: {e}", float(retry_after)
+            )
+            status = row["status"]
+            if status == "pending":
+                cls._retried += 1
+                logger.warning(
+                    f"Job {job['id']} ({job['kind']}) failed, retrying in {retry_after}s: {e}"
+                )
+            else:
+                cls._failed += 1
+                logger.error(f"Job {job['id']} ({job['kind']}) {status}: {e}")
+            return True
+
+        await Database.execute(SqlObject.complete_job, job["id"])
+        cls._completed += 1
+        return True
+
+    @classmethod
+    async def metrics(cls) -> Dict[str, Any]:
+        """
+        Backlog and latency of the queue as a whole, and this process' workers.
+        """
+        backlog = await Database.fetch(SqlObject.job_backlog)
+        latency = await Database.fetch(SqlObject.job_latency)
+        queued = sorted(cls._queued_seconds)
+        return {
+            "backlog": [dict(row) for row in backlog],
+            "last_hour": [dict(row) for row in latency],
+            "local": {
+                "workers": len(cls._workers),
+                "completed": cls._completed,
+                "retried": cls._retried,
+                "failed": cls._failed,
+                "p50_queued_seconds": queued[len(queued) // 2] if queued else None,
+                "max_queued_seconds": queued[-1] if queued else None,
+            },
+        }
@@ -0,0 +1,77 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+from geo_std_utils import EARTH_RADIUS_M
+
+# Upper bound on the number of pairwise distances held in memory at once
+# (float64, so roughly 32 MB per chunk).
+MAX_CHUNK_ELEMENTS = 4_000_000
+
+
+def k_nearest_points(
+    source_lats,
+    source_lngs,
+    target_lats,
+    target_lngs,
+    k: int,
+    chunk_size: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the k nearest source points of every target point by haversine distance.
+
+    Targets are processed in chunks so that at most MAX_CHUNK_ELEMENTS distances
+    are materialised at a time, and the k smallest distances of each row are
+    selected with argpartition instead of a full sort.
+
+    Returns:
+        (indices, distances): arrays of shape (n_targets, min(k, n_sources)).
+        Row i holds the source indices nearest to target i, closest first,
+        and their distances in meters.
+    """
+    source_lat = np.radians(np.asarray(source_lats, dtype=np.float64))
+    source_lng = np.radians(np.asarray(source_lngs, dtype=np.float64))
+    target_lat = np.radians(np.asarray(target_lats, dtype=np.float64))
+    target_lng = np.radians(np.asarray(target_lngs, dtype=np.float64))
+
+    n_sources = source_lat.size
+    n_targets = target_lat.size
+    k = max(0, min(k, n_sources))
+
+    indices = np.empty((n_targets, k), dtype=np.int64)
+    distances = np.empty((n_targets, k), dtype=np.float64)
+    if k == 0 or n_targets == 0:
+        return indices, distances
+
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // n_sources)
+
+    cos_source_lat = np.cos(source_lat)
+    for start in range(0, n_targets, chunk_size):
+        stop = min(start + chunk_size, n_targets)
+        lat = target_lat[start:stop, None]
+        lng = target_lng[start:stop, None]
+
+        # Haversine "a" term; it is monotonic in distance, so select on it directly
+        a = (
+            np.sin((source_lat - lat) / 2) ** 2
+            + np.cos(lat) * cos_source_lat * np.sin((source_lng - lng) / 2) ** 2
+        )
+
+        if k < n_sources:
+            nearest = np.argpartition(a, k - 1, axis=1)[:, :k]
+        else:
+            nearest = np.broadcast_to(np.arange(n_sources), a.shape)
+        nearest_a = np.take_along_axis(a, nearest, axis=1)
+
+        # Order the selected points by distance, keeping source order on ties
+        order = np.lexsort((nearest, nearest_a), axis=1)
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        nearest_a = np.take_along_axis(nearest_a, order, axis=1)
+
+        indices[start:stop] = nearest
+        distances[start:stop] = (
+            2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(nearest_a, 0.0, 1.0)))
+        )
+
+    return indices, distances
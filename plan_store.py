@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from backend_common.database import Database
+from config_factory import CONF
+from search_plan import SearchPlan
+from sql_object import SqlObject
+
+
+class PlanStore:
+    """
+    Search plans stored in Postgres, one row per circle, with a read-through
+    cache of recent plans.
+
+    Skipping the subcircles of a circle is a single UPDATE of their skip
+    flags, so workers rectifying the same plan never overwrite each other's
+    skips. The cache is per process: skips made by other processes show after
+    plan_cache_ttl_seconds.
+    """
+
+    _plans: "OrderedDict[str, Tuple[SearchPlan, float]]" = OrderedDict()
+    hits = 0
+    misses = 0
+
+    @classmethod
+    async def get(cls, plan_name: str) -> Optional[SearchPlan]:
+        entry = cls._plans.get(plan_name)
+        if entry is not None and time.monotonic() - entry[1] <= CONF.plan_cache_ttl_seconds:
+            cls._plans.move_to_end(plan_name)
+            cls.hits += 1
+            return entry[0].copy()
+        cls.misses += 1
+
+        rows = await Database.fetch(SqlObject.load_search_plan, plan_name)
+        if not rows:
+            cls._plans.pop(plan_name, None)
+            return None
+        plan = SearchPlan.from_rows(rows[0]["query"], rows)
+        cls._cache(plan_name, plan)
+        return plan.copy()
+
+    @classmethod
+    async def save(cls, plan_name: str, plan: SearchPlan):
+        columns = plan.to_columns()
+        await Database.execute(
+            SqlObject.store_search_plan,
+            plan_name,
+            plan.query,
+            columns["circle_index"],
+            columns["circle_number"],
+            columns["parent_number"],
+            columns["is_center"],
+            columns["center_lng"],
+            columns["center_lat"],
+            columns["radius"],
+            columns["skip"],
+        )
+        cls._cache(plan_name, plan.copy())
+
+    @classmethod
+    async def skip_subcircles(cls, plan_name: str, plan_index: int):
+        """
+        Marks every circle nested in the circle at `plan_index` as skipped.
+        """
+        # Plan positions are 0 based, circle_index counts from 1
+        await Database.execute(SqlObject.skip_search_plan_subcircles, plan_name, plan_index + 1)
+        entry = cls._plans.get(plan_name)
+        if entry is not None:
+            entry[0].skip_subcircles(plan_index)
+
+    @classmethod
+    def _cache(cls, plan_name: str, plan: SearchPlan):
+        cls._plans[plan_name] = (plan, time.monotonic())
+        cls._plans.move_to_end(plan_name)
+        while len(cls._plans) > CONF.plan_cache_max_plans:
+            cls._plans.popitem(last=False)
+
+    @classmethod
+    def metrics(cls) -> Dict[str, Any]:
+        return {"plans": len(cls._plans), "hits": cls.hits, "misses": cls.misses}
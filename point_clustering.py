@@ -0,0 +1,238 @@
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from geo_std_utils import from_web_mercator_unit, to_web_mercator_unit
+
+
+class _Node:
+    __slots__ = ("x", "y", "count", "sums", "counts", "feature")
+
+    def __init__(self, x, y, count, sums, counts, feature=None):
+        self.x = x
+        self.y = y
+        self.count = count
+        # Per numeric property: sum of the values and number of points having it
+        self.sums = sums
+        self.counts = counts
+        # Source feature of an unclustered point
+        self.feature = feature
+
+
+def numeric_property_names(features: List[Dict]) -> List[str]:
+    names = {}
+    for feature in features:
+        for key, value in (feature.get("properties") or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                names.setdefault(key, None)
+    return list(names)
+
+
+class ClusterIndex:
+    """
+    Zoom-aware point clustering in the style of supercluster.
+
+    Clusters are built once for every zoom from `max_zoom` down to
+    `min_zoom`: points (or clusters of the zoom above) closer than `radius`
+    pixels of a `extent` pixel tile are merged at their weighted centroid.
+    Clusters carry their point count and the sum and average of every
+    numeric property of their points, e.g. popularity_score, rating or
+    population. Asking for a zoom is then a lookup.
+    """
+
+    def __init__(
+        self,
+        features: List[Dict],
+        min_zoom: int = 0,
+        max_zoom: int = 16,
+        radius: float = 40,
+        extent: int = 512,
+    ):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.radius = radius
+        self.extent = extent
+
+        points = []
+        # Features without a point geometry are passed through at every zoom
+        self.unclustered = []
+        for feature in features:
+            if (feature.get("geometry") or {}).get("type") == "Point":
+                points.append(feature)
+            else:
+                self.unclustered.append(feature)
+        self.property_names = numeric_property_names(points)
+
+        coordinates = np.array(
+            [feature["geometry"]["coordinates"][:2] for feature in points],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        mercator = to_web_mercator_unit(coordinates[:, 1], coordinates[:, 0])
+        nodes = [
+            self._point_node(x, y, feature)
+            for (x, y), feature in zip(mercator.tolist(), points)
+        ]
+
+        self._levels: Dict[int, List[_Node]] = {max_zoom + 1: nodes}
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            nodes = self._cluster(nodes, zoom)
+            self._levels[zoom] = nodes
+        self._features: Dict[int, List[Dict]] = {max_zoom + 1: features}
+        # What layer heads need of the features, so a cached index serves a
+        # layer without loading its dataset
+        self.feature_count = len(features)
+        self.feature_properties = (
+            list((features[0].get("properties") or {}).keys()) if features else []
+        )
+        self.created_at = time.monotonic()
+
+    def _point_node(self, x: float, y: float, feature: Dict) -> _Node:
+        properties = feature.get("properties") or {}
+        sums, counts = [], []
+        for name in self.property_names:
+            value = properties.get(name)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                sums.append(value)
+                counts.append(1)
+            else:
+                sums.append(0)
+                counts.append(0)
+        return _Node(x, y, 1, sums, counts, feature)
+
+    def _cluster(self, nodes: List[_Node], zoom: int) -> List[_Node]:
+        r = self.radius / (self.extent * 2**zoom)
+        xs = np.fromiter((node.x for node in nodes), dtype=np.float64, count=len(nodes))
+        ys = np.fromiter((node.y for node in nodes), dtype=np.float64, count=len(nodes))
+        cells_x = np.floor(xs / r).astype(np.int64)
+        cells_y = np.floor(ys / r).astype(np.int64)
+
+        # A node alone in its 3x3 block of r sized cells has no neighbour within
+        # r, only the others need the pairwise pass
+        cell_keys, cell_sizes = np.unique(
+            (cells_x << 32) + cells_y, return_counts=True
+        )
+        block_sizes = np.zeros(len(nodes), dtype=np.int64)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                keys = ((cells_x + dx) << 32) + (cells_y + dy)
+                found = np.minimum(np.searchsorted(cell_keys, keys), len(cell_keys) - 1)
+                block_sizes += np.where(cell_keys[found] == keys, cell_sizes[found], 0)
+        crowded = block_sizes > 1
+
+        grid = defaultdict(list)
+        for i in np.nonzero(crowded)[0].tolist():
+            grid[(int(cells_x[i]), int(cells_y[i]))].append(i)
+
+        r2 = r * r
+        visited = [False] * len(nodes)
+        clustered = []
+        for i, node in enumerate(nodes):
+            if visited[i]:
+                continue
+            visited[i] = True
+            if not crowded[i]:
+                clustered.append(node)
+                continue
+
+            cell_x, cell_y = int(cells_x[i]), int(cells_y[i])
+            neighbours = []
+            for gx in (cell_x - 1, cell_x, cell_x + 1):
+                for gy in (cell_y - 1, cell_y, cell_y + 1):
+                    for j in grid.get((gx, gy), ()):
+                        if not visited[j]:
+                            other = nodes[j]
+                            if (other.x - node.x) ** 2 + (other.y - node.y) ** 2 <= r2:
+                                visited[j] = True
+                                neighbours.append(other)
+            if not neighbours:
+                clustered.append(node)
+                continue
+
+            members = [node] + neighbours
+            count = sum(member.count for member in members)
+            clustered.append(
+                _Node(
+                    sum(member.x * member.count for member in members) / count,
+                    sum(member.y * member.count for member in members) / count,
+                    count,
+                    [sum(values) for values in zip(*(m.sums for m in members))],
+                    [sum(values) for values in zip(*(m.counts for m in members))],
+                )
+            )
+        return clustered
+
+    def clusters(self, zoom: int) -> List[Dict]:
+        """
+        Features at `zoom`: clusters as Point features with cluster properties,
+        and points that are not part of any cluster as they were given.
+        """
+        zoom = min(max(zoom, self.min_zoom), self.max_zoom + 1)
+        features = self._features.get(zoom)
+        if features is None:
+            features = self._make_features(self._levels[zoom])
+            self._features[zoom] = features
+        return features
+
+    def _make_features(self, nodes: List[_Node]) -> List[Dict]:
+        cluster_nodes = [node for node in nodes if node.feature is None]
+        lat_lngs = from_web_mercator_unit(
+            [node.x for node in cluster_nodes], [node.y for node in cluster_nodes]
+        ).tolist()
+        positions = iter(lat_lngs)
+
+        features = []
+        for node in nodes:
+            if node.feature is not None:
+                features.append(node.feature)
+                continue
+            lat, lng = next(positions)
+            properties = {"cluster": True, "point_count": node.count}
+            for name, total, count in zip(self.property_names, node.sums, node.counts):
+                if count:
+                    properties[f"{name}_sum"] = total
+                    properties[f"{name}_avg"] = total / count
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [lng, lat]},
+                    "properties": properties,
+                }
+            )
+        return features + self.unclustered
+
+
+class ClusterCache:
+    """
+    ClusterIndex per dataset, least recently used evicted past `max_datasets`
+    and rebuilt after `ttl_seconds`.
+    """
+
+    def __init__(self, max_datasets: int, ttl_seconds: float):
+        self.max_datasets = max_datasets
+        self.ttl_seconds = ttl_seconds
+        self._indexes: "OrderedDict[str, ClusterIndex]" = OrderedDict()
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, dataset_id: str) -> Optional[ClusterIndex]:
+        index = self._indexes.get(dataset_id)
+        if index is None:
+            return None
+        if time.monotonic() - index.created_at > self.ttl_seconds:
+            del self._indexes[dataset_id]
+            return None
+        self._indexes.move_to_end(dataset_id)
+        self.hits += 1
+        return index
+
+    def put(self, dataset_id: str, index: ClusterIndex):
+        self._indexes[dataset_id] = index
+        self._indexes.move_to_end(dataset_id)
+        self.builds += 1
+        while len(self._indexes) > self.max_datasets:
+            self._indexes.popitem(last=False)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"datasets": len(self._indexes), "hits": self.hits, "builds": self.builds}
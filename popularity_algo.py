@@ -1,11 +1,22 @@
+from collections import defaultdict
 from geo_std_utils import get_point_at_distance
 from use_json import use_json
 import asyncio
+import logging
 from backend_common.database import Database
+from dataset_cache import DATASET_CACHE
+from job_queue import JobQueue
+from plan_store import PlanStore
+from search_plan import SearchPlan
+from quantile_sketch import QuantileSketch
+from sql_object import SqlObject
 import json
 import numpy as np
+import orjson
 import math
 
+logger = logging.getLogger(__name__)
+
 RADIUS_ZOOM_MULTIPLIER = {
     30000.0: 1000, # 1
     15000.0: 500, # 2
@@ -16,6 +27,11 @@ RADIUS_ZOOM_MULTIPLIER = {
     468.75: 15.625 # 7
 }
 
+QUARTILE_PERCENTS = [25, 50, 75]
+
+# Serializes process_plan_popularity per plan within the process
+PLAN_POPULARITY_LOCKS = defaultdict(asyncio.Lock)
+
 def calculate_category_multiplier(index):
     """Calculate category multiplier based on result position."""
     if 0 <= index < 5:  # Category A
@@ -28,179 +44,197 @@ def calculate_category_multiplier(index):
         return 0.4
     
 
-def get_plan_db_entries(plan_content):
-    """Extract plan entries from plan content."""
-    if not plan_content:
+def get_plan_db_entries(plan):
+    """Dataset filename prefixes of the searches of a plan."""
+    if not plan:
         return []
-    
-    plan_entries = []
-    for entry in plan_content:
-        if not isinstance(entry, str):
-            continue
-        if "_circle=" not in entry:
-            continue
-        plan_entries.append(entry.split("_circle=")[0])
-    return plan_entries
-
-
-def add_popularity_score_category(features):
-    """Add popularity score category based on quartiles."""
+    return [plan.dataset_prefix(index) for index in range(len(plan))]
+
+
+def popularity_score_category(score, quartiles):
+    """Category of a popularity score given the 25th, 50th and 75th percentiles."""
+    if score >= quartiles[2]:
+        return "Very High"
+    elif score >= quartiles[1]:
+        return "High"
+    elif score >= quartiles[0]:
+        return "Low"
+    else:
+        return "Very Low"
+
+
+def add_popularity_score_category(features, quartiles=None):
+    """Add popularity score category based on quartiles, by default those of the features' own scores."""
     if not features:
         return features
         
-    scores = [f["properties"].get("popularity_score", 0) for f in features]
-    if not scores:
-        return features
-        
-    quartiles = np.percentile(scores, [25, 50, 75])
+    if quartiles is None:
+        scores = [f["properties"].get("popularity_score", 0) for f in features]
+        quartiles = np.percentile(scores, QUARTILE_PERCENTS)
     
     for feature in features:
         score = feature["properties"].get("popularity_score", 0)
-        if score >= quartiles[2]:
-            category = "Very High"
-        elif score >= quartiles[1]:
-            category = "High"
-        elif score >= quartiles[0]:
-            category = "Low"
-        else:
-            category = "Very Low"
-        feature["properties"]["popularity_score_category"] = category
+        feature["properties"]["popularity_score_category"] = popularity_score_category(
+            score, quartiles
+        )
     
     return features
 
 
-async def get_plan(plan_name):
-    file_path = (
-        f"Backend/layer_category_country_city_matching/full_data_plans/{plan_name}.json"
+def is_ranked_feature(feature):
+    """Only features with an address and coordinates take part in plan popularity."""
+    return bool(
+        feature["properties"].get("address") and feature["geometry"].get("coordinates")
+    )
+
+
+def categories_changed(scores, old_quartiles, new_quartiles):
+    """Whether any of `scores` falls in another category under the new quartiles."""
+    if old_quartiles is None:
+        return True
+    return any(
+        popularity_score_category(score, old_quartiles)
+        != popularity_score_category(score, new_quartiles)
+        for score in scores
     )
-    # use json file
-    json_content = await use_json(file_path, "r")
-    return json_content
+
+
+def rank_dataset_features(response_data, quartiles):
+    """Categorize a dataset's ranked features and sort them by popularity score."""
+    features = response_data.get("features", [])
+    add_popularity_score_category(
+        [feature for feature in features if is_ranked_feature(feature)], quartiles
+    )
+    features.sort(key=lambda x: x["properties"].get("popularity_score", 0), reverse=True)
+
+    properties = response_data.get("properties", [])
+    for name in ("popularity_score", "popularity_score_category"):
+        if name not in properties:
+            properties.append(name)
+    return {"type": "FeatureCollection", "features": features, "properties": properties}
+
+
+async def get_plan(plan_name):
+    plan = await PlanStore.get(plan_name)
+    if plan is None:
+        # Plans saved as JSON files before the plan store move over on first use
+        file_path = (
+            f"Backend/layer_category_country_city_matching/full_data_plans/{plan_name}.json"
+        )
+        entries = await use_json(file_path, "r")
+        if entries:
+            plan = SearchPlan.from_entries(entries)
+            await PlanStore.save(plan_name, plan)
+    return plan
+
+
+async def load_plan_popularity_state(plan_name: str) -> dict:
+    row = await Database.fetchrow(SqlObject.load_plan_popularity, plan_name)
+    if row is None:
+        return {"sketch": QuantileSketch().to_dict(), "quartiles": None, "datasets": {}}
+    return json.loads(row["state"])
+
+
+@JobQueue.handler("plan_popularity")
+async def plan_popularity_job(payload: dict):
+    await process_plan_popularity(payload["plan_name"])
 
 
 async def process_plan_popularity(plan_name: str):
     """
-    Process a plan by its name, updating the database with popularity scores and popularity score categories.
+    Process a plan by its name, updating the database with popularity score categories.
+
+    Scoring is incremental: the plan keeps a quantile sketch of the popularity
+    scores of the datasets scored so far, and the distinct scores of each of
+    them. Only datasets new since the last call are loaded and added to the
+    sketch. Earlier datasets are rewritten only when the new quartiles move one
+    of their scores to another category.
     
     Args:
         plan_name (str): Name of the plan to process (e.g. 'plan_parking_Saudi Arabia_Jeddah')
     """
     plan_content = await get_plan(plan_name)
     if not plan_content:
-        print("No plan content found")
+        logger.info(f"No plan content found for {plan_name}")
         return
         
     plan_entries = get_plan_db_entries(plan_content)
     if not plan_entries:
-        print("No valid plan entries found")
+        logger.info(f"No valid plan entries found for {plan_name}")
         return
         
     plan_entries = [entry + "%" for entry in plan_entries]
-    
-    query = """
-        SELECT * 
-        FROM schema_marketplace.datasets
-        WHERE filename LIKE ANY($1)
-        ORDER BY created_at ASC
-    """
-    
-    try:
-        results = await Database.fetch(query, plan_entries)
-        print(f"Found datasets: {len(results)}")
-        
+
+    async with PLAN_POPULARITY_LOCKS[plan_name]:
+        state = await load_plan_popularity_state(plan_name)
+        sketch = QuantileSketch.from_dict(state["sketch"])
+        old_quartiles = state["quartiles"]
+        dataset_scores = state["datasets"]
+
+        results = await Database.fetch(
+            SqlObject.load_unscored_plan_datasets, plan_entries, list(dataset_scores)
+        )
         if not results:
-            print("No matching datasets found")
             return
-        
-        # Collect all features from all response_data
-        all_features = []
-        feature_map = {}  # Map to keep track of features by (address, coordinates)
-        
-        for result in results:
-            try:
-                response_data = json.loads(result['response_data'])
-                features = response_data.get('features', [])
-                if not features:
-                    print(f"No features found in dataset: {result['filename']}")
-                    continue
-                    
-                for feature in features:
-                    address = feature["properties"].get("address")
-                    coordinates = tuple(feature["geometry"].get("coordinates", []))
-                    if address and coordinates:
-                        key = (address, coordinates)
-                        feature_map[key] = feature
-                        all_features.append(feature)
-            except (json.JSONDecodeError, KeyError) as e:
-                print(f"Error processing result {result.get('filename', 'unknown')}: {e}")
-                continue
-        
-        if not all_features:
-            print("No features found in any dataset")
-            return
-            
-        # Sort all features globally based on popularity_score
-        all_features.sort(key=lambda x: x["properties"].get("popularity_score", 0), reverse=True)
-        all_features = add_popularity_score_category(all_features)
-        
-        sorted_feature_map = {}
-        for feature in all_features:
-            address = feature["properties"].get("address")
-            coordinates = tuple(feature["geometry"].get("coordinates", []))
-            sorted_feature_map[(address, coordinates)] = feature
-        
-        success_count = 0
-        
+        logger.info(f"Found {len(results)} new datasets of {plan_name}")
+
+        datasets = {}
         for result in results:
             try:
-                response_data = json.loads(result['response_data'])
-                features = response_data.get('features', [])
-                
-                updated_features = []
-                for feature in features:
-                    address = feature["properties"].get("address")
-                    coordinates = tuple(feature["geometry"].get("coordinates", []))
-                    key = (address, coordinates)
-                    if key in sorted_feature_map:
-                        updated_feature = sorted_feature_map[key]
-                        updated_features.append(updated_feature)
-                    else:
-                        updated_features.append(feature)
-
-                updated_features.sort(key=lambda x: x["properties"].get("popularity_score", 0), reverse=True)
-                
-                new_response_data = {
-                    "type": "FeatureCollection",
-                    "features": updated_features,
-                    "properties": response_data.get("properties", [])
-                }
-                
-                if "popularity_score" not in new_response_data["properties"]:
-                    new_response_data["properties"].append("popularity_score")
-                
-                if "popularity_score_category" not in new_response_data["properties"]:
-                    new_response_data["properties"].append("popularity_score_category")
-                
-                update_query = """
-                    UPDATE schema_marketplace.datasets 
-                    SET response_data = $1
-                    WHERE filename = $2
-                """
-                
-                await Database.execute(update_query, json.dumps(new_response_data), result['filename'])
-                success_count += 1
-                print(f"Updated database entry for {result['filename']} - {len(updated_features)} features updated")
-                
-            except (json.JSONDecodeError, KeyError) as e:
-                print(f"Error updating database entry {result.get('filename', 'unknown')}: {e}")
+                response_data = orjson.loads(result["response_data"])
+                scores = [
+                    feature["properties"].get("popularity_score", 0)
+                    for feature in response_data.get("features", [])
+                    if is_ranked_feature(feature)
+                ]
+            except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+                logger.error(f"Error processing result {result['filename']}: {e}")
+                dataset_scores[result["filename"]] = []
                 continue
-        
-        print(f"Database update completed. Successfully updated {success_count} out of {len(results)} datasets")
-        
-    except Exception as e:
-        print(f"An error occurred during execution: {e}")
-
-
+            sketch.add(scores)
+            dataset_scores[result["filename"]] = sorted(set(scores))
+            datasets[result["filename"]] = response_data
+
+        quartiles = None
+        new_count = len(datasets)
+        if sketch.count:
+            quartiles = sketch.quantiles(QUARTILE_PERCENTS)
+            changed = [
+                filename
+                for filename, scores in dataset_scores.items()
+                if filename not in datasets
+                and categories_changed(scores, old_quartiles, quartiles)
+            ]
+            if changed:
+                rows = await Database.fetch(SqlObject.load_datasets_with_timestamp, changed)
+                for row in rows:
+                    datasets[row["filename"]] = orjson.loads(row["response_data"])
+        else:
+            # Nothing to categorize yet, only the scored datasets are recorded
+            datasets, new_count = {}, 0
+
+        filenames = list(datasets)
+        state = {
+            "sketch": sketch.to_dict(),
+            "quartiles": quartiles if quartiles is not None else old_quartiles,
+            "datasets": dataset_scores,
+        }
+        row = await Database.fetchrow(
+            SqlObject.store_plan_popularity,
+            plan_name,
+            orjson.dumps(state).decode(),
+            filenames,
+            [
+                orjson.dumps(rank_dataset_features(datasets[filename], quartiles)).decode()
+                for filename in filenames
+            ],
+        )
+        for filename in filenames:
+            DATASET_CACHE.invalidate(filename)
+        logger.info(
+            f"Updated {row['updated_count']} datasets of {plan_name}, "
+            f"{len(filenames) - new_count} of them for changed categories"
+        )
 
 
 def cover_circle_with_seven_circles(
@@ -247,47 +281,15 @@ def cover_circle_with_seven_circles(
     }
 
 
-def create_string_list(
-    circle_hierarchy, type_string, text_search, include_hierarchy=False
-):
-    result = []
-    circles_to_process = [(circle_hierarchy, "1")]
-    total_circles = 0
-
-    while circles_to_process:
-        circle, number = circles_to_process.pop(0)
-        total_circles += 1
-
-        lat, lng = circle["center"]
-        radius = circle["radius"]
-
-        circle_string = f"{lat}_{lng}_{radius * 1000}_{type_string}"
-        if text_search != "" and text_search is not None:
-            circle_string = circle_string + f"_{text_search}"
-
-        center_marker = "*" if circle["is_center"] else ""
-        circle_string += f"_circle={number}{center_marker}_circleNumber={total_circles}"
-
-        result.append(circle_string)
-
-        for i, sub_circle in enumerate(circle["sub_circles"], 1):
-            new_number = f"{number}.{i}" if number else f"{i}"
-            circles_to_process.append((sub_circle, new_number))
-
-    return result
-
-
-async def create_plan(lng, lat, radius, boolean_query, text_search):
+async def create_plan(lng, lat, radius, boolean_query, text_search) -> SearchPlan:
     circle_hierarchy = cover_circle_with_seven_circles((lng, lat), radius / 1000)
-    string_list_plan = create_string_list(circle_hierarchy, boolean_query, text_search)
-    string_list_plan.append("end of search plan")
-    return string_list_plan
+    query = boolean_query
+    if text_search != "" and text_search is not None:
+        query = query + f"_{text_search}"
+    return SearchPlan.from_circle_hierarchy(circle_hierarchy, query)
 
 
 async def save_plan(plan_name, plan):
-    file_path = (
-        f"Backend/layer_category_country_city_matching/full_data_plans/{plan_name}.json"
-    )
-    await use_json(file_path, "w", plan)
+    await PlanStore.save(plan_name, plan)
 
 
@@ -0,0 +1,82 @@
+import math
+from typing import Dict, Iterable, List
+
+
+class QuantileSketch:
+    """
+    Mergeable streaming histogram of values in the style of Ben-Haim and
+    Tom-Tov: a bounded set of (value, count) bins.
+
+    While there are at most `max_bins` distinct values the sketch is exact and
+    quantiles match np.percentile (linear interpolation). Past that, the two
+    closest bins are merged into their weighted mean until `max_bins` remain.
+    Popularity scores take a few dozen distinct values, so plan sketches stay
+    exact in practice.
+    """
+
+    def __init__(self, max_bins: int = 256):
+        self.max_bins = max_bins
+        self._bins: Dict[float, int] = {}
+
+    @property
+    def count(self) -> int:
+        return sum(self._bins.values())
+
+    def add(self, values: Iterable[float]):
+        for value in values:
+            value = float(value)
+            self._bins[value] = self._bins.get(value, 0) + 1
+            # Compressing in batches keeps adding many distinct values linear
+            if len(self._bins) > 2 * self.max_bins:
+                self._compress()
+        self._compress()
+
+    def merge(self, other: "QuantileSketch"):
+        for value, count in other._bins.items():
+            self._bins[value] = self._bins.get(value, 0) + count
+        self._compress()
+
+    def _compress(self):
+        if len(self._bins) <= self.max_bins:
+            return
+        bins = sorted(self._bins.items())
+        while len(bins) > self.max_bins:
+            i = min(range(len(bins) - 1), key=lambda j: bins[j + 1][0] - bins[j][0])
+            (v1, c1), (v2, c2) = bins[i], bins[i + 1]
+            bins[i : i + 2] = [((v1 * c1 + v2 * c2) / (c1 + c2), c1 + c2)]
+        self._bins = dict(bins)
+
+    def quantiles(self, percents: Iterable[float]) -> List[float]:
+        """
+        Values at `percents` (0 to 100) of the values added, as np.percentile.
+        """
+        bins = sorted(self._bins.items())
+        total = sum(count for _, count in bins)
+        if not total:
+            raise ValueError("Quantiles of an empty sketch")
+
+        def value_at_rank(rank: int) -> float:
+            seen = 0
+            for value, count in bins:
+                seen += count
+                if rank < seen:
+                    return value
+            return bins[-1][0]
+
+        result = []
+        for percent in percents:
+            position = percent / 100 * (total - 1)
+            lower = math.floor(position)
+            low_value = value_at_rank(lower)
+            high_value = value_at_rank(min(lower + 1, total - 1))
+            result.append(low_value + (position - lower) * (high_value - low_value))
+        return result
+
+    def to_dict(self) -> Dict:
+        return {"max_bins": self.max_bins, "bins": sorted(self._bins.items())}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "QuantileSketch":
+        sketch = cls(data.get("max_bins", 256))
+        sketch._bins = {float(value): int(count) for value, count in data.get("bins", [])}
+        return sketch
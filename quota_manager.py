@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional
+
+from config_factory import CONF
+from storage import take_shared_quota_token
+
+logger = logging.getLogger(__name__)
+
+
+class LocalTokenBucket:
+    """
+    In-process token bucket refilled at `rate` tokens per second up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    async def try_acquire(self) -> float:
+        """
+        Takes a token if one is available. Returns 0 on success, otherwise the
+        number of seconds until the next token is due.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class SharedTokenBucket:
+    """
+    Token bucket kept in Postgres so that all worker processes draw from the
+    same quota. Refill and take happen in a single upsert on the bucket row.
+    """
+
+    def __init__(self, api: str, rate: float, capacity: float):
+        self.api = api
+        self.rate = rate
+        self.capacity = capacity
+
+    async def try_acquire(self) -> float:
+        granted, tokens = await take_shared_quota_token(self.api, self.rate, self.capacity)
+        if granted:
+            return 0.0
+        return (1 - tokens) / self.rate
+
+
+class ApiQuota:
+    """
+    Rate limit for one outbound API. Calls wait in per-user queues and tokens
+    are handed out round-robin across users, so one large request cannot
+    starve everyone else.
+    """
+
+    def __init__(self, api: str, bucket):
+        self.api = api
+        self.bucket = bucket
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._dispatcher: Optional[asyncio.Task] = None
+        # A token taken for waiters that were all cancelled meanwhile is kept
+        # for the next waiter rather than dropped
+        self._token = False
+        self.granted = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def acquire(self, user_id: str = ""):
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(future)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        queued_at = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            queue = self._queues.get(user_id)
+            if queue is not None and future in queue:
+                queue.remove(future)
+                if not queue:
+                    del self._queues[user_id]
+            elif future.done() and not future.cancelled():
+                # Granted just before the cancellation, pass the token on
+                self._token = True
+                if self._queues and (self._dispatcher is None or self._dispatcher.done()):
+                    self._dispatcher = asyncio.create_task(self._dispatch())
+            raise
+
+        waited = time.monotonic() - queued_at
+        self.granted += 1
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    async def _dispatch(self):
+        while self._queues:
+            if not self._token:
+                try:
+                    wait = await self.bucket.try_acquire()
+                except Exception as e:
+                    # Don't stall outbound calls because the shared bucket is unreachable
+                    logger.warning(f"Quota bucket for {self.api} unavailable: {str(e)}")
+                    wait = 0.0
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                self._token = True
+
+            future = self._next_waiter()
+            if future is None:
+                break
+            try:
+                future.set_result(None)
+            except asyncio.InvalidStateError:
+                # Cancelled after _next_waiter checked it, the token stays for the next
+                continue
+            self._token = False
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        """
+        Pops the future of the next user in round-robin order, skipping waiters
+        cancelled while the bucket was being asked for a token.
+        """
+        while self._queues:
+            user_id, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            if not future.done():
+                return future
+        return None
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": sum(len(queue) for queue in self._queues.values()),
+            "queued_users": len(self._queues),
+            "granted": self.granted,
+            "average_wait_seconds": (
+                self.total_wait_seconds / self.granted if self.granted else 0.0
+            ),
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+def make_quota(api: str, rate: float) -> ApiQuota:
+    capacity = max(1.0, rate * CONF.quota_burst_seconds)
+    if CONF.quota_shared_across_workers:
+        return ApiQuota(api, SharedTokenBucket(api, rate, capacity))
+    return ApiQuota(api, LocalTokenBucket(rate, capacity))
+
+
+QUOTAS: Dict[str, ApiQuota] = {
+    "places_nearby": make_quota("places_nearby", CONF.quota_places_nearby_per_second),
+    "text_search": make_quota("text_search", CONF.quota_text_search_per_second),
+    "routes": make_quota("routes", CONF.quota_routes_per_second),
+    "street_view": make_quota("street_view", CONF.quota_street_view_per_second),
+}
+
+
+async def acquire_quota(api: str, user_id: str = ""):
+    """
+    Waits until a call to `api` is allowed for `user_id`.
+    """
+    await QUOTAS[api].acquire(user_id or "")
+
+
+def quota_metrics() -> Dict[str, Dict[str, Any]]:
+    return {api: quota.metrics() for api, quota in QUOTAS.items()}
@@ -0,0 +1,68 @@
+from typing import Any, Dict, List, Tuple
+
+# Smallest share of a Route Matrix request that must be pairs we actually need
+ROUTE_MATRIX_MIN_FILL = 0.5
+
+# (origin positions into nearest_locations, destination coordinates,
+#  (origin index, destination index) of the pairs the request was packed for)
+RouteMatrixBatch = Tuple[List[int], List[Tuple[float, float]], List[Tuple[int, int]]]
+
+
+def pack_route_matrix_batches(
+    nearest_locations: List[Dict[str, Any]],
+    max_elements: int,
+    max_waypoints: int,
+    min_fill: float = ROUTE_MATRIX_MIN_FILL,
+) -> List[RouteMatrixBatch]:
+    """
+    Packs the target -> nearest coordinate pairs into Route Matrix requests.
+
+    Pairs are grouped by destination, so a request is a block of destination
+    columns and the targets (origins) that need them. A column is added to the
+    current request only while the request stays within the element and waypoint
+    limits and at least `min_fill` of its elements are pairs we asked for; the
+    rest of the matrix is billed but unused. Destinations needed by more targets
+    than fit in one request are split over several columns.
+
+    Every distinct (target, nearest coordinate) pair is in exactly one batch,
+    and only the pairs listed in a batch should be read from its response.
+    """
+    origins_by_destination: Dict[Tuple[float, float], List[int]] = {}
+    for i, item in enumerate(nearest_locations):
+        for coord in dict.fromkeys(item["nearest_coordinates"]):
+            origins_by_destination.setdefault(coord, []).append(i)
+
+    column_size = max(1, min(max_waypoints - 1, max_elements))
+    batches: List[RouteMatrixBatch] = []
+
+    def close_batch():
+        positions = sorted(origins)
+        origin_index = {i: n for n, i in enumerate(positions)}
+        batches.append(
+            (positions, destinations, [(origin_index[i], d) for i, d in targets])
+        )
+
+    origins: set = set()
+    destinations: List[Tuple[float, float]] = []
+    # (target position, destination index) of the pairs in the current batch
+    targets: List[Tuple[int, int]] = []
+    for coord in sorted(origins_by_destination):
+        column = origins_by_destination[coord]
+        for start in range(0, len(column), column_size):
+            chunk = column[start : start + column_size]
+            merged = origins.union(chunk)
+            elements = len(merged) * (len(destinations) + 1)
+            if destinations and (
+                elements > max_elements
+                or len(merged) + len(destinations) + 1 > max_waypoints
+                or len(targets) + len(chunk) < min_fill * elements
+            ):
+                close_batch()
+                merged, destinations, targets = set(chunk), [], []
+            origins = merged
+            targets.extend((i, len(destinations)) for i in chunk)
+            destinations.append(coord)
+
+    if destinations:
+        close_batch()
+    return batches
@@ -0,0 +1,89 @@
+# benchmark_geojson_builder.py
+# Compares the pandas iterrows() conversion that get_census_dataset_from_storage
+# used to run on census rows with the columnar records_to_features builder.
+#
+# Run from the repository root:
+#     python -m scripts.benchmark_geojson_builder [--rows 100000]
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from geojson_builder import records_to_features
+
+CENSUS_COLUMNS = [
+    "id", "population", "male_population", "female_population", "households",
+    "median_age", "density", "income", "zoom_level", "degree", "city", "country",
+    "latitude", "longitude",
+]
+
+
+def legacy_census_features(city_data):
+    city_df = pd.DataFrame([dict(record) for record in city_data], dtype=object)
+    features = []
+    for _, row in city_df.iterrows():
+        coordinates = [float(row["longitude"]), float(row["latitude"])]
+        columns_to_drop = ["latitude", "longitude", "city"]
+        if "country" in row:
+            columns_to_drop.append("country")
+        row = row.dropna()
+        properties = row.drop(columns_to_drop).to_dict()
+        if len(row) == 0:
+            continue
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": coordinates},
+                "properties": properties,
+            }
+        )
+    return features
+
+
+def random_census_rows(rng, n):
+    # Dicts stand in for asyncpg Records, both have keys() and values()
+    population = rng.integers(0, 20_000, n).tolist()
+    income = [None if i % 7 == 0 else float(v) for i, v in enumerate(rng.uniform(1e3, 5e4, n))]
+    lats = rng.uniform(24.56, 24.92, n).tolist()
+    lngs = rng.uniform(46.50, 46.85, n).tolist()
+    return [
+        dict(
+            zip(
+                CENSUS_COLUMNS,
+                (
+                    i, population[i], population[i] // 2, population[i] - population[i] // 2,
+                    population[i] // 5, 31.5, population[i] / 4.2, income[i], 5,
+                    "24.7136N 46.6753E", "Riyadh", "Saudi Arabia", lats[i], lngs[i],
+                ),
+            )
+        )
+        for i in range(n)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark record to GeoJSON conversion")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    print(f"{'rows':>10} {'iterrows (s)':>13} {'columnar (s)':>13} {'speedup':>9}")
+    for n in args.rows:
+        rows = random_census_rows(rng, n)
+
+        started = time.perf_counter()
+        legacy = legacy_census_features(rows)
+        legacy_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        columnar = records_to_features(rows, drop_nulls=True)
+        columnar_time = time.perf_counter() - started
+
+        assert columnar == legacy
+        print(f"{n:>10} {legacy_time:>13.3f} {columnar_time:>13.3f} {legacy_time / columnar_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# benchmark_map_data_response.py
+# Compares building the prdcer_lyr_map_data response through the models
+# (ResLyrMapData, then ResModel in request_handling, then FastAPI's response_model
+# validation and JSON encoding) with the trusted path, which validates the
+# envelope and the layer head and writes the stored features with orjson.
+#
+# Run from the repository root:
+#     python -m scripts.benchmark_map_data_response [--sizes 10000 100000]
+import argparse
+import json
+import time
+import uuid
+
+import numpy as np
+import orjson
+
+from all_types.response_dtypes import ResLyrMapData, ResLyrMapDataHead, ResModel
+
+
+def random_features(rng, n):
+    # Spread over the Riyadh bounding box, with properties like a places layer
+    lats = rng.uniform(24.56, 24.92, n)
+    lngs = rng.uniform(46.50, 46.85, n)
+    return [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [float(lng), float(lat)]},
+            "properties": {
+                "name": f"Place {i}",
+                "address": f"{i} King Fahd Road, Riyadh",
+                "rating": round(float(rng.uniform(1, 5)), 1),
+                "user_ratings_total": int(rng.integers(0, 5000)),
+                "types": ["restaurant", "food", "point_of_interest"],
+            },
+        }
+        for i, (lat, lng) in enumerate(zip(lats, lngs))
+    ]
+
+
+def head_fields(features):
+    return {
+        "type": "FeatureCollection",
+        "properties": list(features[0]["properties"].keys()),
+        "prdcer_layer_name": "Restaurants",
+        "prdcer_lyr_id": "l1",
+        "bknd_dataset_id": "d1",
+        "points_color": "red",
+        "layer_legend": "",
+        "layer_description": "",
+        "records_count": len(features),
+        "city_name": "Riyadh",
+        "is_zone_lyr": "false",
+    }
+
+
+def validated_response(features) -> bytes:
+    layer = ResLyrMapData(features=features, **head_fields(features))
+    envelope = ResModel[ResLyrMapData](
+        message="Request received", request_id=str(uuid.uuid4()), data=layer
+    )
+    # FastAPI dumps the returned model and validates it against response_model
+    checked = ResModel[ResLyrMapData].model_validate(envelope.model_dump())
+    return json.dumps(checked.model_dump(mode="json")).encode()
+
+
+def trusted_response(features) -> bytes:
+    head = ResLyrMapDataHead(**head_fields(features))
+    envelope = ResModel[ResLyrMapDataHead](
+        message="Request received", request_id=str(uuid.uuid4()), data=head
+    ).model_dump()
+    envelope["data"]["features"] = features
+    return orjson.dumps(envelope)
+
+
+def best_of(func, features, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = func(features)
+        timings.append(time.perf_counter() - started)
+    return min(timings), body
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark map data responses")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    print(f"{'features':>10} {'validated (s)':>14} {'trusted (s)':>12} {'speedup':>9}")
+    for size in args.sizes:
+        features = random_features(rng, size)
+        validated, validated_body = best_of(validated_response, features, args.repeat)
+        trusted, trusted_body = best_of(trusted_response, features, args.repeat)
+
+        # Same document apart from the request id
+        expected = json.loads(validated_body)
+        actual = json.loads(trusted_body)
+        expected.pop("request_id")
+        actual.pop("request_id")
+        assert expected == actual
+
+        print(f"{size:>10} {validated:>14.3f} {trusted:>12.3f} {validated / trusted:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
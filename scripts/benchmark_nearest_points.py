@@ -0,0 +1,91 @@
+# benchmark_nearest_points.py
+# Compares the per-pair Python nearest-point search that filter_for_nearest_points
+# used to run with the vectorized k_nearest_points kernel.
+#
+# Run from the repository root:
+#     python -m scripts.benchmark_nearest_points [--targets 100] [--k 2]
+import argparse
+import math
+import time
+
+import numpy as np
+
+from nearest_points import k_nearest_points
+
+
+def legacy_calculate_distance_km(point1, point2) -> float:
+    R = 6371
+    lon1, lat1 = math.radians(point1[0]), math.radians(point1[1])
+    lon2, lat2 = math.radians(point2[0]), math.radians(point2[1])
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def legacy_nearest_points(category_coordinates, target_coordinates, k):
+    nearest_locations = []
+    for target in target_coordinates:
+        distances = []
+        for loc in category_coordinates:
+            dist = legacy_calculate_distance_km(
+                (target["longitude"], target["latitude"]),
+                (loc["longitude"], loc["latitude"]),
+            )
+            distances.append(
+                {"latitude": loc["latitude"], "longitude": loc["longitude"], "distance": dist}
+            )
+        nearest = sorted(distances, key=lambda x: x["distance"])[:k]
+        nearest_locations.append([(loc["latitude"], loc["longitude"]) for loc in nearest])
+    return nearest_locations
+
+
+def random_coordinates(rng, n):
+    # Spread over the Riyadh bounding box
+    lats = rng.uniform(24.56, 24.92, n)
+    lngs = rng.uniform(46.50, 46.85, n)
+    return [{"latitude": float(lat), "longitude": float(lng)} for lat, lng in zip(lats, lngs)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark nearest-point search")
+    parser.add_argument("--targets", type=int, default=100)
+    parser.add_argument("--k", type=int, default=2)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    targets = random_coordinates(rng, args.targets)
+
+    print(f"{'points':>10} {'legacy (s)':>12} {'vectorized (s)':>15} {'speedup':>9}")
+    for size in args.sizes:
+        sources = random_coordinates(rng, size)
+
+        start = time.perf_counter()
+        expected = legacy_nearest_points(sources, targets, args.k)
+        legacy_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        indices, _ = k_nearest_points(
+            [loc["latitude"] for loc in sources],
+            [loc["longitude"] for loc in sources],
+            [t["latitude"] for t in targets],
+            [t["longitude"] for t in targets],
+            k=args.k,
+        )
+        result = [
+            [(sources[i]["latitude"], sources[i]["longitude"]) for i in row] for row in indices
+        ]
+        vectorized_seconds = time.perf_counter() - start
+
+        if result != expected:
+            raise AssertionError(f"results differ for {size} points")
+
+        print(
+            f"{size:>10} {legacy_seconds:>12.3f} {vectorized_seconds:>15.4f} "
+            f"{legacy_seconds / vectorized_seconds:>8.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
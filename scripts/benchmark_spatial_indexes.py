@@ -0,0 +1,196 @@
+# benchmark_spatial_indexes.py
+# Compares the latitude/longitude BETWEEN bounding box queries on unindexed
+# tables with the SqlObject queries on the geom columns and indexes added by
+# database_files/migrations, on synthetic census, Saudi real estate and
+# Canada commercial property rows.
+#
+# Needs a local Postgres with PostGIS and pg_trgm available. Everything is
+# created in a scratch schema that is dropped afterwards; the migrations and
+# queries are pointed at it in place of "schema_marketplace".
+#
+# Run from the repository root:
+#     python -m scripts.benchmark_spatial_indexes --dsn postgresql://postgres@localhost/postgres [--rows 1000000]
+import argparse
+import asyncio
+import statistics
+import time
+
+import asyncpg
+
+from database_files.migrate import load_migrations
+from sql_object import SqlObject
+
+SCRATCH_SCHEMA = "benchmark_spatial"
+
+CREATE_TABLES = """
+CREATE EXTENSION IF NOT EXISTS postgis;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+DROP SCHEMA IF EXISTS "{schema}" CASCADE;
+CREATE SCHEMA "{schema}";
+
+-- Census rows are appended city by city, as in production
+CREATE TABLE "{schema}".census AS
+SELECT i AS id,
+       (random() * 20000)::int AS population,
+       25.0 + (i / $1::float8) * 20 + random() * 0.01 AS latitude,
+       35.0 + random() * 20 AS longitude,
+       5 + i % 3 AS zoom_level,
+       'city_' || (i * 40 / $1) AS city,
+       'Saudi Arabia' AS country
+FROM generate_series(0, $1 - 1) AS i;
+
+CREATE TABLE "{schema}".saudi_real_estate AS
+SELECT 'https://example.com/' || i AS url,
+       (random() * 5e6)::int::text AS price,
+       'Riyadh' AS city,
+       16.0 + random() * 16 AS latitude,
+       36.0 + random() * 19 AS longitude,
+       (ARRAY['villa_for_sale', 'apartment_for_rent', 'land_for_sale'])[1 + i % 3] AS category
+FROM generate_series(0, $1 - 1) AS i
+ORDER BY random();
+
+CREATE TABLE "{schema}".canada_commercial_properties AS
+SELECT i || ' Main St' AS address,
+       (random() * 5e6)::int::text AS price,
+       'For sale' AS price_description,
+       (ARRAY['Office', 'Retail', 'Industrial Warehouse', 'Retail Plaza'])[1 + i % 4] AS property_type,
+       'Toronto' AS city,
+       '' AS description,
+       '' AS region_stats_summary,
+       42.0 + random() * 14 AS latitude,
+       -140.0 + random() * 88 AS longitude
+FROM generate_series(0, $1 - 1) AS i
+ORDER BY random();
+"""
+
+# The queries before the migrations, with the keyset paging of the current ones
+LEGACY_QUERIES = {
+    "census": """SELECT * FROM "{schema}".census
+        WHERE population is not Null
+        AND latitude BETWEEN $1 AND $2
+        AND longitude BETWEEN $3 AND $4
+        AND zoom_level = $5;
+    """,
+    "saudi_real_estate": """
+        SELECT url, price, city, latitude, longitude, category, ctid::text AS row_id
+        FROM "{schema}".saudi_real_estate
+        WHERE "category" = ANY($1)
+            AND latitude BETWEEN $2 AND $3
+            AND longitude BETWEEN $4 AND $5
+            AND (latitude, longitude, ctid) > ($7::float8, $8::float8, $9::text::tid)
+        ORDER BY latitude, longitude, ctid
+        LIMIT $6;
+    """,
+    "canada_commercial_properties": """
+        SELECT address, price, price_description, property_type, city, description, region_stats_summary, latitude, longitude,
+            ctid::text AS row_id
+        FROM "{schema}".canada_commercial_properties
+        WHERE lower(property_type) LIKE '%' || lower($1) || '%'
+            AND latitude BETWEEN $2 AND $3
+            AND longitude BETWEEN $4 AND $5
+            AND (latitude, longitude, ctid) > ($7::float8, $8::float8, $9::text::tid)
+        ORDER BY latitude, longitude, ctid
+        LIMIT $6;
+    """,
+}
+
+INDEXED_QUERIES = {
+    "census": SqlObject.census_w_bounding_box,
+    "saudi_real_estate": SqlObject.saudi_real_estate_w_bounding_box_and_category,
+    "canada_commercial_properties": SqlObject.canada_commercial_w_bounding_box_and_property_type,
+}
+
+FIRST_PAGE_KEY = (-91.0, -181.0, "(0,0)")
+
+
+def query_args(table, bounding_box):
+    # Bounding boxes are [min_lat, max_lat, min_lng, max_lng], as in storage.py
+    if table == "census":
+        return (*bounding_box, 5)
+    if table == "saudi_real_estate":
+        return (["villa_for_sale"], *bounding_box, 20, *FIRST_PAGE_KEY)
+    return ("warehouse", *bounding_box, 20, *FIRST_PAGE_KEY)
+
+
+def city_bounding_box(table, size_deg):
+    center_lat, center_lng = {
+        "census": (35.0, 45.0),
+        "saudi_real_estate": (24.7, 46.7),
+        "canada_commercial_properties": (43.7, -79.4),
+    }[table]
+    half = size_deg / 2
+    return [center_lat - half, center_lat + half, center_lng - half, center_lng + half]
+
+
+def in_scratch_schema(sql):
+    return sql.replace('"schema_marketplace"', f'"{SCRATCH_SCHEMA}"').replace(
+        "'schema_marketplace.", f"'{SCRATCH_SCHEMA}."
+    )
+
+
+async def time_query(conn, query, args, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await conn.fetch(query, *args)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+async def run(args):
+    conn = await asyncpg.connect(args.dsn)
+    try:
+        print(f"Loading {args.rows} synthetic rows per table into {SCRATCH_SCHEMA}...")
+        # Multi statement scripts cannot take parameters, inline the row count
+        await conn.execute(
+            CREATE_TABLES.format(schema=SCRATCH_SCHEMA).replace("$1", str(int(args.rows)))
+        )
+        await conn.execute("ANALYZE")
+
+        legacy = {}
+        for table, query in LEGACY_QUERIES.items():
+            query = query.format(schema=SCRATCH_SCHEMA)
+            for size in args.box_sizes:
+                bbox = city_bounding_box(table, size)
+                legacy[table, size] = await time_query(
+                    conn, query, query_args(table, bbox), args.repeat
+                )
+
+        started = time.perf_counter()
+        for migration in load_migrations():
+            await conn.execute(in_scratch_schema(migration.sql))
+        await conn.execute("ANALYZE")
+        print(f"Migrations applied in {time.perf_counter() - started:.1f} s")
+
+        print(
+            f"{'table':>30} {'bbox (deg)':>11} {'BETWEEN (ms)':>13} "
+            f"{'indexed (ms)':>13} {'speedup':>9}"
+        )
+        for table, query in INDEXED_QUERIES.items():
+            query = in_scratch_schema(query)
+            for size in args.box_sizes:
+                bbox = city_bounding_box(table, size)
+                indexed = await time_query(conn, query, query_args(table, bbox), args.repeat)
+                before = legacy[table, size]
+                print(
+                    f"{table:>30} {size:>11} {before * 1000:>13.2f} "
+                    f"{indexed * 1000:>13.2f} {before / indexed:>8.1f}x"
+                )
+    finally:
+        if not args.keep:
+            await conn.execute(f'DROP SCHEMA IF EXISTS "{SCRATCH_SCHEMA}" CASCADE')
+        await conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark spatial index migrations")
+    parser.add_argument("--dsn", default="postgresql://postgres@localhost:5432/postgres")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--box-sizes", type=float, nargs="+", default=[0.05, 0.2, 1.0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch schema")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
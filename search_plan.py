@@ -0,0 +1,237 @@
+import re
+from typing import Dict, Iterator, List, Optional
+
+END_OF_PLAN = "end of search plan"
+
+# Entries of plans saved as lists of strings:
+# "{lng}_{lat}_{radius}_{query}_circle={number}[*]_circleNumber={index + 1}[_skip]"
+PLAN_ENTRY_PATTERN = re.compile(
+    r"^(?P<lng>[^_]+)_(?P<lat>[^_]+)_(?P<radius>[^_]+)_(?P<query>.*)"
+    r"_circle=(?P<number>[\d.]+)(?P<center>\*?)"
+    r"_circleNumber=(?P<index>\d+)(?P<skip>_skip)?$"
+)
+
+
+class PlanCircle:
+    """
+    One search of a plan. `number` is the circle's place in the circle
+    hierarchy, e.g. "1.3.2", `parent` the plan index of the circle it
+    subdivides, -1 for the root. The circle's subtree is
+    SearchPlan.preorder[preorder_start:preorder_end].
+    """
+
+    __slots__ = (
+        "number",
+        "parent",
+        "is_center",
+        "lng",
+        "lat",
+        "radius",
+        "preorder_start",
+        "preorder_end",
+    )
+
+    def __init__(
+        self, number: str, parent: int, is_center: bool, lng: float, lat: float, radius: float
+    ):
+        self.number = number
+        self.parent = parent
+        self.is_center = is_center
+        self.lng = lng
+        self.lat = lat
+        self.radius = radius
+        self.preorder_start = 0
+        self.preorder_end = 0
+
+
+class SearchPlan:
+    """
+    The searches of a "full data" request: circles covering the requested
+    area, in the breadth first order they are fetched in, page by page.
+
+    The circle tree is array backed. Circles keep the plan index of their
+    parent, and `preorder` lists the plan indexes depth first, so the
+    subtree of any circle is a contiguous range of it. Skipping the subcircles
+    of a circle marks that range. Skip flags live in a bytearray, which makes
+    copies of a plan cheap; the circles themselves are shared.
+    """
+
+    __slots__ = ("query", "circles", "skipped", "preorder")
+
+    def __init__(self, query: str, circles: List[PlanCircle], skipped: Optional[bytearray] = None):
+        self.query = query
+        self.circles = circles
+        self.skipped = skipped if skipped is not None else bytearray(len(circles))
+        self.preorder = self._link_subtrees()
+
+    def _link_subtrees(self) -> List[int]:
+        children: List[List[int]] = [[] for _ in self.circles]
+        roots = []
+        for index, circle in enumerate(self.circles):
+            (children[circle.parent] if circle.parent >= 0 else roots).append(index)
+
+        preorder = []
+        stack = [(index, False) for index in reversed(roots)]
+        while stack:
+            index, done = stack.pop()
+            circle = self.circles[index]
+            if done:
+                circle.preorder_end = len(preorder)
+                continue
+            circle.preorder_start = len(preorder)
+            preorder.append(index)
+            stack.append((index, True))
+            stack.extend((child, False) for child in reversed(children[index]))
+        return preorder
+
+    def __len__(self) -> int:
+        return len(self.circles)
+
+    def __iter__(self) -> Iterator[PlanCircle]:
+        return iter(self.circles)
+
+    def copy(self) -> "SearchPlan":
+        plan = SearchPlan.__new__(SearchPlan)
+        plan.query = self.query
+        plan.circles = self.circles
+        plan.skipped = bytearray(self.skipped)
+        plan.preorder = self.preorder
+        return plan
+
+    def skip_subcircles(self, index: int):
+        """
+        Marks every circle nested in the circle at `index` as skipped.
+        """
+        circle = self.circles[index]
+        for nested in self.preorder[circle.preorder_start + 1 : circle.preorder_end]:
+            self.skipped[nested] = 1
+
+    def next_unskipped(self, index: int) -> Optional[int]:
+        """
+        Plan index of the first circle after `index` that is not skipped.
+        """
+        position = self.skipped.find(0, index + 1)
+        return None if position < 0 else position
+
+    def dataset_prefix(self, index: int) -> str:
+        """
+        The start shared by the dataset filenames of the circle's searches.
+        """
+        circle = self.circles[index]
+        return f"{circle.lng}_{circle.lat}_{circle.radius}_{self.query}"
+
+    def entry(self, index: int) -> str:
+        circle = self.circles[index]
+        return (
+            f"{self.dataset_prefix(index)}"
+            f"_circle={circle.number}{'*' if circle.is_center else ''}"
+            f"_circleNumber={index + 1}{'_skip' if self.skipped[index] else ''}"
+        )
+
+    def to_entries(self) -> List[str]:
+        return [self.entry(index) for index in range(len(self.circles))] + [END_OF_PLAN]
+
+    def to_columns(self) -> Dict[str, list]:
+        """
+        One list per circle attribute, e.g. for unnest in Postgres. circle_index
+        counts from 1, as circleNumber in entries.
+        """
+        return {
+            "circle_index": list(range(1, len(self.circles) + 1)),
+            "circle_number": [circle.number for circle in self.circles],
+            "parent_number": [
+                self.circles[circle.parent].number if circle.parent >= 0 else None
+                for circle in self.circles
+            ],
+            "is_center": [circle.is_center for circle in self.circles],
+            "center_lng": [circle.lng for circle in self.circles],
+            "center_lat": [circle.lat for circle in self.circles],
+            "radius": [circle.radius for circle in self.circles],
+            "skip": [bool(flag) for flag in self.skipped],
+        }
+
+    @classmethod
+    def _from_circles(cls, query: str, attributes: List[tuple], skipped: bytearray) -> "SearchPlan":
+        # attributes: (number, is_center, lng, lat, radius) in plan order
+        index_of = {number: index for index, (number, *_) in enumerate(attributes)}
+        circles = [
+            PlanCircle(
+                number,
+                index_of.get(number.rpartition(".")[0], -1),
+                is_center,
+                lng,
+                lat,
+                radius,
+            )
+            for number, is_center, lng, lat, radius in attributes
+        ]
+        return cls(query, circles, skipped)
+
+    @classmethod
+    def from_rows(cls, query: str, rows: List[Dict]) -> "SearchPlan":
+        """
+        Plan from rows of to_columns values, e.g. database rows.
+        """
+        rows = sorted(rows, key=lambda row: row["circle_index"])
+        return cls._from_circles(
+            query,
+            [
+                (
+                    row["circle_number"],
+                    row["is_center"],
+                    row["center_lng"],
+                    row["center_lat"],
+                    row["radius"],
+                )
+                for row in rows
+            ],
+            bytearray(bool(row["skip"]) for row in rows),
+        )
+
+    @classmethod
+    def from_entries(cls, entries: List[str]) -> "SearchPlan":
+        """
+        Plan from its list of strings form.
+        """
+        query = None
+        attributes = []
+        skipped = bytearray()
+        for entry in entries:
+            if entry == END_OF_PLAN:
+                continue
+            match = PLAN_ENTRY_PATTERN.match(entry)
+            if match is None:
+                raise ValueError(f"Invalid search plan entry: {entry}")
+            if query is None:
+                query = match["query"]
+            elif match["query"] != query:
+                raise ValueError(f"Search plan entries of different queries: {entry}")
+            attributes.append(
+                (
+                    match["number"],
+                    bool(match["center"]),
+                    float(match["lng"]),
+                    float(match["lat"]),
+                    float(match["radius"]),
+                )
+            )
+            skipped.append(bool(match["skip"]))
+        return cls._from_circles(query or "", attributes, skipped)
+
+    @classmethod
+    def from_circle_hierarchy(cls, circle_hierarchy: Dict, query: str) -> "SearchPlan":
+        """
+        Plan of the circles of cover_circle_with_seven_circles, breadth first.
+        Radiuses of the hierarchy are in km, those of the plan in meters.
+        """
+        attributes = []
+        circles_to_process = [(circle_hierarchy, "1")]
+        position = 0
+        while position < len(circles_to_process):
+            circle, number = circles_to_process[position]
+            position += 1
+            lng, lat = circle["center"]
+            attributes.append((number, circle["is_center"], lng, lat, circle["radius"] * 1000))
+            for i, sub_circle in enumerate(circle["sub_circles"], 1):
+                circles_to_process.append((sub_circle, f"{number}.{i}"))
+        return cls._from_circles(query, attributes, bytearray(len(attributes)))
@@ -0,0 +1,81 @@
+import asyncio
+import copy
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+class _Flight:
+    __slots__ = ("task", "waiters", "leader_waiting", "snapshot")
+
+    def __init__(self):
+        self.task: asyncio.Task = None
+        self.waiters = 0
+        self.leader_waiting = True
+        self.snapshot = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller starts the
+    function and everyone arriving while it is in flight awaits the same
+    result (or exception). Followers receive a deep copy, because callers
+    mutate the datasets they get back, unless `copy_results` is False.
+
+    The function runs in its own task, so a caller that is cancelled, e.g.
+    because its client disconnected, does not cancel the others. The task is
+    cancelled only once no caller is waiting for it any more.
+    """
+
+    def __init__(self, copy_results: bool = True):
+        self.copy_results = copy_results
+        self._in_flight: Dict[str, _Flight] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        flight = self._in_flight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, func))
+            self._in_flight[key] = flight
+        else:
+            self.coalesced += 1
+        flight.waiters += 1
+
+        try:
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done():
+                self._leave(key, flight, leader)
+            raise
+        finally:
+            flight.waiters -= 1
+
+        if leader or not self.copy_results:
+            return result
+        return copy.deepcopy(flight.snapshot)
+
+    def _leave(self, key: str, flight: _Flight, leader: bool):
+        if leader:
+            flight.leader_waiting = False
+        if flight.waiters == 1:
+            # The last caller is gone, nobody needs the result
+            if self._in_flight.get(key) is flight:
+                del self._in_flight[key]
+            flight.task.cancel()
+
+    async def _run(self, key: str, flight: _Flight, func: Callable[[], Awaitable[T]]) -> T:
+        try:
+            result = await func()
+            followers = flight.waiters - (1 if flight.leader_waiting else 0)
+            if self.copy_results and followers:
+                # Followers copy from a snapshot, the leader may mutate its result
+                flight.snapshot = copy.deepcopy(result)
+            return result
+        finally:
+            if self._in_flight.get(key) is flight:
+                del self._in_flight[key]
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._in_flight), "coalesced": self.coalesced}
@@ -0,0 +1,102 @@
+import math
+from typing import Any, Dict, List
+
+import numpy as np
+from geopy.distance import geodesic
+
+from geo_std_utils import chord_length, haversine_distance_m, to_unit_sphere
+
+# Haversine on the mean sphere differs from the WGS-84 geodesic used elsewhere in
+# the backend by at most ~0.56%. Candidates whose haversine distance falls inside
+# this relative band around the query radius are re-checked with geopy, so radius
+# membership is identical to a plain geodesic scan.
+SPHERE_ERROR_MARGIN = 0.007
+
+
+class SpatialGridIndex:
+    """
+    Uniform grid over unit-sphere cartesian coordinates.
+
+    Points are bucketed into cubic cells whose edge is the chord length of
+    `cell_size_m`. A radius query only visits the cells that can contain a
+    match, then refines the candidates with a vectorized haversine check.
+    Working on the unit sphere avoids the longitude distortion of a lat/lng
+    grid, including near the poles and the antimeridian.
+    """
+
+    def __init__(self, lats, lngs, cell_size_m: float):
+        if cell_size_m <= 0:
+            raise ValueError("cell_size_m must be positive")
+
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self.cell_size = chord_length(cell_size_m)
+        self._cells: Dict[tuple, np.ndarray] = {}
+
+        if self.lats.size == 0:
+            return
+
+        cell_keys = np.floor(to_unit_sphere(self.lats, self.lngs) / self.cell_size)
+        cell_keys = cell_keys.astype(np.int64)
+        order = np.lexsort((cell_keys[:, 2], cell_keys[:, 1], cell_keys[:, 0]))
+        sorted_keys = cell_keys[order]
+        boundaries = np.flatnonzero(np.any(np.diff(sorted_keys, axis=0) != 0, axis=1)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(order)]))
+        for start, end in zip(starts, ends):
+            self._cells[tuple(sorted_keys[start])] = order[start:end]
+
+    @classmethod
+    def from_features(cls, features: List[Dict[str, Any]], cell_size_m: float):
+        """
+        Builds an index over GeoJSON point features. Index positions match the
+        order of `features`.
+        """
+        coordinates = np.array(
+            [feature["geometry"]["coordinates"][:2] for feature in features],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        return cls(coordinates[:, 1], coordinates[:, 0], cell_size_m)
+
+    def __len__(self) -> int:
+        return int(self.lats.size)
+
+    def _candidates(self, lat: float, lng: float, radius_m: float) -> np.ndarray:
+        center = to_unit_sphere(lat, lng)
+        reach = math.ceil(chord_length(radius_m * (1 + SPHERE_ERROR_MARGIN)) / self.cell_size)
+        cx, cy, cz = np.floor(center / self.cell_size).astype(np.int64)
+
+        buckets = []
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                for dz in range(-reach, reach + 1):
+                    bucket = self._cells.get((cx + dx, cy + dy, cz + dz))
+                    if bucket is not None:
+                        buckets.append(bucket)
+
+        if not buckets:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(buckets)
+
+    def query_radius(self, lat: float, lng: float, radius_m: float) -> np.ndarray:
+        """
+        Returns the sorted indices of all points within `radius_m` meters
+        (WGS-84 geodesic distance) of the given location.
+        """
+        candidates = self._candidates(lat, lng, radius_m)
+        if candidates.size == 0:
+            return candidates
+
+        distances = haversine_distance_m(
+            lat, lng, self.lats[candidates], self.lngs[candidates]
+        )
+        inside = distances <= radius_m * (1 - SPHERE_ERROR_MARGIN)
+        boundary = ~inside & (distances <= radius_m * (1 + SPHERE_ERROR_MARGIN))
+
+        for position in np.flatnonzero(boundary):
+            idx = candidates[position]
+            inside[position] = (
+                geodesic((lat, lng), (self.lats[idx], self.lngs[idx])).meters <= radius_m
+            )
+
+        return np.sort(candidates[inside])
@@ -19,11 +19,12 @@ class SqlObject:
 
 
 
+    # Bounding boxes are [min_lat, max_lat, min_lng, max_lng] and are matched
+    # against the indexed geom point columns of database_files/migrations
     #Ignoring latitude and longitude (disable virtual square)
     census_w_bounding_box: str = """SELECT * FROM "schema_marketplace".census
                                 WHERE population is not Null 
-                                AND latitude BETWEEN $1 AND $2 
-                                AND longitude BETWEEN $3 AND $4
+                                AND geom && ST_MakeEnvelope($3, $1, $4, $2, 4326)
                                 AND zoom_level = $5;
                                 """
     # population_w_bounding_box: str = """SELECT * FROM "schema_marketplace".housing
@@ -35,22 +36,118 @@ class SqlObject:
     economic_w_bounding_box: str = """SELECT * FROM "schema_marketplace".economic
                                     where latitude BETWEEN $1 AND $2 AND longitude BETWEEN $3 AND $4 LIMIT 20;
                                     """
+    # The property queries page with a keyset on (latitude, longitude, ctid):
+    # $7..$9 are the key of the last row of the previous page. Later pages cost
+    # no more than the first; the (latitude, longitude) indexes of migration
+    # 0007 let the planner read rows in key order instead of sorting every
+    # bounding box match per page
     canada_commercial_w_bounding_box_and_property_type: str = """
-        SELECT address, price, price_description, property_type, city, description, region_stats_summary, latitude, longitude
+        SELECT address, price, price_description, property_type, city, description, region_stats_summary, latitude, longitude,
+            ctid::text AS row_id
         FROM "schema_marketplace".canada_commercial_properties
         WHERE lower(property_type) LIKE '%' || lower($1) || '%'
-            AND latitude BETWEEN $2 AND $3
-            AND longitude BETWEEN $4 AND $5
-        LIMIT $6 OFFSET $7;
+            AND geom && ST_MakeEnvelope($4, $2, $5, $3, 4326)
+            AND (latitude, longitude, ctid) > ($7::float8, $8::float8, $9::text::tid)
+        ORDER BY latitude, longitude, ctid
+        LIMIT $6;
     """
 
     saudi_real_estate_w_bounding_box_and_category: str = """
-        SELECT url, price, city, latitude, longitude, category FROM "schema_marketplace".saudi_real_estate
+        SELECT url, price, city, latitude, longitude, category, ctid::text AS row_id
+        FROM "schema_marketplace".saudi_real_estate
         WHERE "category" = ANY($1)
-            AND latitude BETWEEN $2 AND $3
-            AND longitude BETWEEN $4 AND $5
-        LIMIT $6 OFFSET $7;
+            AND geom && ST_MakeEnvelope($4, $2, $5, $3, 4326)
+            AND (latitude, longitude, ctid) > ($7::float8, $8::float8, $9::text::tid)
+        ORDER BY latitude, longitude, ctid
+        LIMIT $6;
     """
+
+    # The two queries below build the GeoJSON features in Postgres and return
+    # the features array as JSON text. Properties are the row's columns without
+    # the location columns, with whole number strings turned into numbers as
+    # convert_strings_to_ints does for the Python built datasets.
+    census_features_json_w_bounding_box: str = """
+        SELECT COALESCE(json_agg(json_build_object(
+                   'type', 'Feature',
+                   'geometry', json_build_object(
+                       'type', 'Point',
+                       'coordinates', json_build_array(c.longitude::float8, c.latitude::float8)
+                   ),
+                   'properties', (
+                       SELECT COALESCE(jsonb_object_agg(
+                           key,
+                           CASE WHEN jsonb_typeof(value) = 'string' AND value #>> '{}' ~ '^-?[0-9]+$'
+                                THEN to_jsonb((value #>> '{}')::numeric)
+                                ELSE value
+                           END
+                       ), '{}'::jsonb)
+                       FROM jsonb_each(to_jsonb(c) - 'latitude' - 'longitude' - 'city' - 'country' - 'geom')
+                       WHERE jsonb_typeof(value) <> 'null'
+                   )
+               )), '[]')::text AS features,
+               count(*) AS row_count
+        FROM "schema_marketplace".census c
+        WHERE population is not Null
+            AND geom && ST_MakeEnvelope($3, $1, $4, $2, 4326)
+            AND zoom_level = $5;
+    """
+
+    saudi_real_estate_features_json_w_bounding_box_and_category: str = """
+        WITH page AS (
+            SELECT url, price, latitude, longitude, category, ctid AS row_id
+            FROM "schema_marketplace".saudi_real_estate
+            WHERE "category" = ANY($1)
+                AND geom && ST_MakeEnvelope($4, $2, $5, $3, 4326)
+                AND (latitude, longitude, ctid) > ($7::float8, $8::float8, $9::text::tid)
+            ORDER BY latitude, longitude, ctid
+            LIMIT $6
+        )
+        SELECT COALESCE(json_agg(json_build_object(
+                   'type', 'Feature',
+                   'geometry', json_build_object(
+                       'type', 'Point',
+                       'coordinates', json_build_array(longitude::float8, latitude::float8)
+                   ),
+                   'properties', json_build_object(
+                       'url', url,
+                       'price', CASE WHEN price::text ~ '^-?[0-9]+$'
+                                     THEN to_json(price::text::numeric)
+                                     ELSE to_json(price)
+                                END,
+                       'category', category
+                   )
+               ) ORDER BY latitude, longitude, row_id), '[]')::text AS features,
+               count(*) AS row_count,
+               (
+                   SELECT json_build_array(latitude, longitude, row_id::text)
+                   FROM page
+                   ORDER BY latitude DESC, longitude DESC, row_id DESC
+                   LIMIT 1
+               )::text AS last_key
+        FROM page;
+    """
+    create_schema_migrations_table: str = """
+    CREATE SCHEMA IF NOT EXISTS "schema_marketplace";
+
+    CREATE TABLE IF NOT EXISTS "schema_marketplace"."schema_migrations" (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+    load_schema_migration_versions: str = """
+    SELECT version FROM "schema_marketplace"."schema_migrations";
+    """
+    # Runs one migration and records it in a single transaction. The advisory
+    # lock keeps workers starting together from applying it side by side.
+    apply_schema_migration: str = """
+    SELECT pg_advisory_xact_lock(hashtext('schema_marketplace.schema_migrations'));
+    {migration_sql}
+    INSERT INTO "schema_marketplace"."schema_migrations" (version, name)
+    VALUES ({version}, '{name}')
+    ON CONFLICT (version) DO NOTHING;
+    """
+
     create_datasets_table: str = """
     CREATE SCHEMA IF NOT EXISTS "schema_marketplace";
     
@@ -87,4 +184,289 @@ class SqlObject:
     delete_dataset: str = """
     DELETE FROM "schema_marketplace"."datasets"
     WHERE filename = $1;
-    """
\ No newline at end of file
+    """
+
+    load_datasets_with_timestamp: str = """
+    SELECT filename, response_data, created_at
+    FROM "schema_marketplace"."datasets"
+    WHERE filename = ANY($1);
+    """
+
+    # Datasets of a search plan not yet scored by process_plan_popularity
+    load_unscored_plan_datasets: str = """
+    SELECT filename, response_data
+    FROM "schema_marketplace"."datasets"
+    WHERE filename LIKE ANY($1)
+        AND NOT filename = ANY($2)
+    ORDER BY created_at ASC;
+    """
+
+    load_plan_popularity: str = """
+    SELECT state FROM "schema_marketplace"."plan_popularity" WHERE plan_name = $1;
+    """
+
+    # Writes back the rescored datasets ($3 filenames, $4 response_data) and
+    # the plan's scoring state in one statement, so in one transaction and
+    # one round trip however many datasets changed
+    store_plan_popularity: str = """
+    WITH updated AS (
+        UPDATE "schema_marketplace"."datasets" d
+        SET response_data = u.response_data
+        FROM unnest($3::text[], $4::jsonb[]) AS u(filename, response_data)
+        WHERE d.filename = u.filename
+        RETURNING d.filename
+    )
+    INSERT INTO "schema_marketplace"."plan_popularity" (plan_name, state, updated_at)
+    VALUES ($1, $2, CURRENT_TIMESTAMP)
+    ON CONFLICT (plan_name) DO UPDATE SET state = $2, updated_at = CURRENT_TIMESTAMP
+    RETURNING (SELECT count(*) FROM updated) AS updated_count;
+    """
+
+    delete_expired_datasets: str = """
+    DELETE FROM "schema_marketplace"."datasets"
+    WHERE created_at < $1
+    RETURNING filename;
+    """
+
+    # Search plans, see plan_store.PlanStore
+    load_search_plan: str = """
+    SELECT p.query, c.circle_index, c.circle_number, c.is_center,
+        c.center_lng, c.center_lat, c.radius, c.skip
+    FROM "schema_marketplace".search_plans p
+    JOIN "schema_marketplace".search_plan_circles c USING (plan_name)
+    WHERE p.plan_name = $1
+    ORDER BY c.circle_index;
+    """
+
+    # Replaces a plan and its circles in one statement
+    store_search_plan: str = """
+    WITH plan AS (
+        INSERT INTO "schema_marketplace".search_plans (plan_name, query, created_at)
+        VALUES ($1, $2, CURRENT_TIMESTAMP)
+        ON CONFLICT (plan_name) DO UPDATE SET query = $2, created_at = CURRENT_TIMESTAMP
+        RETURNING plan_name
+    ), stale AS (
+        DELETE FROM "schema_marketplace".search_plan_circles
+        WHERE plan_name = $1 AND circle_index <> ALL($3::int[])
+    )
+    INSERT INTO "schema_marketplace".search_plan_circles
+        (plan_name, circle_index, circle_number, parent_number, is_center,
+         center_lng, center_lat, radius, skip)
+    SELECT plan.plan_name, c.*
+    FROM plan, unnest(
+        $3::int[], $4::text[], $5::text[], $6::bool[],
+        $7::float8[], $8::float8[], $9::float8[], $10::bool[]
+    ) AS c
+    ON CONFLICT (plan_name, circle_index) DO UPDATE SET
+        circle_number = EXCLUDED.circle_number,
+        parent_number = EXCLUDED.parent_number,
+        is_center = EXCLUDED.is_center,
+        center_lng = EXCLUDED.center_lng,
+        center_lat = EXCLUDED.center_lat,
+        radius = EXCLUDED.radius,
+        skip = EXCLUDED.skip;
+    """
+
+    # Skips every circle nested in the circle at circle_index $2
+    skip_search_plan_subcircles: str = """
+    UPDATE "schema_marketplace".search_plan_circles c
+    SET skip = true
+    FROM "schema_marketplace".search_plan_circles parent
+    WHERE parent.plan_name = $1 AND parent.circle_index = $2
+        AND c.plan_name = $1
+        AND c.circle_number LIKE parent.circle_number || '.%'
+        AND NOT c.skip;
+    """
+
+    # Job queue, see job_queue.JobQueue and database_files/migrations/0005_job_queue.sql
+    enqueue_job: str = """
+    INSERT INTO "schema_marketplace".jobs (kind, dedupe_key, payload, max_attempts, run_after)
+    VALUES ($1, $2, $3, $4, now() + $5 * interval '1 second')
+    ON CONFLICT (kind, dedupe_key) WHERE status = 'pending' DO NOTHING
+    RETURNING id;
+    """
+
+    # Takes the next due job, or a running one whose lease ran out because its
+    # worker died
+    claim_job: str = """
+    UPDATE "schema_marketplace".jobs j
+    SET status = 'running', attempts = j.attempts + 1, started_at = now()
+    WHERE j.id = (
+        SELECT id FROM "schema_marketplace".jobs
+        WHERE (status = 'pending' AND run_after <= now())
+            OR (status = 'running' AND started_at < now() - $1 * interval '1 second')
+        ORDER BY run_after, id
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING j.id, j.kind, j.payload, j.attempts, j.max_attempts,
+        extract(epoch FROM j.started_at - j.enqueued_at)::float8 AS queued_seconds;
+    """
+
+    complete_job: str = """
+    UPDATE "schema_marketplace".jobs
+    SET status = 'done', finished_at = now(), last_error = NULL
+    WHERE id = $1;
+    """
+
+    # Failed jobs are retried after $3 seconds until they run out of attempts.
+    # A retry is dropped when a newer job of the same key is already pending.
+    fail_job: str = """
+    UPDATE "schema_marketplace".jobs j
+    SET status = CASE
+            WHEN j.attempts >= j.max_attempts THEN 'failed'
+            WHEN EXISTS (
+                SELECT 1 FROM "schema_marketplace".jobs p
+                WHERE p.kind = j.kind AND p.dedupe_key = j.dedupe_key AND p.status = 'pending'
+            ) THEN 'superseded'
+            ELSE 'pending'
+        END,
+        run_after = now() + $3 * interval '1 second',
+        finished_at = now(),
+        last_error = $2
+    WHERE id = $1
+    RETURNING status;
+    """
+
+    purge_finished_jobs: str = """
+    DELETE FROM "schema_marketplace".jobs
+    WHERE status IN ('done', 'failed', 'superseded')
+        AND finished_at < now() - $1 * interval '1 second';
+    """
+
+    job_backlog: str = """
+    SELECT kind, status, count(*) AS jobs,
+        extract(epoch FROM now() - min(enqueued_at))::float8 AS oldest_seconds
+    FROM "schema_marketplace".jobs
+    WHERE status IN ('pending', 'running')
+    GROUP BY kind, status;
+    """
+
+    # Latency is enqueue to finish, over the jobs finished in the last hour
+    job_latency: str = """
+    SELECT kind,
+        count(*) FILTER (WHERE status = 'done') AS done,
+        count(*) FILTER (WHERE status = 'failed') AS failed,
+        percentile_cont(0.5) WITHIN GROUP (
+            ORDER BY extract(epoch FROM finished_at - enqueued_at)
+        ) FILTER (WHERE status = 'done') AS p50_seconds,
+        percentile_cont(0.95) WITHIN GROUP (
+            ORDER BY extract(epoch FROM finished_at - enqueued_at)
+        ) FILTER (WHERE status = 'done') AS p95_seconds
+    FROM "schema_marketplace".jobs
+    WHERE status IN ('done', 'failed') AND finished_at > now() - interval '1 hour'
+    GROUP BY kind;
+    """
+
+    count_dataset_features: str = """
+    SELECT filename, COALESCE(jsonb_array_length(response_data->'features'), 0) AS feature_count
+    FROM "schema_marketplace"."datasets"
+    WHERE filename = ANY($1)
+        AND created_at >= $2;
+    """
+
+    # The features of a dataset as JSON text, one row each in array order. The
+    # document is detoasted and parsed once, however the rows are chunked.
+    load_dataset_features: str = """
+    SELECT feature.value::text AS feature
+    FROM "schema_marketplace"."datasets",
+        jsonb_array_elements(response_data->'features') WITH ORDINALITY AS feature(value, position)
+    WHERE filename = $1
+    ORDER BY feature.position;
+    """
+
+    create_route_cache_table: str = """
+    CREATE SCHEMA IF NOT EXISTS "schema_marketplace";
+
+    CREATE TABLE IF NOT EXISTS "schema_marketplace"."route_cache" (
+        cache_key TEXT PRIMARY KEY,
+        route_data JSONB,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+
+    store_routes: str = """
+    INSERT INTO "schema_marketplace"."route_cache"
+    (cache_key, route_data, created_at)
+    SELECT cache_key, route_data, $3
+    FROM unnest($1::text[], $2::jsonb[]) AS route(cache_key, route_data)
+    ON CONFLICT (cache_key)
+    DO UPDATE SET
+        route_data = EXCLUDED.route_data,
+        created_at = EXCLUDED.created_at;
+    """
+
+    load_routes: str = """
+    SELECT cache_key, route_data
+    FROM "schema_marketplace"."route_cache"
+    WHERE cache_key = ANY($1)
+        AND created_at >= $2;
+    """
+
+    create_api_quota_buckets_table: str = """
+    CREATE SCHEMA IF NOT EXISTS "schema_marketplace";
+
+    CREATE TABLE IF NOT EXISTS "schema_marketplace"."api_quota_buckets" (
+        api TEXT PRIMARY KEY,
+        tokens DOUBLE PRECISION NOT NULL,
+        granted BOOLEAN NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL
+    );
+    """
+
+    # Refills the bucket for the time elapsed since the last call and takes one
+    # token if available. The row lock of the upsert serialises workers, and
+    # "granted" reports whether this call got the token. The clock is read once,
+    # as the proposed updated_at, and the refill is computed once, so granted and
+    # the tokens left always agree. A call that waited on the lock may have read
+    # the clock before the call it waited for, hence the GREATEST.
+    take_api_quota_token: str = """
+    INSERT INTO "schema_marketplace"."api_quota_buckets" AS bucket
+    (api, tokens, granted, updated_at)
+    VALUES ($1, $2::float8 - 1, TRUE, clock_timestamp())
+    ON CONFLICT (api)
+    DO UPDATE SET
+        (granted, tokens) = (
+            SELECT refill.tokens >= 1,
+                refill.tokens - CASE WHEN refill.tokens >= 1 THEN 1 ELSE 0 END
+            FROM (
+                SELECT LEAST(
+                    $2::float8,
+                    bucket.tokens + GREATEST(
+                        EXTRACT(EPOCH FROM EXCLUDED.updated_at - bucket.updated_at)::float8, 0
+                    ) * $3::float8
+                ) AS tokens
+            ) AS refill
+        ),
+        updated_at = GREATEST(bucket.updated_at, EXCLUDED.updated_at)
+    RETURNING granted, tokens;
+    """
+
+    create_dataset_fetch_locks_table: str = """
+    CREATE SCHEMA IF NOT EXISTS "schema_marketplace";
+
+    CREATE TABLE IF NOT EXISTS "schema_marketplace"."dataset_fetch_locks" (
+        filename TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        locked_until TIMESTAMPTZ NOT NULL
+    );
+    """
+
+    # Takes the lease on a dataset filename unless another worker holds an
+    # unexpired one; returns a row only when the lease was taken.
+    acquire_dataset_fetch_lock: str = """
+    INSERT INTO "schema_marketplace"."dataset_fetch_locks" AS lock
+    (filename, holder, locked_until)
+    VALUES ($1, $2, clock_timestamp() + make_interval(secs => $3::float8))
+    ON CONFLICT (filename)
+    DO UPDATE SET
+        holder = EXCLUDED.holder,
+        locked_until = EXCLUDED.locked_until
+    WHERE lock.locked_until < clock_timestamp()
+    RETURNING filename;
+    """
+
+    release_dataset_fetch_lock: str = """
+    DELETE FROM "schema_marketplace"."dataset_fetch_locks"
+    WHERE filename = $1 AND holder = $2;
+    """
@@ -1,7 +1,8 @@
 import logging
 import uuid
 from datetime import datetime, date, timedelta, timezone
-from typing import Any, Dict, Tuple, Optional, List
+from typing import Any, AsyncIterator, Dict, Tuple, Optional, List
+import base64
 import json
 import os
 
@@ -9,7 +10,6 @@ from fastapi import HTTPException, status
 from pydantic import BaseModel
 from backend_common.auth import load_user_profile
 from backend_common.database import Database
-import pandas as pd
 from sql_object import SqlObject
 from all_types.myapi_dtypes import ReqFetchDataset
 from backend_common.logging_wrapper import apply_decorator_to_module
@@ -18,6 +18,9 @@ import asyncpg
 from backend_common.background import get_background_tasks
 import orjson
 from popularity_algo import create_plan, get_plan
+from job_queue import JobQueue
+from dataset_cache import DATASET_CACHE, DATASET_EXPIRY
+from geojson_builder import records_to_features
 
 logging.basicConfig(
     level=logging.INFO,
@@ -52,6 +55,8 @@ CENSUS_FILE_MAPPING = {
 }
 
 DEFAULT_LIMIT = 20
+# Keyset of the property queries before any row: (latitude, longitude, ctid)
+FIRST_PAGE_KEY = [-91.0, -181.0, "(0,0)"]
 
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
@@ -153,6 +158,17 @@ def make_dataset_filename_part(req: ReqFetchDataset, included_types: List[str],
     exclude_str = "_".join(sorted(excluded_types))
     type_string = f"{include_str}_excluding_{exclude_str}" if exclude_str else include_str
     return f"{cord_string}_{type_string}"
+
+
+def make_route_cache_key(origin: str, destination: str, precision: int) -> str:
+    """ Cache key for a route, with "lat,lng" endpoints rounded to `precision` decimals. """
+    def rounded(point: str) -> str:
+        lat, lng = point.split(",")
+        return f"{round(float(lat), precision)},{round(float(lng), precision)}"
+
+    return f"{rounded(origin)}|{rounded(destination)}"
+
+
 async def search_metastore_for_string(string_search: str) -> Optional[Dict]:
     """
     Searches the metastore for a given string and returns the corresponding data if found.
@@ -189,6 +205,22 @@ async def fetch_dataset_id(lyr_id: str) -> Tuple[str, Dict]:
     # )
 
 
+async def fetch_dataset_ids(lyr_ids: List[str]) -> Dict[str, Tuple[str, Dict]]:
+    """
+    Resolves the dataset ID of every layer in `lyr_ids` from a single read of
+    the dataset layer matching. Layers without a dataset are left out.
+    """
+    wanted = set(lyr_ids)
+    dataset_layer_matching = await load_dataset_layer_matching()
+
+    found = {}
+    for d_id, dataset_info in dataset_layer_matching.items():
+        for lyr_id in dataset_info["prdcer_lyrs"]:
+            if lyr_id in wanted and lyr_id not in found:
+                found[lyr_id] = (d_id, dataset_info)
+    return found
+
+
 def fetch_layer_owner(prdcer_lyr_id: str) -> str:
     """
     Fetches the owner of a layer based on the producer layer ID.
@@ -651,6 +683,7 @@ async def store_data_resp(req: ReqFetchDataset, dataset: Dict, file_name: str) -
             json.dumps(dataset),
             datetime.utcnow(),
         )
+        DATASET_CACHE.invalidate(file_name)
 
         return file_name
 
@@ -660,6 +693,213 @@ async def store_data_resp(req: ReqFetchDataset, dataset: Dict, file_name: str) -
         return await store_data_resp(req, dataset, file_name)
 
 
+async def store_cached_routes(routes: Dict[str, Dict]) -> None:
+    """
+    Stores many cache entries, keyed by cache key, with a single statement.
+    """
+    if not routes:
+        return
+    try:
+        await Database.execute(
+            SqlObject.store_routes,
+            list(routes),
+            [json.dumps(route_data) for route_data in routes.values()],
+            datetime.utcnow(),
+        )
+    except asyncpg.exceptions.UndefinedTableError:
+        await Database.execute(SqlObject.create_route_cache_table)
+        await store_cached_routes(routes)
+
+
+async def load_cached_routes(cache_keys: List[str], max_age: timedelta) -> Dict[str, Dict]:
+    """
+    Loads all cached routes younger than `max_age` for the given keys in one query.
+    """
+    if not cache_keys:
+        return {}
+    try:
+        rows = await Database.fetch(
+            SqlObject.load_routes, cache_keys, datetime.utcnow() - max_age
+        )
+    except asyncpg.exceptions.UndefinedTableError:
+        return {}
+    return {row["cache_key"]: orjson.loads(row["route_data"]) for row in rows}
+
+
+async def acquire_dataset_fetch_lock(filename: str, holder: str, lease_seconds: float) -> bool:
+    """
+    Tries to take the cross-worker fetch lease on a dataset filename.
+    """
+    try:
+        row = await Database.fetchrow(
+            SqlObject.acquire_dataset_fetch_lock, filename, holder, lease_seconds
+        )
+    except asyncpg.exceptions.UndefinedTableError:
+        await Database.execute(SqlObject.create_dataset_fetch_locks_table)
+        return await acquire_dataset_fetch_lock(filename, holder, lease_seconds)
+    return row is not None
+
+
+async def release_dataset_fetch_lock(filename: str, holder: str) -> None:
+    await Database.execute(SqlObject.release_dataset_fetch_lock, filename, holder)
+
+
+async def take_shared_quota_token(api: str, rate: float, capacity: float) -> Tuple[bool, float]:
+    """
+    Takes one token from the Postgres-backed bucket of `api`.
+    Returns whether a token was granted and the tokens left in the bucket.
+    """
+    try:
+        row = await Database.fetchrow(SqlObject.take_api_quota_token, api, capacity, rate)
+    except asyncpg.exceptions.UndefinedTableError:
+        await Database.execute(SqlObject.create_api_quota_buckets_table)
+        return await take_shared_quota_token(api, rate, capacity)
+    return row["granted"], row["tokens"]
+
+
+async def load_datasets_response_data(filenames: List[str]) -> Dict[str, str]:
+    """
+    Returns the response_data JSON stored under each of `filenames`, through the
+    in-process dataset cache. Rows missing from the cache are read with a single
+    query and rows past the dataset expiry are deleted with a single statement.
+    Filenames without a (live) row are left out.
+    """
+    found = {}
+    missing = []
+    for filename in dict.fromkeys(filenames):
+        cached = DATASET_CACHE.get(filename)
+        if cached is not None:
+            found[filename] = cached[0]
+        else:
+            missing.append(filename)
+    if not missing:
+        return found
+
+    generation = DATASET_CACHE.generation
+    rows = await Database.fetch(SqlObject.load_datasets_with_timestamp, missing)
+    oldest_allowed = datetime.now(timezone.utc) - DATASET_EXPIRY
+    expired = []
+    for row in rows:
+        created_at = row["created_at"]
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        if created_at < oldest_allowed:
+            expired.append(row["filename"])
+            continue
+        response_data = row["response_data"]
+        if response_data:
+            DATASET_CACHE.put(row["filename"], response_data, created_at, generation)
+            found[row["filename"]] = response_data
+
+    if expired:
+        await JobQueue.enqueue("dataset_expiry", {}, dedupe_key="dataset_expiry")
+    return found
+
+
+@JobQueue.handler("dataset_expiry")
+async def delete_expired_datasets(payload: Dict) -> None:
+    """
+    Deletes every stored dataset past DATASET_EXPIRY, not only those a read
+    came across.
+    """
+    rows = await Database.fetch(
+        SqlObject.delete_expired_datasets, datetime.utcnow() - DATASET_EXPIRY
+    )
+    for row in rows:
+        DATASET_CACHE.invalidate(row["filename"])
+    logger.info(f"Deleted {len(rows)} expired datasets")
+
+
+async def load_dataset_response_data(filename: str) -> Optional[str]:
+    """
+    Returns the response_data JSON stored under `filename`, or None.
+    """
+    return (await load_datasets_response_data([filename])).get(filename)
+
+
+def dataset_cache_metrics() -> Dict[str, Any]:
+    return DATASET_CACHE.metrics()
+
+
+async def plan_page_filenames(dataset_id: str) -> Optional[List[str]]:
+    """
+    Returns the dataset filenames of all plan pages up to the page in
+    `dataset_id` (a plan page token), in page order, or None when the plan
+    does not exist.
+    """
+    # Extract plan name and page number
+    plan_name, page_number = dataset_id.split("@#$")
+    dataset_prefix, plan_name = plan_name.split("page_token=")
+    page_number = int(page_number)
+    # Load the plan
+    plan = await get_plan(plan_name)
+    if not plan:
+        return None
+    # if not plan:
+    #     city_info=load_country_city()
+    #     category = plan_name.split("_")[1]
+    #     country_name = plan_name.split("_")[2]
+    #     city_name = plan_name.split("_")[3]
+
+    #     lng=city_info[f"{country_name}"][f"{city_name}"]["lat"]
+    #     lat=city_info[f"{country_name}"][f"{city_name}"]["lat"]
+    #     radius=ReqFetchDataset.model_fields["radius"].default
+    #     boolean_query=category
+    #     text_search=""
+    #     plan = await create_plan(
+    #         lng, lat, radius, boolean_query, text_search
+    #     )
+
+
+    category = plan.query.replace(" ", "_")
+    new_plan = []
+    for i, circle in enumerate(plan.circles[:page_number]):
+        prefix = f"{circle.lng}_{circle.lat}_{circle.radius}_{category}"
+        if i == 0:
+            new_item = f"{prefix}_token="
+        else:
+            new_item = f"{prefix}_token=page_token={plan_name}@#${i}"
+
+        new_plan.append(new_item)
+
+    return new_plan
+
+
+async def open_dataset_feature_stream(
+    dataset_id: str, fetch_full_plan_datasets=False, chunk_size: int = 1000
+) -> Tuple[int, AsyncIterator[List[str]]]:
+    """
+    Streams the features of a stored dataset straight from the JSONB column
+    as JSON text that is never decoded here, `chunk_size` features at a time.
+    Each stored dataset is read with a single query, so the document is parsed
+    once; plan datasets are read page by page in page order, like load_dataset.
+
+    Returns:
+        The total number of features and an async iterator of feature chunks.
+    """
+    if "plan" in dataset_id and fetch_full_plan_datasets:
+        filenames = await plan_page_filenames(dataset_id) or []
+    else:
+        filenames = [dataset_id]
+
+    rows = await Database.fetch(
+        SqlObject.count_dataset_features,
+        list(dict.fromkeys(filenames)),
+        datetime.now(timezone.utc) - DATASET_EXPIRY,
+    )
+    feature_counts = {row["filename"]: row["feature_count"] for row in rows}
+
+    async def chunks() -> AsyncIterator[List[str]]:
+        for filename in filenames:
+            if not feature_counts.get(filename):
+                continue
+            rows = await Database.fetch(SqlObject.load_dataset_features, filename)
+            for start in range(0, len(rows), chunk_size):
+                yield [row["feature"] for row in rows[start : start + chunk_size]]
+
+    return sum(feature_counts.get(filename, 0) for filename in filenames), chunks()
+
+
 async def load_dataset(dataset_id: str, fetch_full_plan_datasets=False) -> Dict:
     """
     Loads a dataset from file based on its ID.
@@ -671,68 +911,23 @@ async def load_dataset(dataset_id: str, fetch_full_plan_datasets=False) -> Dict:
     # using the page number and the plan , load and concatenate all datasets from the plan that have page number equal to that number or less
     # each dataset is a list of dictionaries , so just extend the list  and save the big final list into dataset variable
     # else load dataset with dataset id
-    three_months_ago = datetime.now(timezone.utc) - timedelta(days=90)
-    
 
     
     if "plan" in dataset_id and fetch_full_plan_datasets:
-        # Extract plan name and page number
-        plan_name, page_number = dataset_id.split("@#$")
-        dataset_prefix, plan_name = plan_name.split("page_token=")
-        page_number = int(page_number)
-        # Load the plan
-        plan = await get_plan(plan_name)
-        if not plan:
+        page_ids = await plan_page_filenames(dataset_id)
+        if page_ids is None:
             return {}
-        # if not plan:
-        #     city_info=load_country_city()
-        #     category = plan_name.split("_")[1]
-        #     country_name = plan_name.split("_")[2]
-        #     city_name = plan_name.split("_")[3]
-
-        #     lng=city_info[f"{country_name}"][f"{city_name}"]["lat"]
-        #     lat=city_info[f"{country_name}"][f"{city_name}"]["lat"]
-        #     radius=ReqFetchDataset.model_fields["radius"].default
-        #     boolean_query=category
-        #     text_search=""
-        #     plan = await create_plan(
-        #         lng, lat, radius, boolean_query, text_search
-        #     )
-
-
-        #TODO this is a temp fix because this whole thing needs to be redone
-        new_plan = []
-        for i, item in enumerate(plan):
-            if item == "end of search plan":
-                continue
-                
-            first_parts = item.split('_', 3)
-            lat, lon, value, rest = first_parts
-            category = rest.split('_circle=')[0].replace(" ", "_")
-            
-            if i == 0:
-                new_item = f"{lat}_{lon}_{value}_{category}_token="
-            else:
-                new_item = f"{lat}_{lon}_{value}_{category}_token=page_token={plan_name}@#${i}"
-            
-            new_plan.append(new_item)
 
         # Initialize an empty list to store all datasets
         all_features = []
         feat_collec = {"type": "FeatureCollection", "features": []}
         properties_set = set()  # Initialize a set to store unique properties
-        for i in range(page_number):
-            dataset_id = new_plan[i]  # Get the formatted item for this page
-            json_content = await Database.fetchrow(SqlObject.load_dataset_with_timestamp, dataset_id)
-            if json_content:
-                created_at = json_content.get("created_at")
-            if created_at.tzinfo is None:
-                created_at = created_at.replace(tzinfo=timezone.utc)
-            if created_at and created_at < three_months_ago:
-                await Database.execute(SqlObject.delete_dataset, dataset_id)
-                json_content= None
-            if json_content:
-                dataset = orjson.loads(json_content.get("response_data", "{}")) 
+        # Read every page at once, then merge them in page order
+        pages = await load_datasets_response_data(page_ids)
+        for dataset_id in page_ids:
+            response_data = pages.get(dataset_id)
+            if response_data:
+                dataset = orjson.loads(response_data)
                 all_features.extend(dataset.get("features", [])) 
                 properties_set.update(dataset.get("properties", []))            
         if all_features:
@@ -741,21 +936,52 @@ async def load_dataset(dataset_id: str, fetch_full_plan_datasets=False) -> Dict:
             feat_collec["properties"] = list(properties_set)
     else:
         feat_collec=None
-        json_content = await Database.fetchrow(SqlObject.load_dataset_with_timestamp, dataset_id)
-        if json_content:
-            created_at = json_content.get("created_at")
-            if created_at.tzinfo is None:
-                created_at = created_at.replace(tzinfo=timezone.utc)
-            if created_at and created_at < three_months_ago:
-                await Database.execute(SqlObject.delete_dataset, dataset_id)
-                json_content= None
-
-        if json_content:
-            feat_collec = orjson.loads(json_content.get("response_data", "{}")) 
+        response_data = await load_dataset_response_data(dataset_id)
+        if response_data:
+            feat_collec = orjson.loads(response_data)
         
     return feat_collec
 
 
+def encode_page_token(last_key: List) -> str:
+    """
+    Opaque next_page_token for a keyset paged query, from the key of the
+    last row returned.
+    """
+    return base64.urlsafe_b64encode(orjson.dumps(last_key)).decode().rstrip("=")
+
+
+def decode_page_token(page_token: str) -> List:
+    """
+    Keyset to continue a paged query from. An empty token, or "0", is the
+    first page.
+    """
+    if not page_token or page_token == "0":
+        return FIRST_PAGE_KEY
+    try:
+        padding = "=" * (-len(page_token) % 4)
+        latitude, longitude, row_id = orjson.loads(
+            base64.urlsafe_b64decode(page_token + padding)
+        )
+        return [float(latitude), float(longitude), str(row_id)]
+    except (ValueError, TypeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid page token"
+        ) from e
+
+
+def make_next_page_token(rows: List) -> str:
+    """
+    next_page_token after a page of keyset paged rows, empty on the last page.
+    """
+    if len(rows) < DEFAULT_LIMIT:
+        return ""
+    last = rows[-1]
+    return encode_page_token(
+        [float(last["latitude"]), float(last["longitude"]), last["row_id"]]
+    )
+
+
 async def get_census_dataset_from_storage(
     filename: str,
     action: str,
@@ -783,32 +1009,9 @@ async def get_census_dataset_from_storage(
         *request_location._bounding_box, 
         request_location.zoom_level
     )
-    city_df = pd.DataFrame([dict(record) for record in city_data], dtype=object)
-    # city_df = pd.DataFrame(city_data, dtype=object)
-
-    # Convert to GeoJSON format
-    features = []
-    for _, row in city_df.iterrows():
-        # Parse coordinates from Degree column
-        coordinates = [float(row["longitude"]), float(row["latitude"])]
 
-        # Create properties dict excluding certain columns
-        columns_to_drop = ["latitude", "longitude", "city"]
-        if "country" in row:
-            columns_to_drop.append("country")
-
-        row = row.dropna()
-        properties = row.drop(columns_to_drop).to_dict()
-
-        if len(row) == 0:
-            continue
-
-        feature = {
-            "type": "Feature",
-            "geometry": {"type": "Point", "coordinates": coordinates},
-            "properties": properties,
-        }
-        features.append(feature)
+    # Convert to GeoJSON format, census rows leave out their empty columns
+    features = records_to_features(city_data, drop_nulls=True, excluded_columns=["geom"])
 
     # Create GeoJSON structure similar to Google Maps API response
     geojson_data = {"type": "FeatureCollection", "features": features}
@@ -833,12 +1036,6 @@ async def get_commercial_properties_dataset_from_storage(
     """
     data_type = request_location.included_types[0]
 
-    page_number = 0
-    if next_page_token:
-        page_number = int(next_page_token)
-
-    offset = page_number * DEFAULT_LIMIT
-
     query = SqlObject.canada_commercial_w_bounding_box_and_property_type
 
     city_data = await Database.fetch(
@@ -846,28 +1043,11 @@ async def get_commercial_properties_dataset_from_storage(
         data_type.replace("_", " "),
         *request_location._bounding_box,
         DEFAULT_LIMIT,
-        offset,
+        *decode_page_token(next_page_token),
     )
-    city_df = pd.DataFrame([dict(record) for record in city_data])
 
     # Convert to GeoJSON format
-    features = []
-    for _, row in city_df.iterrows():
-        # Parse coordinates from Degree column
-        coordinates = [float(row["longitude"]), float(row["latitude"])]
-
-        # Create properties dict excluding certain columns
-        columns_to_drop = ["latitude", "longitude", "city"]
-        if "country" in row:
-            columns_to_drop.append("country")
-        properties = row.drop(columns_to_drop).to_dict()
-
-        feature = {
-            "type": "Feature",
-            "geometry": {"type": "Point", "coordinates": coordinates},
-            "properties": properties,
-        }
-        features.append(feature)
+    features = records_to_features(city_data, excluded_columns=["row_id"])
 
     # Create GeoJSON structure similar to Google Maps API response
     geojson_data = {"type": "FeatureCollection", "features": features}
@@ -876,10 +1056,7 @@ async def get_commercial_properties_dataset_from_storage(
     if not filename:
         filename = f"commercial_canada_{request_location.city_name.lower()}_{data_type}"
 
-    if len(features) < DEFAULT_LIMIT:
-        next_page_token = ""
-    else:
-        next_page_token = str(page_number + 1)
+    next_page_token = make_next_page_token(city_data)
 
     return geojson_data, filename, next_page_token
 
@@ -900,37 +1077,18 @@ async def get_real_estate_dataset_from_storage(
     # filtered_categories = [item for item in realEstateData if item in req.included_types]
     # final_categories = [item for item in filtered_categories if item not in req.excludedTypes]
 
-    page_number = 0
-    if next_page_token:
-        page_number = int(next_page_token)
-
-    offset = page_number * DEFAULT_LIMIT
     query = SqlObject.saudi_real_estate_w_bounding_box_and_category
 
     city_data = await Database.fetch(
-        query, data_type, *request_location._bounding_box, DEFAULT_LIMIT, offset
+        query,
+        data_type,
+        *request_location._bounding_box,
+        DEFAULT_LIMIT,
+        *decode_page_token(next_page_token),
     )
 
-    city_df = pd.DataFrame([dict(record) for record in city_data])
-
     # Convert to GeoJSON format
-    features = []
-    for _, row in city_df.iterrows():
-        # Parse coordinates from Degree column
-        coordinates = [float(row["longitude"]), float(row["latitude"])]
-
-        # Create properties dict excluding certain columns
-        columns_to_drop = ["latitude", "longitude", "city"]
-        if "country" in row:
-            columns_to_drop.append("country")
-        properties = row.drop(columns_to_drop).to_dict()
-
-        feature = {
-            "type": "Feature",
-            "geometry": {"type": "Point", "coordinates": coordinates},
-            "properties": properties,
-        }
-        features.append(feature)
+    features = records_to_features(city_data, excluded_columns=["row_id"])
 
     # Create GeoJSON structure similar to Google Maps API response
     geojson_data = {"type": "FeatureCollection", "features": features}
@@ -939,12 +1097,66 @@ async def get_real_estate_dataset_from_storage(
     if not filename:
         filename = f"saudi_real_estate_{request_location.city_name.lower()}_{data_type}"
 
-    if len(features) < DEFAULT_LIMIT:
+    next_page_token = make_next_page_token(city_data)
+
+    return geojson_data, filename, next_page_token
+
+
+async def get_census_features_json_from_storage(
+    filename: str,
+    action: str,
+    request_location: ReqFetchDataset,
+    next_page_token: str,
+    data_type: str,
+) -> Tuple[str, int, str, str]:
+    """
+    get_census_dataset_from_storage with the features built by Postgres.
+    Returns the features array as JSON text, the number of features, the
+    filename and the next page token.
+    """
+    row = await Database.fetchrow(
+        SqlObject.census_features_json_w_bounding_box,
+        *request_location._bounding_box,
+        request_location.zoom_level,
+    )
+
+    if not filename:
+        filename = f"census_{request_location.city_name.lower()}_{data_type}"
+
+    return row["features"], row["row_count"], filename, next_page_token
+
+
+async def get_real_estate_features_json_from_storage(
+    filename: str,
+    action: str,
+    request_location: ReqFetchDataset,
+    next_page_token: str,
+    data_type: str,
+) -> Tuple[str, int, str, str]:
+    """
+    get_real_estate_dataset_from_storage with the features built by Postgres.
+    Returns the features array as JSON text, the number of features, the
+    filename and the next page token.
+    """
+    data_type = request_location._included_types
+
+    row = await Database.fetchrow(
+        SqlObject.saudi_real_estate_features_json_w_bounding_box_and_category,
+        data_type,
+        *request_location._bounding_box,
+        DEFAULT_LIMIT,
+        *decode_page_token(next_page_token),
+    )
+
+    if not filename:
+        filename = f"saudi_real_estate_{request_location.city_name.lower()}_{data_type}"
+
+    if row["row_count"] < DEFAULT_LIMIT:
         next_page_token = ""
     else:
-        next_page_token = str(page_number + 1)
+        next_page_token = encode_page_token(orjson.loads(row["last_key"]))
 
-    return geojson_data, filename, next_page_token
+    return row["features"], row["row_count"], filename, next_page_token
 
 
 async def fetch_db_categories_by_lat_lng(bounding_box: list[float]) -> Dict:
@@ -0,0 +1,59 @@
+import json
+import math
+
+import numpy as np
+
+from geojson_builder import columns_to_features, features_envelope_json, records_to_features
+
+
+def test_records_to_features_drops_location_columns_and_nulls():
+    records = [
+        {"price": 10, "city": "Riyadh", "latitude": 24.7, "longitude": 46.6, "url": None},
+        {"price": math.nan, "city": "Riyadh", "latitude": 24.8, "longitude": 46.7, "url": "u"},
+        {"price": 30, "city": "Riyadh", "latitude": None, "longitude": 46.7, "url": "v"},
+    ]
+
+    assert records_to_features(records, drop_nulls=True) == [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [46.6, 24.7]},
+            "properties": {"price": 10},
+        },
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [46.7, 24.8]},
+            "properties": {"url": "u"},
+        },
+    ]
+    assert records_to_features(records)[0]["properties"] == {"price": 10, "url": None}
+    assert records_to_features([]) == []
+
+
+def test_columns_to_features_returns_native_values():
+    features = columns_to_features(
+        {
+            "latitude": np.array([24.7]),
+            "longitude": np.array([46.6]),
+            "population": np.array([1200], dtype=np.int64),
+            "country": np.array(["Saudi Arabia"]),
+        }
+    )
+    assert features[0]["properties"] == {"population": 1200}
+    assert type(features[0]["properties"]["population"]) is int
+
+
+def test_features_envelope_json_layout():
+    body = features_envelope_json(
+        "Request received", "id-1", {"layer_id": "l1", "records_count": 2}, '[{"a":1},{"b":2}]'
+    )
+    assert body == (
+        b'{"message":"Request received","request_id":"id-1",'
+        b'"data":{"layer_id":"l1","records_count":2,"features":[{"a":1},{"b":2}]}}'
+    )
+    assert json.loads(body)["data"]["features"] == [{"a": 1}, {"b": 2}]
+
+    assert json.loads(features_envelope_json("m", "id", {}, "[]")) == {
+        "message": "m",
+        "request_id": "id",
+        "data": {"features": []},
+    }
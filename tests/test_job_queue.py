@@ -0,0 +1,222 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("backend_common")
+
+import job_queue  # noqa: E402
+from job_queue import JobQueue  # noqa: E402
+from sql_object import SqlObject  # noqa: E402
+
+
+class FakeDatabase:
+    """
+    In-memory jobs table following the job queue statements of SqlObject,
+    with a clock that only moves when the test says so.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.jobs = {}
+        self.calls = []
+
+    async def fetchrow(self, query, *args):
+        self.calls.append((query, args))
+        if query == SqlObject.enqueue_job:
+            kind, dedupe_key, payload, max_attempts, delay = args
+            if dedupe_key is not None and any(
+                job["kind"] == kind and job["dedupe_key"] == dedupe_key and job["status"] == "pending"
+                for job in self.jobs.values()
+            ):
+                return None
+            job_id = len(self.jobs) + 1
+            self.jobs[job_id] = {
+                "id": job_id,
+                "kind": kind,
+                "dedupe_key": dedupe_key,
+                "payload": payload,
+                "status": "pending",
+                "attempts": 0,
+                "max_attempts": max_attempts,
+                "run_after": self.now + delay,
+                "enqueued_at": self.now,
+                "started_at": None,
+            }
+            return {"id": job_id}
+        if query == SqlObject.claim_job:
+            (lease,) = args
+            due = [
+                job
+                for job in self.jobs.values()
+                if (job["status"] == "pending" and job["run_after"] <= self.now)
+                or (job["status"] == "running" and job["started_at"] < self.now - lease)
+            ]
+            if not due:
+                return None
+            job = min(due, key=lambda job: (job["run_after"], job["id"]))
+            job.update(status="running", attempts=job["attempts"] + 1, started_at=self.now)
+            return {
+                **{key: job[key] for key in ("id", "kind", "payload", "attempts", "max_attempts")},
+                "queued_seconds": job["started_at"] - job["enqueued_at"],
+            }
+        if query == SqlObject.fail_job:
+            job_id, error, retry_after = args
+            job = self.jobs[job_id]
+            if job["attempts"] >= job["max_attempts"]:
+                status = "failed"
+            elif any(
+                other["kind"] == job["kind"]
+                and other["dedupe_key"] == job["dedupe_key"]
+                and other["status"] == "pending"
+                for other in self.jobs.values()
+            ):
+                status = "superseded"
+            else:
+                status = "pending"
+            job.update(status=status, run_after=self.now + retry_after, last_error=error)
+            return {"status": status}
+        raise AssertionError(f"Unexpected query {query}")
+
+    async def execute(self, query, *args):
+        self.calls.append((query, args))
+        if query == SqlObject.complete_job:
+            self.jobs[args[0]]["status"] = "done"
+            return
+        if query == SqlObject.purge_finished_jobs:
+            raise ConnectionError("connection reset")
+        raise AssertionError(f"Unexpected query {query}")
+
+
+@pytest.fixture
+def database(monkeypatch):
+    fake = FakeDatabase()
+    monkeypatch.setattr(job_queue, "Database", fake)
+    monkeypatch.setattr(JobQueue, "_handlers", {})
+    monkeypatch.setattr(JobQueue, "_wakeup", None)
+    monkeypatch.setattr(JobQueue, "_completed", 0)
+    monkeypatch.setattr(JobQueue, "_retried", 0)
+    monkeypatch.setattr(JobQueue, "_failed", 0)
+    monkeypatch.setattr(job_queue.CONF, "job_max_attempts", 3)
+    monkeypatch.setattr(job_queue.CONF, "job_lease_seconds", 300.0)
+    monkeypatch.setattr(job_queue.CONF, "job_retry_base_seconds", 5.0)
+    return fake
+
+
+def fail_job_calls(database):
+    return [args for query, args in database.calls if query == SqlObject.fail_job]
+
+
+def test_job_runs_once_and_completes(database):
+    payloads = []
+
+    @JobQueue.handler("score")
+    async def score(payload):
+        payloads.append(payload)
+
+    assert asyncio.run(JobQueue.enqueue("score", {"plan": "a"}, dedupe_key="a"))
+    assert asyncio.run(JobQueue.run_next())
+    assert not asyncio.run(JobQueue.run_next())
+    assert payloads == [{"plan": "a"}]
+    assert database.jobs[1]["status"] == "done"
+    assert JobQueue._completed == 1
+
+
+def test_pending_job_absorbs_duplicates(database):
+    assert asyncio.run(JobQueue.enqueue("score", {"plan": "a"}, dedupe_key="a"))
+    assert not asyncio.run(JobQueue.enqueue("score", {"plan": "a"}, dedupe_key="a"))
+    assert asyncio.run(JobQueue.enqueue("score", {"plan": "b"}, dedupe_key="b"))
+    assert len(database.jobs) == 2
+
+
+def test_failed_job_is_retried_with_backoff(database):
+    @JobQueue.handler("score")
+    async def score(payload):
+        raise ValueError("boom")
+
+    asyncio.run(JobQueue.enqueue("score", {}, dedupe_key="a"))
+    for attempt in range(1, 4):
+        assert asyncio.run(JobQueue.run_next())
+        # Not due again before the backoff has passed
+        assert not asyncio.run(JobQueue.run_next())
+        database.now += 5.0 * 2 ** (attempt - 1)
+
+    assert [args[2] for args in fail_job_calls(database)] == [5.0, 10.0, 20.0]
+    assert fail_job_calls(database)[0][1] == "ValueError: boom"
+    assert database.jobs[1]["status"] == "failed"
+    assert (JobQueue._retried, JobQueue._failed) == (2, 1)
+    assert not asyncio.run(JobQueue.run_next())
+
+
+def test_retry_is_superseded_by_newer_pending_job(database):
+    @JobQueue.handler("score")
+    async def score(payload):
+        # A request enqueues newer work for the same key while this one runs
+        await JobQueue.enqueue("score", {"version": 2}, dedupe_key="a")
+        raise ValueError("boom")
+
+    asyncio.run(JobQueue.enqueue("score", {"version": 1}, dedupe_key="a"))
+    assert asyncio.run(JobQueue.run_next())
+    assert database.jobs[1]["status"] == "superseded"
+    assert database.jobs[2]["status"] == "pending"
+    assert JobQueue._retried == 0
+
+
+def test_expired_lease_is_taken_over(database):
+    calls = []
+
+    @JobQueue.handler("score")
+    async def score(payload):
+        calls.append(payload)
+
+    asyncio.run(JobQueue.enqueue("score", {"plan": "a"}))
+    # A worker claims the job and dies without finishing it
+    asyncio.run(job_queue.Database.fetchrow(SqlObject.claim_job, 300.0))
+    assert not asyncio.run(JobQueue.run_next())
+
+    database.now += 301.0
+    assert asyncio.run(JobQueue.run_next())
+    assert calls == [{"plan": "a"}]
+    assert database.jobs[1]["attempts"] == 2
+    assert database.jobs[1]["status"] == "done"
+
+
+def test_expired_lease_on_last_attempt_fails_without_running(database):
+    calls = []
+
+    @JobQueue.handler("score")
+    async def score(payload):
+        calls.append(payload)
+
+    asyncio.run(JobQueue.enqueue("score", {}))
+    database.jobs[1].update(status="running", attempts=3, started_at=0.0)
+    database.now += 301.0
+
+    assert asyncio.run(JobQueue.run_next())
+    assert calls == []
+    assert fail_job_calls(database)[0][1] == "RuntimeError: Lease expired on the last attempt"
+    assert database.jobs[1]["status"] == "failed"
+
+
+def test_job_without_handler_fails(database):
+    asyncio.run(JobQueue.enqueue("unknown", {}))
+    assert asyncio.run(JobQueue.run_next())
+    assert fail_job_calls(database)[0][1] == "LookupError: No handler for unknown jobs"
+
+
+def test_worker_survives_purge_errors(database, monkeypatch):
+    monkeypatch.setattr(JobQueue, "_last_purge", 0.0)
+    monkeypatch.setattr(job_queue.CONF, "job_purge_interval_seconds", 0.0)
+    monkeypatch.setattr(job_queue.CONF, "job_poll_interval_seconds", 0.01)
+
+    async def run_worker():
+        JobQueue._wakeup = asyncio.Event()
+        worker = asyncio.create_task(JobQueue._work())
+        await asyncio.sleep(0.05)
+        alive = not worker.done()
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        return alive
+
+    assert asyncio.run(run_worker())
+    purges = [query for query, _ in database.calls if query == SqlObject.purge_finished_jobs]
+    assert len(purges) > 1
@@ -0,0 +1,24 @@
+import pytest
+
+from database_files.migrate import load_migrations
+
+
+def test_migrations_have_consecutive_versions():
+    migrations = load_migrations()
+    assert [m.version for m in migrations] == list(range(1, len(migrations) + 1))
+    assert migrations[0].name == "spatial_extensions"
+
+
+def test_migration_file_names_are_checked(tmp_path):
+    (tmp_path / "0002_second.sql").write_text("SELECT 2;")
+    (tmp_path / "0001_first.sql").write_text("SELECT 1;")
+    assert [m.name for m in load_migrations(tmp_path)] == ["first", "second"]
+
+    (tmp_path / "0002_again.sql").write_text("SELECT 2;")
+    with pytest.raises(ValueError, match="Duplicate"):
+        load_migrations(tmp_path)
+
+    (tmp_path / "0002_again.sql").unlink()
+    (tmp_path / "3_bad.sql").write_text("SELECT 3;")
+    with pytest.raises(ValueError, match="NNNN"):
+        load_migrations(tmp_path)
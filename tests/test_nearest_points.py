@@ -0,0 +1,55 @@
+import math
+
+import numpy as np
+
+from geo_std_utils import EARTH_RADIUS_M
+from nearest_points import k_nearest_points
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def brute_force_k_nearest(source_lats, source_lngs, lat, lng, k):
+    distances = [
+        (haversine_m(lat, lng, source_lat, source_lng), i)
+        for i, (source_lat, source_lng) in enumerate(zip(source_lats, source_lngs))
+    ]
+    return sorted(distances)[:k]
+
+
+def test_k_nearest_points_matches_brute_force():
+    rng = np.random.default_rng(3)
+    # Riyadh-sized extent plus points on both sides of the antimeridian
+    source_lats = np.concatenate([rng.uniform(24.5, 25.0, 300), rng.uniform(-17.2, -16.8, 40)])
+    source_lngs = np.concatenate([rng.uniform(46.5, 47.0, 300), rng.uniform(179.9, 180.1, 40)])
+    source_lngs = np.where(source_lngs > 180, source_lngs - 360, source_lngs)
+    target_lats = np.concatenate([rng.uniform(24.5, 25.0, 50), [-17.0, -17.0]])
+    target_lngs = np.concatenate([rng.uniform(46.5, 47.0, 50), [179.99, -179.99]])
+
+    for k, chunk_size in ((1, None), (5, 7), (len(source_lats), 16), (len(source_lats) + 10, None)):
+        indices, distances = k_nearest_points(
+            source_lats, source_lngs, target_lats, target_lngs, k, chunk_size=chunk_size
+        )
+        assert indices.shape == distances.shape == (len(target_lats), min(k, len(source_lats)))
+
+        for row, (lat, lng) in enumerate(zip(target_lats, target_lngs)):
+            expected = brute_force_k_nearest(source_lats, source_lngs, lat, lng, k)
+            assert indices[row].tolist() == [i for _, i in expected]
+            assert np.allclose(distances[row], [d for d, _ in expected], rtol=0, atol=1e-6)
+
+
+def test_k_nearest_points_without_points():
+    indices, distances = k_nearest_points([], [], [24.7, 24.8], [46.6, 46.7], 3)
+    assert indices.shape == distances.shape == (2, 0)
+
+    indices, distances = k_nearest_points([24.7], [46.6], [], [], 3)
+    assert indices.shape == distances.shape == (0, 1)
+
+    indices, distances = k_nearest_points([24.7, 24.8], [46.6, 46.7], [24.7], [46.6], 0)
+    assert indices.shape == (1, 0)
@@ -0,0 +1,52 @@
+import numpy as np
+
+from point_clustering import ClusterIndex
+
+
+def random_features(n):
+    rng = np.random.default_rng(7)
+    lats = rng.uniform(24.56, 24.92, n)
+    lngs = rng.uniform(46.50, 46.85, n)
+    return [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [float(lng), float(lat)]},
+            "properties": {"name": f"p{i}", "rating": i % 5, "population": 10, "phone": ""},
+        }
+        for i, (lat, lng) in enumerate(zip(lats, lngs))
+    ]
+
+
+def test_clusters_keep_counts_and_aggregates_at_every_zoom():
+    features = random_features(2000)
+    index = ClusterIndex(features, max_zoom=16)
+
+    sizes = []
+    for zoom in range(0, 18):
+        clusters = index.clusters(zoom)
+        sizes.append(len(clusters))
+        assert sum(f["properties"].get("point_count", 1) for f in clusters) == 2000
+        assert sum(
+            f["properties"].get("population_sum", f["properties"].get("population"))
+            for f in clusters
+        ) == 20000
+        for feature in clusters:
+            properties = feature["properties"]
+            if properties.get("cluster"):
+                assert properties["population_avg"] == 10
+                assert "phone_sum" not in properties
+
+    # Fewer, larger clusters when zooming out, raw points past max_zoom
+    assert sizes == sorted(sizes) and sizes[0] == 1
+    assert index.clusters(17) == features
+    assert index.clusters(30) == features
+    # Layer heads are served from the index without the dataset
+    assert index.feature_count == 2000
+    assert index.feature_properties == ["name", "rating", "population", "phone"]
+
+
+def test_features_without_point_geometry_are_passed_through():
+    polygon = {"type": "Feature", "geometry": {"type": "Polygon"}, "properties": {}}
+    index = ClusterIndex(random_features(50) + [polygon])
+    assert index.clusters(0)[-1] is polygon
+    assert len(index.clusters(0)) == 2
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from quantile_sketch import QuantileSketch
+
+
+def test_sketch_is_exact_for_few_distinct_values():
+    rng = np.random.default_rng(3)
+    # Popularity scores: category multiplier times zoom multiplier
+    values = rng.choice([1.0, 0.8, 0.6, 0.4], 500) * rng.choice([1000, 500, 62.5], 500)
+
+    sketch = QuantileSketch()
+    for chunk in np.array_split(values, 7):
+        part = QuantileSketch()
+        part.add(chunk.tolist())
+        sketch.merge(QuantileSketch.from_dict(part.to_dict()))
+
+    assert sketch.count == 500
+    assert sketch.quantiles([0, 25, 50, 75, 100]) == pytest.approx(
+        np.percentile(values, [0, 25, 50, 75, 100])
+    )
+
+
+def test_compressed_sketch_stays_close():
+    values = np.random.default_rng(5).normal(100, 15, 20_000)
+    sketch = QuantileSketch(max_bins=64)
+    sketch.add(values.tolist())
+
+    assert sketch.count == 20_000
+    for got, expected in zip(sketch.quantiles([25, 50, 75]), np.percentile(values, [25, 50, 75])):
+        assert abs(got - expected) < 1.5
+
+    with pytest.raises(ValueError):
+        QuantileSketch().quantiles([50])
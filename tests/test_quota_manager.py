@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("backend_common")
+
+from quota_manager import ApiQuota  # noqa: E402
+
+
+class GatedBucket:
+    """
+    Bucket whose every reply is held until the test releases it, like the
+    shared bucket waiting on Postgres.
+    """
+
+    def __init__(self):
+        self.replies = asyncio.Queue()
+        self.calls = 0
+
+    async def try_acquire(self) -> float:
+        self.calls += 1
+        return await self.replies.get()
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_tokens_are_handed_out_round_robin():
+    async def run():
+        bucket = GatedBucket()
+        quota = ApiQuota("test", bucket)
+        granted = []
+
+        async def call(user_id, n):
+            await quota.acquire(user_id)
+            granted.append((user_id, n))
+
+        tasks = [asyncio.create_task(call("a", n)) for n in range(3)]
+        tasks += [asyncio.create_task(call("b", n)) for n in range(2)]
+        await settle()
+        for _ in tasks:
+            bucket.replies.put_nowait(0.0)
+        await asyncio.gather(*tasks)
+        return granted, quota.metrics()
+
+    granted, metrics = asyncio.run(run())
+    assert granted == [("a", 0), ("b", 0), ("a", 1), ("b", 1), ("a", 2)]
+    assert metrics["granted"] == 5
+    assert metrics["queue_depth"] == 0
+
+
+def test_waiter_cancelled_while_bucket_replies():
+    async def run():
+        bucket = GatedBucket()
+        quota = ApiQuota("test", bucket)
+        cancelled = asyncio.create_task(quota.acquire("a"))
+        other = asyncio.create_task(quota.acquire("b"))
+        await settle()
+
+        # The first waiter goes away in the loop iteration the bucket replies
+        bucket.replies.put_nowait(0.0)
+        cancelled.cancel()
+        await asyncio.wait_for(other, timeout=1)
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        return bucket.calls, quota
+
+    calls, quota = asyncio.run(run())
+    # The token taken while "a" was cancelled went to "b"
+    assert calls == 1
+    assert quota.metrics()["granted"] == 1
+    assert not quota._dispatcher.cancelled() and quota._dispatcher.exception() is None
+
+
+def test_token_of_cancelled_waiters_is_kept_for_the_next():
+    async def run():
+        bucket = GatedBucket()
+        quota = ApiQuota("test", bucket)
+        waiter = asyncio.create_task(quota.acquire("a"))
+        await settle()
+        waiter.cancel()
+        bucket.replies.put_nowait(0.0)
+        await settle()
+
+        # No bucket reply is queued: the next waiter runs on the kept token
+        await asyncio.wait_for(quota.acquire("b"), timeout=1)
+        return bucket.calls
+
+    assert asyncio.run(run()) == 1
@@ -0,0 +1,57 @@
+from collections import Counter
+
+import numpy as np
+
+from route_matrix import pack_route_matrix_batches
+
+
+def random_nearest_locations(rng, n_stores, n_targets, k):
+    stores = [
+        (round(lat, 6), round(lng, 6))
+        for lat, lng in zip(rng.uniform(24.5, 25.0, n_stores), rng.uniform(46.5, 47.0, n_stores))
+    ]
+    return [
+        {
+            "target": {"latitude": float(lat), "longitude": float(lng)},
+            "nearest_coordinates": [stores[j] for j in rng.choice(n_stores, k, replace=False)],
+        }
+        for lat, lng in zip(rng.uniform(24.5, 25.0, n_targets), rng.uniform(46.5, 47.0, n_targets))
+    ]
+
+
+def counted_pairs(nearest_locations, batches):
+    counted = Counter()
+    for positions, destinations, pairs in batches:
+        for origin_index, destination_index in pairs:
+            counted[positions[origin_index], destinations[destination_index]] += 1
+    return counted
+
+
+def test_every_wanted_pair_is_counted_once():
+    rng = np.random.default_rng(7)
+    # Few stores shared by many targets, so columns are split into chunks
+    for n_stores, n_targets, k in ((36, 353, 3), (5, 400, 2), (200, 50, 5), (1, 120, 1)):
+        nearest_locations = random_nearest_locations(rng, n_stores, n_targets, k)
+        for max_elements, max_waypoints in ((625, 50), (100, 25), (10, 4)):
+            batches = pack_route_matrix_batches(nearest_locations, max_elements, max_waypoints)
+
+            wanted = Counter(
+                (i, coord)
+                for i, item in enumerate(nearest_locations)
+                for coord in set(item["nearest_coordinates"])
+            )
+            assert counted_pairs(nearest_locations, batches) == wanted
+
+            for positions, destinations, _ in batches:
+                assert len(positions) * len(destinations) <= max_elements
+                assert len(positions) + len(destinations) <= max_waypoints
+
+
+def test_duplicate_coordinates_and_empty_targets():
+    nearest_locations = [
+        {"target": {"latitude": 24.7, "longitude": 46.7}, "nearest_coordinates": [(1.0, 2.0)] * 3},
+        {"target": {"latitude": 24.8, "longitude": 46.8}, "nearest_coordinates": []},
+    ]
+    batches = pack_route_matrix_batches(nearest_locations, 625, 50)
+    assert counted_pairs(nearest_locations, batches) == {(0, (1.0, 2.0)): 1}
+    assert pack_route_matrix_batches([], 625, 50) == []
@@ -0,0 +1,68 @@
+import pytest
+
+from search_plan import END_OF_PLAN, SearchPlan
+
+
+def circle(lng, lat, radius_km, sub_circles=(), is_center=False):
+    return {
+        "center": (lng, lat),
+        "radius": radius_km,
+        "sub_circles": list(sub_circles),
+        "is_center": is_center,
+    }
+
+
+def make_plan():
+    # 1 > 1.1 .. 1.3, 1.2 > 1.2.1 .. 1.2.2
+    hierarchy = circle(
+        46.6753,
+        24.7136,
+        30.0,
+        [
+            circle(46.6753, 24.7136, 15.0, is_center=True),
+            circle(46.8, 24.7136, 15.0, [circle(46.8, 24.7136, 7.5, is_center=True), circle(46.9, 24.7, 7.5)]),
+            circle(46.6, 24.8, 15.0),
+        ],
+    )
+    return SearchPlan.from_circle_hierarchy(hierarchy, "coffee_shop_best_coffee")
+
+
+def test_entries_keep_the_plan_string_format():
+    plan = make_plan()
+    entries = plan.to_entries()
+
+    assert [c.number for c in plan] == ["1", "1.1", "1.2", "1.3", "1.2.1", "1.2.2"]
+    assert entries[0] == "46.6753_24.7136_30000.0_coffee_shop_best_coffee_circle=1_circleNumber=1"
+    assert entries[1] == "46.6753_24.7136_15000.0_coffee_shop_best_coffee_circle=1.1*_circleNumber=2"
+    assert entries[-1] == END_OF_PLAN
+    assert plan.dataset_prefix(2) == "46.8_24.7136_15000.0_coffee_shop_best_coffee"
+
+    parsed = SearchPlan.from_entries(entries)
+    assert parsed.query == "coffee_shop_best_coffee"
+    assert [c.parent for c in parsed] == [-1, 0, 0, 0, 2, 2]
+    assert parsed.to_entries() == entries
+
+
+def test_skip_subcircles_marks_the_subtree_only():
+    plan = make_plan()
+    copy = plan.copy()
+
+    plan.skip_subcircles(0)
+    assert list(plan.skipped) == [0, 1, 1, 1, 1, 1]
+    assert plan.next_unskipped(0) is None
+    assert list(copy.skipped) == [0] * 6
+
+    copy.skip_subcircles(2)
+    assert list(copy.skipped) == [0, 0, 0, 0, 1, 1]
+    assert copy.next_unskipped(2) == 3
+    assert copy.entry(4).endswith("_circleNumber=5_skip")
+
+    columns = copy.to_columns()
+    assert columns["parent_number"] == [None, "1", "1", "1", "1.2", "1.2"]
+    rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    assert SearchPlan.from_rows(copy.query, rows[::-1]).to_entries() == copy.to_entries()
+
+
+def test_invalid_plan_entries_are_rejected():
+    with pytest.raises(ValueError):
+        SearchPlan.from_entries(["not a plan entry", END_OF_PLAN])
@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_followers_get_copies_of_one_call():
+    async def run():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await release.wait()
+            return {"features": [1, 2]}
+
+        leader = asyncio.create_task(flights.do("k", fetch))
+        followers = [asyncio.create_task(flights.do("k", fetch)) for _ in range(2)]
+        await settle()
+        assert flights.metrics() == {"in_flight": 1, "coalesced": 2}
+        release.set()
+        results = await asyncio.gather(leader, *followers)
+        return calls, results, flights.metrics()
+
+    calls, results, metrics = asyncio.run(run())
+    assert calls == [1]
+    assert all(result == {"features": [1, 2]} for result in results)
+    assert len({id(result) for result in results}) == 3
+    assert metrics["in_flight"] == 0
+
+
+def test_leader_may_mutate_its_result():
+    async def run():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return {"features": [1]}
+
+        async def mutating_leader():
+            result = await flights.do("k", fetch)
+            result["features"].append(2)
+            return result
+
+        leader = asyncio.create_task(mutating_leader())
+        await settle()
+        follower = asyncio.create_task(flights.do("k", fetch))
+        await settle()
+        release.set()
+        return await asyncio.gather(leader, follower)
+
+    leader_result, follower_result = asyncio.run(run())
+    assert leader_result == {"features": [1, 2]}
+    assert follower_result == {"features": [1]}
+
+
+def test_exception_reaches_every_caller():
+    async def run():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            raise ValueError("quota exceeded")
+
+        tasks = [asyncio.create_task(flights.do("k", fetch)) for _ in range(3)]
+        await settle()
+        release.set()
+        return await asyncio.gather(*tasks, return_exceptions=True), flights.metrics()
+
+    results, metrics = asyncio.run(run())
+    assert [type(result) for result in results] == [ValueError] * 3
+    assert metrics["in_flight"] == 0
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    async def run():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return {"features": [1]}
+
+        leader = asyncio.create_task(flights.do("k", fetch))
+        await settle()
+        follower = asyncio.create_task(flights.do("k", fetch))
+        await settle()
+
+        leader.cancel()
+        await settle()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == {"features": [1]}
+
+
+def test_call_is_cancelled_when_every_caller_is_gone():
+    async def run():
+        flights = SingleFlight()
+        started, cancelled = asyncio.Event(), asyncio.Event()
+
+        async def fetch():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        tasks = [asyncio.create_task(flights.do("k", fetch)) for _ in range(2)]
+        await started.wait()
+        tasks[0].cancel()
+        await settle()
+        assert not cancelled.is_set()
+        tasks[1].cancel()
+        await settle()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return cancelled.is_set(), flights.metrics()
+
+    was_cancelled, metrics = asyncio.run(run())
+    assert was_cancelled
+    assert metrics["in_flight"] == 0
@@ -0,0 +1,51 @@
+import numpy as np
+from geopy.distance import geodesic
+
+from spatial_index import SpatialGridIndex
+
+
+def brute_force_radius(lats, lngs, lat, lng, radius):
+    return [
+        i
+        for i in range(len(lats))
+        if geodesic((lat, lng), (lats[i], lngs[i])).meters <= radius
+    ]
+
+
+def test_query_radius_matches_geodesic_scan():
+    rng = np.random.default_rng(42)
+    # Jeddah-sized extent plus a cluster that straddles the antimeridian
+    lats = np.concatenate([rng.uniform(21.3, 21.8, 600), rng.uniform(-17.2, -16.8, 200)])
+    lngs = np.concatenate([rng.uniform(39.0, 39.4, 600), rng.uniform(179.8, 180.2, 200)])
+    lngs = np.where(lngs > 180, lngs - 360, lngs)
+
+    for radius in (250.0, 1000.0, 5000.0):
+        index = SpatialGridIndex(lats, lngs, cell_size_m=1000.0)
+        for lat, lng in zip(lats[::41], lngs[::41]):
+            expected = brute_force_radius(lats, lngs, lat, lng, radius)
+            assert index.query_radius(lat, lng, radius).tolist() == expected
+
+
+def test_query_radius_on_boundary_points():
+    center = (24.7136, 46.6753)
+    radius = 2000.0
+    ring = [
+        geodesic(meters=radius * factor).destination(center, bearing)
+        for bearing in range(0, 360, 15)
+        for factor in (0.999, 1.001)
+    ]
+    lats = [p.latitude for p in ring]
+    lngs = [p.longitude for p in ring]
+
+    index = SpatialGridIndex(lats, lngs, cell_size_m=radius)
+    expected = brute_force_radius(lats, lngs, center[0], center[1], radius)
+
+    assert index.query_radius(center[0], center[1], radius).tolist() == expected
+    assert len(expected) == len(ring) // 2
+
+
+def test_empty_index():
+    index = SpatialGridIndex.from_features([], cell_size_m=500.0)
+
+    assert len(index) == 0
+    assert index.query_radius(21.5, 39.1, 500.0).size == 0
@@ -0,0 +1,137 @@
+import struct
+
+from vector_tiles import TILE_EXTENT, LayerTiles, encode_point_tile
+
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def read_fields(data):
+    # (field number, value) pairs of a protobuf message
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value, pos = data[pos : pos + 8], pos + 8
+        else:
+            length, pos = read_varint(data, pos)
+            value, pos = data[pos : pos + length], pos + length
+        yield field_number, value
+
+
+def read_packed(data):
+    values, pos = [], 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode_value(data):
+    field_number, value = next(read_fields(data))
+    if field_number == 1:
+        return value.decode()
+    if field_number == 3:
+        return struct.unpack("<d", value)[0]
+    if field_number == 5:
+        return value
+    if field_number == 6:
+        return unzigzag(value)
+    return bool(value)
+
+
+def decode_tile(data):
+    layers = {}
+    for _, layer_data in read_fields(data):
+        fields = list(read_fields(layer_data))
+        keys = [v.decode() for f, v in fields if f == 3]
+        values = [decode_value(v) for f, v in fields if f == 4]
+        features = []
+        for f, feature_data in fields:
+            if f != 2:
+                continue
+            feature = dict(read_fields(feature_data))
+            tags = read_packed(feature.get(2, b""))
+            command, x, y = read_packed(feature[4])
+            assert command == 9 and feature[3] == 1
+            features.append(
+                (
+                    (unzigzag(x), unzigzag(y)),
+                    {keys[k]: values[v] for k, v in zip(tags[::2], tags[1::2])},
+                )
+            )
+        name = next(v.decode() for f, v in fields if f == 1)
+        layers[name] = features
+    return layers
+
+
+def point(lng, lat, **properties):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [lng, lat]},
+        "properties": properties,
+    }
+
+
+def test_encode_point_tile_round_trips_properties():
+    features = [
+        point(0, 0, name="a", rating=4.5, count=3, delta=-2, open=True, types=["x"]),
+        point(0, 0, name="b", rating=None),
+    ]
+    layers = decode_tile(encode_point_tile("lyr", features, [10, 4096], [-5, 0]))
+
+    assert layers["lyr"] == [
+        (
+            (10, -5),
+            {
+                "name": "a",
+                "rating": 4.5,
+                "count": 3,
+                "delta": -2,
+                "open": True,
+                "types": '["x"]',
+            },
+        ),
+        ((4096, 0), {"name": "b"}),
+    ]
+    assert encode_point_tile("lyr", [], [], []) == b""
+
+
+def test_layer_tiles_selects_features_in_tile():
+    # Riyadh, a point across the Greenwich tile border at z1, and Sydney
+    features = [
+        point(46.6753, 24.7136, name="riyadh"),
+        point(-0.05, 10.0, name="greenwich"),
+        point(151.2093, -33.8688, name="sydney"),
+        {"type": "Feature", "geometry": None, "properties": {"name": "no geometry"}},
+    ]
+    layer_tiles = LayerTiles("lyr", "dataset", features, max_tiles=2)
+
+    z0 = decode_tile(layer_tiles.tile(0, 0, 0))["lyr"]
+    assert sorted(p["name"] for _, p in z0) == ["greenwich", "riyadh", "sydney"]
+
+    # North-east quarter: Riyadh, plus Greenwich inside the tile buffer
+    z1 = decode_tile(layer_tiles.tile(1, 1, 0))["lyr"]
+    assert sorted(p["name"] for _, p in z1) == ["greenwich", "riyadh"]
+    (x, y), _ = next(f for f in z1 if f[1]["name"] == "greenwich")
+    assert x == -1 and 0 < y < TILE_EXTENT
+
+    assert layer_tiles.tile(1, 0, 1) == b""
+    # Tiles are cached, least recently used evicted first
+    layer_tiles.tile(1, 1, 0)
+    assert (layer_tiles.hits, layer_tiles.misses, layer_tiles.tile_count()) == (1, 3, 2)
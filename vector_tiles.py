@@ -0,0 +1,253 @@
+import struct
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import orjson
+
+from geo_std_utils import to_web_mercator_unit
+
+# Tile coordinate range, the Mapbox default
+TILE_EXTENT = 4096
+# Points up to this far outside a tile (in tile units) are included, so that
+# symbols near a tile border are not clipped by the renderer
+TILE_BUFFER = 64
+MAX_TILE_ZOOM = 24
+
+# Protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+
+# MoveTo command with a count of 1, see the Mapbox Vector Tile spec 4.3
+_MOVE_TO_ONE = (1 & 0x7) | (1 << 3)
+_GEOM_TYPE_POINT = 1
+
+
+def _varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _key(out: bytearray, field_number: int, wire_type: int):
+    _varint(out, (field_number << 3) | wire_type)
+
+
+def _bytes_field(out: bytearray, field_number: int, data: bytes):
+    _key(out, field_number, _LENGTH_DELIMITED)
+    _varint(out, len(data))
+    out += data
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def encode_value(value: Any) -> Optional[bytes]:
+    """
+    Encodes a feature property as a vector tile Value message. Lists and
+    dicts, which MVT cannot represent, are sent as JSON strings. Returns None
+    for null properties, which are left out of the tile.
+    """
+    out = bytearray()
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        _key(out, 7, _VARINT)
+        _varint(out, int(value))
+    elif isinstance(value, int) and 0 <= value < 2**64:
+        _key(out, 5, _VARINT)
+        _varint(out, value)
+    elif isinstance(value, int) and -(2**63) <= value < 0:
+        _key(out, 6, _VARINT)
+        _varint(out, _zigzag(value))
+    elif isinstance(value, float):
+        _key(out, 3, _FIXED64)
+        out += struct.pack("<d", value)
+    else:
+        if not isinstance(value, str):
+            value = orjson.dumps(value).decode()
+        _bytes_field(out, 1, value.encode())
+    return bytes(out)
+
+
+def encode_point_tile(
+    layer_name: str,
+    features: List[Dict],
+    tile_xs: List[int],
+    tile_ys: List[int],
+    extent: int = TILE_EXTENT,
+) -> bytes:
+    """
+    Encodes point features as a Mapbox Vector Tile with a single layer.
+    `tile_xs` and `tile_ys` are the features' positions in tile coordinates.
+    A tile without features is encoded as an empty body.
+    """
+    if not features:
+        return b""
+
+    keys: Dict[str, int] = {}
+    values: Dict[bytes, int] = {}
+    layer = bytearray()
+    _key(layer, 15, _VARINT)
+    _varint(layer, 2)
+    _bytes_field(layer, 1, layer_name.encode())
+
+    for feature, x, y in zip(features, tile_xs, tile_ys):
+        tags = bytearray()
+        for key, value in (feature.get("properties") or {}).items():
+            encoded = encode_value(value)
+            if encoded is None:
+                continue
+            _varint(tags, keys.setdefault(key, len(keys)))
+            _varint(tags, values.setdefault(encoded, len(values)))
+
+        geometry = bytearray()
+        _varint(geometry, _MOVE_TO_ONE)
+        _varint(geometry, _zigzag(x))
+        _varint(geometry, _zigzag(y))
+
+        message = bytearray()
+        if tags:
+            _bytes_field(message, 2, tags)
+        _key(message, 3, _VARINT)
+        _varint(message, _GEOM_TYPE_POINT)
+        _bytes_field(message, 4, geometry)
+        _bytes_field(layer, 2, message)
+
+    for key in keys:
+        _bytes_field(layer, 3, key.encode())
+    for value in values:
+        _bytes_field(layer, 4, value)
+    _key(layer, 5, _VARINT)
+    _varint(layer, extent)
+
+    tile = bytearray()
+    _bytes_field(tile, 3, layer)
+    return bytes(tile)
+
+
+class LayerTiles:
+    """
+    A point layer prepared for tiling, and the tiles encoded from it so far.
+
+    Features are projected to Web Mercator once and sorted by x, so a tile
+    only scans the features in its column. Encoded tiles are kept, least
+    recently used first, up to `max_tiles`.
+    """
+
+    def __init__(
+        self, layer_name: str, dataset_id: str, features: List[Dict], max_tiles: int
+    ):
+        self.layer_name = layer_name
+        self.dataset_id = dataset_id
+        self.max_tiles = max_tiles
+        self.created_at = time.monotonic()
+        self._tiles: "OrderedDict[Tuple[int, int, int], bytes]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        points = [
+            feature
+            for feature in features
+            if (feature.get("geometry") or {}).get("type") == "Point"
+        ]
+        coordinates = np.array(
+            [feature["geometry"]["coordinates"][:2] for feature in points],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        mercator = to_web_mercator_unit(coordinates[:, 1], coordinates[:, 0])
+        order = np.argsort(mercator[:, 0], kind="stable")
+        self.features = [points[i] for i in order]
+        self.xs = mercator[order, 0]
+        self.ys = mercator[order, 1]
+
+    def tile(self, z: int, x: int, y: int) -> bytes:
+        key = (z, x, y)
+        encoded = self._tiles.get(key)
+        if encoded is not None:
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return encoded
+
+        self.misses += 1
+        encoded = self._encode(z, x, y)
+        self._tiles[key] = encoded
+        while len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return encoded
+
+    def _encode(self, z: int, x: int, y: int) -> bytes:
+        scale = 2**z
+        buffer = TILE_BUFFER / TILE_EXTENT
+        start = np.searchsorted(self.xs, (x - buffer) / scale, side="left")
+        end = np.searchsorted(self.xs, (x + 1 + buffer) / scale, side="right")
+
+        tile_xs = np.rint((self.xs[start:end] * scale - x) * TILE_EXTENT)
+        tile_ys = np.rint((self.ys[start:end] * scale - y) * TILE_EXTENT)
+        inside = np.nonzero(
+            (tile_xs >= -TILE_BUFFER)
+            & (tile_xs <= TILE_EXTENT + TILE_BUFFER)
+            & (tile_ys >= -TILE_BUFFER)
+            & (tile_ys <= TILE_EXTENT + TILE_BUFFER)
+        )[0]
+
+        return encode_point_tile(
+            self.layer_name,
+            [self.features[start + i] for i in inside],
+            tile_xs[inside].astype(np.int64).tolist(),
+            tile_ys[inside].astype(np.int64).tolist(),
+        )
+
+    def tile_count(self) -> int:
+        return len(self._tiles)
+
+
+class TileCache:
+    """
+    Per-layer tile cache: one LayerTiles per producer layer, least recently
+    used layers evicted past `max_layers`. A layer is rebuilt from its
+    dataset after `ttl_seconds`, so dataset updates and changes made by other
+    worker processes show up.
+    """
+
+    def __init__(self, max_layers: int, max_tiles_per_layer: int, ttl_seconds: float):
+        self.max_layers = max_layers
+        self.max_tiles_per_layer = max_tiles_per_layer
+        self.ttl_seconds = ttl_seconds
+        self._layers: "OrderedDict[str, LayerTiles]" = OrderedDict()
+        self.builds = 0
+
+    def get(self, layer_id: str) -> Optional[LayerTiles]:
+        layer_tiles = self._layers.get(layer_id)
+        if layer_tiles is None:
+            return None
+        if time.monotonic() - layer_tiles.created_at > self.ttl_seconds:
+            del self._layers[layer_id]
+            return None
+        self._layers.move_to_end(layer_id)
+        return layer_tiles
+
+    def build(self, layer_id: str, dataset_id: str, features: List[Dict]) -> LayerTiles:
+        layer_tiles = LayerTiles(layer_id, dataset_id, features, self.max_tiles_per_layer)
+        self._layers[layer_id] = layer_tiles
+        self._layers.move_to_end(layer_id)
+        self.builds += 1
+        while len(self._layers) > self.max_layers:
+            self._layers.popitem(last=False)
+        return layer_tiles
+
+    def invalidate(self, layer_id: str):
+        self._layers.pop(layer_id, None)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "layers": len(self._layers),
+            "tiles": sum(layer.tile_count() for layer in self._layers.values()),
+            "builds": self.builds,
+            "hits": sum(layer.hits for layer in self._layers.values()),
+            "misses": sum(layer.misses for layer in self._layers.values()),
+        }